@@ -0,0 +1,555 @@
+"""
+性能测试脚本，不依赖饭否服务器，所有请求都发往本地的模拟服务器。
+
+用法::
+
+    python bench.py            # 运行所有测试
+    python bench.py async_fan  # 只运行指定的测试
+"""
+import asyncio
+import collections
+import functools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import van
+
+CONSUMER_KEY = 'b55d535f350dcc59c3f10e9cf43c1749'
+CONSUMER_SECRET = 'e9d72893b188b6340ad35f15b6aa7837'
+OAUTH_TOKEN = {'oauth_token': 'token', 'oauth_token_secret': 'secret'}
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+
+def fake_user(id='test'):
+    return {
+        'id': id, 'unique_id': '~' + id, 'name': id, 'screen_name': id, 'location': '北京',
+        'gender': '男', 'birthday': '', 'description': '', 'protected': False,
+        'followers_count': 100, 'friends_count': 100, 'favourites_count': 10, 'statuses_count': 1000,
+        'following': False, 'notifications': False, 'utc_offset': 28800,
+        'created_at': 'Sat Jun 17 07:14:00 +0000 2017',
+        'profile_image_url': 'http://avatar1.fanfou.com/s0/00/00/00.jpg',
+        'profile_image_url_large': 'http://avatar1.fanfou.com/l0/00/00/00.jpg',
+    }
+
+
+def fake_status(rawid, user=None):
+    return {
+        'id': 'status{}'.format(rawid), 'rawid': rawid, 'text': '你好啊，李银河！ #测试# @test',
+        'created_at': 'Sat Jun 17 07:14:00 +0000 2017', 'source': '网页', 'truncated': False,
+        'in_reply_to_status_id': '', 'in_reply_to_user_id': '', 'in_reply_to_screen_name': '',
+        'favorited': False, 'is_self': False, 'location': '北京',
+        'user': user or fake_user(),
+    }
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """对所有请求返回同一个 JSON 响应的本地服务器"""
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, payload, delay=0.0):
+        body = json.dumps(payload).encode('utf8')
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _reply(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                if delay:
+                    time.sleep(delay)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = _reply
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+    @property
+    def api_url(self):
+        return 'http://127.0.0.1:{}/{{}}.json'.format(self.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class StreamStubServer(ThreadingMixIn, HTTPServer):
+    """模拟 Streaming API：每个连接以 chunked 编码发送相同的数据后保持连接"""
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, data, hold=1.0):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                self.send_response(200)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for chunk in split_chunks(data):
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                self.wfile.flush()
+                time.sleep(hold)
+                self.wfile.write(b'0\r\n\r\n')
+                self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(('127.0.0.1', 0), Handler)
+
+    @property
+    def stream_url(self):
+        return 'http://127.0.0.1:{}/1/user.json'.format(self.server_address[1])
+
+    __enter__ = StubServer.__enter__
+    __exit__ = StubServer.__exit__
+
+
+def run_async(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def report(name, n, elapsed, unit='req'):
+    print('{:<40} {:>10.1f} {}/s  ({} in {:.3f}s)'.format(name, n / elapsed, unit, n, elapsed))
+
+
+@benchmark
+def bench_async_fan(total=2000, concurrency=50, delay=0.01):
+    """比较线程池中的 Fan 与单个事件循环中的 AsyncFan 的吞吐量"""
+    with StubServer(fake_user(), delay=delay) as server:
+        fan = van.Fan(CONSUMER_KEY, CONSUMER_SECRET, OAUTH_TOKEN)
+        fan.api_url = server.api_url
+        fan.session.mount('http://', van.requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(lambda _: fan.get('users/show'), range(total)))
+        report('Fan ({} threads)'.format(concurrency), total, time.perf_counter() - start)
+
+        async def run():
+            async with van.AsyncFan(CONSUMER_KEY, CONSUMER_SECRET, OAUTH_TOKEN, limit=concurrency) as afan:
+                afan.api_url = server.api_url
+                sem = asyncio.Semaphore(concurrency)
+
+                async def one():
+                    async with sem:
+                        await afan.get('users/show')
+
+                start = time.perf_counter()
+                await asyncio.gather(*[one() for _ in range(total)])
+                report('AsyncFan ({} tasks)'.format(concurrency), total, time.perf_counter() - start)
+
+        run_async(run())
+
+
+@benchmark
+def bench_created_at(total=20000):
+    """比较 arrow 与 parse_time 的解析速度，以及延迟解析对构造 Status 的影响"""
+    raw = 'Sat Jun 17 07:14:00 +0000 2017'
+    fmt = 'ddd MMM DD HH:mm:ss Z YYYY'
+
+    start = time.perf_counter()
+    for _ in range(total):
+        van.arrow.get(raw, fmt)
+    report('arrow.get', total, time.perf_counter() - start, 'parse')
+
+    start = time.perf_counter()
+    for _ in range(total):
+        van.parse_time(raw)
+    report('parse_time', total, time.perf_counter() - start, 'parse')
+
+    fan = van.Fan(CONSUMER_KEY, CONSUMER_SECRET, OAUTH_TOKEN)
+    data = [fake_status(i) for i in range(total)]
+
+    start = time.perf_counter()
+    for d in data:
+        status = van.Status.from_json(fan, d)
+        # 模拟之前在 __init__ 中立即解析 Status 和 User 的 created_at
+        van.arrow.get(status.created_at_raw, fmt)
+        van.arrow.get(status.user.created_at_raw, fmt)
+    report('Status (eager arrow)', total, time.perf_counter() - start, 'obj')
+
+    start = time.perf_counter()
+    for d in data:
+        van.Status.from_json(fan, d)
+    report('Status (lazy created_at)', total, time.perf_counter() - start, 'obj')
+
+    statuses = [van.Status.from_json(fan, d) for d in data]
+    start = time.perf_counter()
+    statuses.sort(key=lambda s: s.timestamp)
+    report('sort by timestamp', total, time.perf_counter() - start, 'obj')
+
+
+def measure(build, total):
+    """返回 build() 构造的对象在内存中平均每条占用的字节数"""
+    payload = json.dumps([fake_status(i, fake_user('user{}'.format(i % 50))) for i in range(total)])
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    data = json.loads(payload)
+    objects = build(data)
+    del data
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    assert len(objects) == total
+    return size / total
+
+
+@benchmark
+def bench_memory(total=20000):
+    """每条消息占用的内存"""
+    fan = van.Fan(CONSUMER_KEY, CONSUMER_SECRET, OAUTH_TOKEN)
+    fan_im = van.Fan(CONSUMER_KEY, CONSUMER_SECRET, OAUTH_TOKEN, identity_map=True)
+
+    def statuses(fan):
+        def build(data):
+            rv = [van.Status.from_json(fan, d) for d in data]
+            for s in rv:
+                s.user  # 访问作者，生成 User 对象
+            return rv
+        return build
+
+    print('{:<40} {:>10.0f} bytes/status'.format('json dict', measure(lambda data: data, total)))
+    print('{:<40} {:>10.0f} bytes/status'.format('Status', measure(statuses(fan), total)))
+    print('{:<40} {:>10.0f} bytes/status'.format('Status (identity map)', measure(statuses(fan_im), total)))
+
+
+def fake_event(rawid):
+    status = fake_status(rawid)
+    return {'event': 'message.create', 'source': status['user'], 'target': None, 'object': status,
+            'created_at': 'Sat, 17 Jun 2017 07:14:00 +0000'}
+
+
+def recorded_stream(total, heartbeat_every=20):
+    """模拟录制下来的流式数据：每条事件以 \\r\\n 结尾，中间穿插心跳"""
+    frames = []
+    for i in range(total):
+        frames.append(json.dumps(fake_event(i), ensure_ascii=False).encode('utf8') + b'\r\n')
+        if i % heartbeat_every == 0:
+            frames.append(b'\r\n')
+    return b''.join(frames)
+
+
+def split_chunks(data, seed=0):
+    """按照随机大小切分数据，模拟网络上收到的数据块"""
+    rnd = random.Random(seed)
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = rnd.choice((1, 64, 512, 1460, 4096, 16384))
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+
+@benchmark
+def bench_stream_framing(total=20000):
+    """比较字符串拼接切分与 StreamFramer 的吞吐量"""
+    data = recorded_stream(total)
+    chunks = split_chunks(data)
+    mb = len(data) / 1e6
+
+    # 之前的做法：每个数据块当作一个完整的 JSON
+    lost = 0
+    for chunk in chunks:
+        try:
+            json.loads(chunk.decode('utf8'))
+        except ValueError:
+            lost += 1
+    print('{:<40} {:>10} of {} chunks unparsable'.format('chunk as document', lost, len(chunks)))
+
+    start = time.perf_counter()
+    frames = corrupted = 0
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk.decode('utf8', 'replace')
+        *complete, buffer = buffer.split('\r\n')
+        frames += len(complete)
+        corrupted += sum('\ufffd' in f for f in complete)
+    elapsed = time.perf_counter() - start
+    report('str concat + split', frames, elapsed, 'frame')
+    print('{:<40} {:>10} frames with broken utf8'.format('str concat + split', corrupted))
+
+    start = time.perf_counter()
+    framer = van.StreamFramer()
+    frames = 0
+    for chunk in chunks:
+        frames += len(framer.feed(chunk))
+    elapsed = time.perf_counter() - start
+    report('StreamFramer', frames, elapsed, 'frame')
+    report('StreamFramer', mb, elapsed, 'MB')
+
+    fan = van.Fan(CONSUMER_KEY, CONSUMER_SECRET, OAUTH_TOKEN)
+    stream = van.Stream.__new__(van.Stream)
+    stream.fan = fan
+    stream._seen = van.collections.OrderedDict()
+    stream._last_rawid = -1
+    start = time.perf_counter()
+    framer = van.StreamFramer()
+    events = 0
+    for chunk in chunks:
+        for frame in framer.feed(chunk):
+            stream._parse_frame(frame)
+            events += 1
+    report('StreamFramer + Event', events, time.perf_counter() - start, 'event')
+
+
+@benchmark
+def bench_listener_dispatch(listeners=5000, total=20000):
+    """比较逐个扫描监听器与按事件类型索引的分发速度"""
+    Event = van.Event
+    masks = (Event.MESSAGE_CREATE, Event.FRIENDS, Event.FAV, Event.USER, Event.HEART_BEAT)
+    rnd = random.Random(0)
+    table = van.ListenerTable()
+    for i in range(listeners):
+        table.install(van.Listener(rnd.choice(masks), None))
+    scan = table.listeners
+    lock = threading.RLock()
+    types = [rnd.choice(Event.TYPES) for _ in range(total)]
+
+    start = time.perf_counter()
+    for type in types:
+        with lock:
+            [lsn.action for lsn in scan if lsn.on & type and (lsn.ttl is None or lsn.ttl > 0)]
+    report('linear scan ({} listeners)'.format(listeners), total, time.perf_counter() - start, 'event')
+
+    start = time.perf_counter()
+    for type in types:
+        table.actions(type)
+    report('ListenerTable ({} listeners)'.format(listeners), total, time.perf_counter() - start, 'event')
+
+
+@benchmark
+def bench_dispatcher(total=500, listeners=4, delay=0.002):
+    """慢监听器对读取线程的影响：直接调用与线程池"""
+    def slow(evt):
+        time.sleep(delay)
+
+    actions = [functools.partial(slow) for _ in range(listeners)]
+    for name, dispatcher in (('inline', van.Dispatcher()),
+                             ('PoolDispatcher(8)', van.PoolDispatcher(workers=8, maxsize=total))):
+        start = time.perf_counter()
+        for i in range(total):
+            for action in actions:
+                dispatcher.submit(action, i)
+        report('{} submit'.format(name), total, time.perf_counter() - start, 'event')
+        dispatcher.close()
+        report('{} drained'.format(name), total, time.perf_counter() - start, 'event')
+        stats = dispatcher.stats()
+        print('{:<40} max_depth={} latency_avg={:.4f}s'.format(name, stats['max_depth'], stats['latency_avg']))
+
+
+@benchmark
+def bench_stream_mux(accounts=100, events=50):
+    """一个事件循环同时维护多个账号的长连接"""
+    data = recorded_stream(events, heartbeat_every=10)
+    total = accounts * events
+    with StreamStubServer(data, hold=0.5) as server:
+        class Mux(van.StreamMux):
+            stream_url = server.stream_url
+
+        mux = Mux(reconnect=False)
+        received = []
+
+        @mux.on(van.Event.MESSAGE_CREATE)
+        async def handle(event):
+            received.append(event)
+            if len(received) == total:
+                mux.stop()
+
+        async def run():
+            fans = [van.AsyncFan(CONSUMER_KEY, CONSUMER_SECRET, OAUTH_TOKEN) for _ in range(accounts)]
+            for fan in fans:
+                mux.add(fan)
+            start = time.perf_counter()
+            await mux.run()
+            elapsed = time.perf_counter() - start
+            for fan in fans:
+                await fan.close()
+            return elapsed
+
+        elapsed = run_async(run())
+        report('StreamMux ({} accounts)'.format(accounts), len(received), elapsed, 'event')
+
+
+@benchmark
+def bench_listener_filter(listeners=1000, total=5000):
+    """每个监听器自己检查关键词与共享的过滤自动机"""
+    Event = van.Event
+    fan = van.Fan(CONSUMER_KEY, CONSUMER_SECRET, OAUTH_TOKEN)
+    words = ['词{}'.format(i) for i in range(listeners)]
+    data = []
+    for i in range(total):
+        d = fake_event(i)
+        d['object']['text'] = '{} {} 你好啊'.format(words[i % listeners], words[(i * 7) % listeners])
+        data.append(d)
+
+    table = van.ListenerTable()
+    hits = [0]
+
+    def make(word):
+        def handler(evt):
+            if word in evt.object.text:
+                hits[0] += 1
+        return handler
+
+    for word in words:
+        table.install(van.Listener(Event.MESSAGE_CREATE, make(word)))
+    start = time.perf_counter()
+    for d in data:
+        evt = Event(fan, Event.MESSAGE_CREATE, d)
+        for action in table.actions(evt.type, evt):
+            action(evt)
+    report('check in handler ({} listeners)'.format(listeners), total, time.perf_counter() - start, 'event')
+    expected, hits[0] = hits[0], 0
+
+    table = van.ListenerTable()
+    for word in words:
+        table.install(van.Listener(Event.MESSAGE_CREATE, lambda evt: hits.__setitem__(0, hits[0] + 1),
+                                   filter=van.Filter(keywords=[word])))
+    start = time.perf_counter()
+    for d in data:
+        evt = Event(fan, Event.MESSAGE_CREATE, d)
+        for action in table.actions(evt.type, evt):
+            action(evt)
+    report('Filter ({} listeners)'.format(listeners), total, time.perf_counter() - start, 'event')
+    assert hits[0] == expected
+
+
+@benchmark
+def bench_event(total=20000):
+    """只按类型过滤的监听器与读取全部载荷的监听器构造事件的开销"""
+    fan = van.Fan(CONSUMER_KEY, CONSUMER_SECRET, OAUTH_TOKEN)
+    data = [fake_event(i) for i in range(total)]
+
+    start = time.perf_counter()
+    for d in data:
+        evt = van.Event(fan, van.Event.MESSAGE_CREATE, d)
+        evt.source, evt.target, evt.object, evt.created_at
+    report('Event (all payloads)', total, time.perf_counter() - start, 'event')
+
+    start = time.perf_counter()
+    for d in data:
+        evt = van.Event(fan, van.Event.MESSAGE_CREATE, d)
+        evt.type
+    report('Event (type only)', total, time.perf_counter() - start, 'event')
+
+    start = time.perf_counter()
+    for d in data:
+        evt = van.Event(fan, van.Event.MESSAGE_CREATE, d)
+        evt.raw['object']['text']
+    report('Event (raw text)', total, time.perf_counter() - start, 'event')
+
+
+@benchmark
+def bench_replay(total=20000, listeners=10, path=None):
+    """回放录制的数据，测量 Stream 分发事件的吞吐量；path 为空时先录制模拟数据"""
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), 'stream.rec')
+        framer = van.StreamFramer()
+        with van.StreamRecorder(path) as recorder:
+            for i, frame in enumerate(framer.feed(recorded_stream(total))):
+                recorder.write(frame, timestamp=1497683640 + i * 0.01)
+
+    fan = van.Fan(CONSUMER_KEY, CONSUMER_SECRET, OAUTH_TOKEN)
+    stream = van.Stream(fan, source=van.ReplaySource(path, speed=None))
+    counter = collections.Counter()
+    for i in range(listeners):
+        stream.on(van.Event.MESSAGE_CREATE if i % 2 else van.Event.ALL)(lambda evt: counter.update((evt.type,)))
+
+    start = time.perf_counter()
+    stream.start()
+    stream.join()
+    elapsed = time.perf_counter() - start
+    frames = sum(1 for _ in van.StreamRecorder.read(path))
+    report('Stream replay ({} listeners)'.format(listeners), frames, elapsed, 'event')
+    report('Stream replay ({} listeners)'.format(listeners), sum(counter.values()), elapsed, 'call')
+
+
+@benchmark
+def bench_transport(accounts=200, rounds=5, concurrency=20):
+    """多个账号轮流请求时，各自的连接池与共享 Transport 的连接数和吞吐量"""
+    with StubServer(fake_user()) as server:
+        def run(name, transport):
+            fans = [van.Fan(CONSUMER_KEY, CONSUMER_SECRET, OAUTH_TOKEN, transport=transport) for _ in range(accounts)]
+            for fan in fans:
+                fan.api_url = server.api_url
+            if transport is not None:
+                transport.warm_up([server.api_url.format('')], connections=concurrency)
+            before = server.connections
+            start = time.perf_counter()
+            with ThreadPoolExecutor(concurrency) as pool:
+                list(pool.map(lambda fan: fan.get('users/show'), fans * rounds))
+            elapsed = time.perf_counter() - start
+            report(name, accounts * rounds, elapsed)
+            print('{:<40} {:>10} connections'.format(name, server.connections - before))
+
+        run('Fan (own session)', None)
+        transport = van.Transport(pool_maxsize=concurrency)
+        run('Fan (shared Transport)', transport)
+        transport.close()
+
+
+@benchmark
+def bench_signing(total=20000):
+    """比较 OAuth1Session 的签名与 Fan 的签名快速路径"""
+    fan = van.Fan(CONSUMER_KEY, CONSUMER_SECRET, OAUTH_TOKEN)
+    url = fan.api_url.format('statuses/home_timeline')
+    params = {'mode': 'lite', 'format': 'html', 'count': 60, 'max_id': 'status1'}
+
+    prepared = van.requests.Request('GET', url, params=params).prepare()
+    start = time.perf_counter()
+    for _ in range(total):
+        fan.session.auth(prepared.copy())
+    report('OAuth1Session', total, time.perf_counter() - start, 'sig')
+
+    start = time.perf_counter()
+    for _ in range(total):
+        fan._signer().sign('GET', url, params)
+    report('_FastSigner', total, time.perf_counter() - start, 'sig')
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print('== {} =='.format(name))
+        BENCHMARKS[name]()
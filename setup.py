@@ -6,6 +6,7 @@ setup(
         version=van.__version__,
         py_modules=['van'],
         install_requires=['requests-oauthlib==0.8.0'],
+        extras_require={'async': ['aiohttp>=3.0']},
         # package_data={'': ['README.rst','LICENSE']},
         keywords=['fanfou', 'sdk'],
         description='Fanfou SDK in Python',
@@ -1,8 +1,16 @@
+import asyncio
 import base64
+import functools
+import gc
 import io
+import json
 import os
+import pickle
 import random
 import string
+import tempfile
+import threading
+import time
 
 import arrow
 from nose.tools import *
@@ -32,17 +40,25 @@ def auth():
     return fan
 
 
-fan = auth()
+_fan = None
+
+
+def live_fan():
+    """登录过的 Fan，第一次用到时才登录，只跑离线测试时不需要帐号和网络"""
+    global _fan
+    if _fan is None:
+        _fan = auth()
+    return _fan
 
 
 class TestAuth:
     def test_xauth(self):
-        assert isinstance(fan._oauth_token, dict)
+        assert isinstance(live_fan()._oauth_token, dict)
 
 
 class TestAPI:
     def setup(self):
-        self.fan = fan  # type:Fan
+        self.fan = live_fan()  # type:Fan
         self.me = self.fan.me  # type:User
 
     def test_user_api(self):
@@ -106,7 +122,7 @@ class TestAPI:
 
 class TestTimeline:
     def setup(self):
-        self.fan = fan
+        self.fan = live_fan()
         self.me = self.fan.me  # type:User
         self.tl = self.me.timeline
 
@@ -160,10 +176,20 @@ class TestTimeline:
         assert_equal(tl.seek(-(1 << 32), 2), 0)
         assert_raises(ValueError, tl.seek, 1, 2)
 
+    def test_max_items(self):
+        tl = van.Timeline(self.fan, self.me.id, 'statuses/user_timeline', max_items=20)
+        first = tl.read(60)
+        assert_less_equal(len(tl._pool), 20)
+        assert_equal(tl.tell(), 60)
+
+        assert_equal(tl.seek(0), 0)
+        assert_equal([s.id for s in tl.read(10)], [s.id for s in first[:10]])
+        assert_less_equal(len(tl._pool), 20)
+
 
 class TestStream:
     def setup(self):
-        self.fan = fan
+        self.fan = live_fan()
         self.s = Stream(self.fan)
         self.s.start()
         self.i = 0
@@ -190,3 +216,1358 @@ class TestStream:
         def _(evt):
             assert_is_instance(evt, Event)
             assert_equal(evt.object, r'\r\n')
+
+
+class TestCache:
+    def setup(self):
+        self.cache = van.MemoryCache(ttls={'statuses/home_timeline': 0}, maxsize=2)
+
+    def test_ttl(self):
+        assert_equal(self.cache.ttl('users/show'), van.Cache.DEFAULT_TTLS['users/show'])
+        assert_equal(self.cache.ttl('statuses/home_timeline'), 0)
+
+        self.cache.set('statuses/home_timeline', {}, [])
+        assert_equal(len(self.cache), 0)
+
+    def test_uncached(self):
+        cache = van.MemoryCache(ttls={'friendships/accept': 60}, default_ttl=60)
+        assert_equal(cache.ttl('friendships/accept'), 0)
+        assert_equal(cache.ttl('favorites/create/s1'), 0)
+        assert_equal(cache.ttl('statuses/user_timeline'), 0)
+        assert_equal(cache.ttl('statuses/mentions'), 0)
+        assert_equal(cache.ttl('statuses/context_timeline'), van.Cache.DEFAULT_TTLS['statuses/context_timeline'])
+        assert_equal(cache.ttl('account/notification'), 60)
+
+        fan = FakeFan({'friendships/accept': lambda id, **params: {'id': id}}, cache=cache)
+        fan.accept_follower('a')
+        fan.accept_follower('a')
+        assert_equal(len(fan.calls), 2)
+
+    def test_lru(self):
+        for id in ('a', 'b', 'c'):
+            self.cache.set('users/show', {'id': id}, {'id': id})
+        assert_is(self.cache.get('users/show', {'id': 'a'}), van._MISSING)
+        assert_equal(self.cache.get('users/show', {'id': 'c'}), {'id': 'c'})
+        assert_equal(self.cache.stats(), {'hits': 1, 'misses': 1, 'size': 2})
+
+    def test_invalidate(self):
+        self.cache.set('users/show', {'id': 'a'}, {'id': 'a'})
+        self.cache.set('users/show', {'id': 'b'}, {'id': 'b'})
+        self.cache.invalidate('users/show', 'a')
+        assert_equal(len(self.cache), 1)
+        self.cache.invalidate('users/show')
+        assert_equal(len(self.cache), 0)
+
+
+class FakeFan(Fan):
+    """用本地函数响应请求的 Fan，`routes` 为接口到函数的映射，函数的参数为请求参数"""
+
+    def __init__(self, routes=None, **kwargs):
+        super().__init__(CONSUMER_KEY, CONSUMER_SECRET, {'oauth_token': 'token', 'oauth_token_secret': 'secret'},
+                         **kwargs)
+        self.routes = routes or {}
+        self.calls = []
+
+    def request(self, method, endpoint, params=None, data=None, files=None, **kwargs):
+        params = {k: v for k, v in (params or data or {}).items() if v is not None}
+        self.calls.append((endpoint, params))
+        return self.routes[endpoint](**params)
+
+
+def fake_statuses(total):
+    """从新到旧排列的消息，id 为 status{rawid}"""
+    return [{'id': 'status{}'.format(i), 'rawid': i, 'text': str(i), 'user': {'id': 'test'}}
+            for i in range(total, 0, -1)]
+
+
+def timeline_route(statuses):
+    """按 since_id 和 max_id（不包含边界）返回 statuses 中的一页"""
+    def route(count=20, since_id=None, max_id=None, **params):
+        rv = statuses
+        if max_id is not None:
+            rv = [s for s in rv if s['rawid'] < int(max_id[6:])]
+        if since_id is not None:
+            rv = [s for s in rv if s['rawid'] > int(since_id[6:])]
+        return rv[:int(count)]
+    return route
+
+
+class TestTimelineWindow:
+    def setup(self):
+        self.statuses = fake_statuses(300)
+        self.fan = FakeFan({'statuses/user_timeline': timeline_route(self.statuses)})
+        self.tl = van.Timeline(self.fan, 'test', 'statuses/user_timeline', max_items=50)
+
+    def rawids(self, statuses):
+        return [s.rawid for s in statuses]
+
+    def test_list_pool(self):
+        tl = van.Timeline(self.fan, 'test', 'statuses/user_timeline')
+        assert_equal(len(list(tl)), 300)
+        assert_is_instance(tl._pool, list)
+
+    def test_seek_far(self):
+        assert_equal(self.rawids(self.tl.read(250)), list(range(300, 50, -1)))
+        assert_less_equal(len(self.tl._pool), 50)
+        calls = len(self.fan.calls)
+        assert_equal(self.tl.seek(0), 0)
+        assert_equal(len(self.fan.calls), calls + 1)
+        assert_equal(self.rawids(self.tl.read(70)), list(range(300, 230, -1)))
+        assert_less_equal(len(self.tl._pool), 50)
+
+    def test_rewind_far(self):
+        self.tl.read(250)
+        calls = len(self.fan.calls)
+        self.statuses.insert(0, fake_statuses(301)[0])
+        self.tl.rewind()
+        assert_less_equal(len(self.fan.calls), calls + 2)
+        assert_equal(self.rawids(self.tl.read(3)), [301, 300, 299])
+
+    def test_deleted_boundary(self):
+        self.tl.read(120)
+        boundary = self.tl._evicted[-1][0]
+        self.statuses[:] = [s for s in self.statuses if s['id'] not in (boundary, 'status298')]
+        self.tl.seek(0)
+        rest = self.tl.read(300)
+        assert_equal(self.rawids(rest), [s['rawid'] for s in self.statuses])
+
+    def test_evicted_bounded(self):
+        self.tl.max_evicted = 100
+        assert_equal(len(list(self.tl)), 300)
+        assert_less_equal(len(self.tl._evicted), 100)
+        assert_less_equal(len(self.tl._pool), 50)
+
+
+class FakeAsyncFan(van.AsyncFan):
+    """:class:`FakeFan` 的异步版本"""
+
+    def __init__(self, routes=None, **kwargs):
+        super().__init__(CONSUMER_KEY, CONSUMER_SECRET, {'oauth_token': 'token', 'oauth_token_secret': 'secret'},
+                         **kwargs)
+        self.routes = routes or {}
+        self.calls = []
+
+    async def request(self, method, endpoint, params=None, data=None, files=None, **kwargs):
+        self.files = files
+        return FakeFan.request(self, method, endpoint, params, data, files, **kwargs)
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def fail(**params):
+    raise van.ApiRequestError('failed', status_code=500)
+
+
+class TestAsyncFan:
+    def setup(self):
+        self.statuses = fake_statuses(30)
+        self.fan = FakeAsyncFan({
+            'users/show': lambda **params: {'id': 'test', 'name': 'Test'},
+            'statuses/user_timeline': timeline_route(self.statuses),
+            'statuses/update': lambda status, **params: dict(self.statuses[0], text=status),
+            'photos/upload': lambda status, **params: dict(self.statuses[0], text=status),
+            'statuses/followers': lambda page, **params: [{'id': 'u{}'.format(page)}] * 2 if page < 3 else [],
+            'blocks/ids': page_route(4),
+            'followers/ids': lambda page, **params: ['u{}'.format(i // 2) for i in page_route(3)(page)],
+        })
+
+    def test_me(self):
+        me = run(self.fan.me)
+        assert_is_instance(me, van.AsyncUser)
+        assert_equal(me.name, 'Test')
+        assert_is(run(self.fan.me), me)
+        assert_equal(len(self.fan.calls), 1)
+
+    def test_timeline(self):
+        async def read():
+            tl = van.AsyncTimeline(self.fan, 'test', 'statuses/user_timeline')
+            first = await tl.read(5)
+            rest = []
+            async for s in tl:
+                rest.append(s)
+            return first, rest
+
+        first, rest = run(read())
+        assert_true(all(isinstance(s, van.AsyncStatus) for s in first))
+        assert_equal([s.rawid for s in first + rest], list(range(30, 0, -1)))
+
+    def test_pager(self):
+        async def read():
+            users = []
+            async for u in van.AsyncPager(self.fan, 'statuses/followers', van.AsyncUser.from_json):
+                users.append(u)
+            return users
+
+        users = run(read())
+        assert_equal([u.id for u in users], ['u1', 'u1', 'u2', 'u2'])
+        assert_equal([params['page'] for _, params in self.fan.calls], [1, 2, 3])
+
+    def test_fetch_ids(self):
+        ids = run(self.fan.fetch_blocked_users_id(workers=3))
+        assert_equal(ids, list(range(12)))
+        user = van.AsyncUser.from_json(self.fan, {'id': 'test'})
+        ids = run(user.fetch_followers_id(workers=2, compact=True))
+        assert_equal(ids, ('u0', 'u1', 'u2', 'u3', 'u4'))
+        assert_true(all(params['id'] == 'test' for endpoint, params in self.fan.calls if endpoint == 'followers/ids'))
+
+    def test_update_status(self):
+        status = run(self.fan.update_status('hello'))
+        assert_is_instance(status, van.AsyncStatus)
+        assert_equal(status.text, 'hello')
+
+        self.fan.routes['statuses/update'] = fail
+        assert_raises(van.ApiRequestError, run, self.fan.update_status('world'))
+        assert_equal(self.fan.draft_box[0]['status'], 'world')
+
+    def test_photo(self):
+        fd, path = tempfile.mkstemp(suffix='.jpg')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(base64.b64decode(RAW_PHOTO))
+        try:
+            run(self.fan.update_status('photo', photo=path))
+        finally:
+            os.remove(path)
+        assert_equal(self.fan.files['photo'], base64.b64decode(RAW_PHOTO))
+
+        calls = len(self.fan.calls)
+        assert_raises(ValueError, run, self.fan.update_status('photo', photo=path))
+        assert_equal(len(self.fan.calls), calls)
+        assert_equal(self.fan.draft_box, [])
+
+    def test_unsupported(self):
+        assert_raises(TypeError, FakeAsyncFan, scheduler=van.RequestScheduler())
+        assert_raises(TypeError, FakeAsyncFan, outbox=None)
+
+
+def page_route(pages, size=3):
+    """返回前 `pages` 页，每页 `size` 个元素"""
+    def route(page, **params):
+        page = int(page)
+        if page > pages:
+            return []
+        return [(page - 1) * size + i for i in range(size)]
+    return route
+
+
+class TestPager:
+    def setup(self):
+        self.fan = FakeFan({'followers/ids': page_route(4)})
+
+    def test_pager(self):
+        assert_equal(list(van.pager(self.fan, 'followers/ids', prefetch=0)), list(range(12)))
+        assert_equal([params['page'] for _, params in self.fan.calls], [1, 2, 3, 4, 5])
+
+    def test_prefetch(self):
+        assert_equal(list(van.pager(self.fan, 'followers/ids', prefetch=2)), list(range(12)))
+        assert_equal(sorted(params['page'] for _, params in self.fan.calls), [1, 2, 3, 4, 5])
+
+    def test_prefetch_close(self):
+        it = van.pager(self.fan, 'followers/ids', prefetch=1, count=3)
+        assert_equal(next(it), 0)
+        it.close()
+        time.sleep(0.1)
+        # 预读最多领先一页，关闭后不再继续请求
+        assert_less_equal(len(self.fan.calls), 3)
+        assert_true(all(params['count'] == 3 for _, params in self.fan.calls))
+
+    def test_prefetcher_error(self):
+        pages = iter([[1], [2]])
+
+        def fetch():
+            try:
+                return next(pages)
+            except StopIteration:
+                raise van.NetworkError
+
+        prefetcher = van.Prefetcher(fetch, depth=2)
+        assert_equal(prefetcher.get(), [1])
+        assert_equal(prefetcher.get(), [2])
+        assert_raises(van.NetworkError, prefetcher.get)
+        prefetcher.close()
+
+
+class TestParallelPager:
+    def test_order(self):
+        route = page_route(5)
+
+        def slow(page, **params):
+            # 靠前的页返回得更慢，结果仍按页码顺序产生
+            time.sleep(0.05 / int(page))
+            return route(page, **params)
+
+        fan = FakeFan({'followers/ids': slow})
+        assert_equal(list(van.parallel_pager(fan, 'followers/ids', workers=4)), list(range(15)))
+
+    def test_stop_at_empty(self):
+        fan = FakeFan({'followers/ids': page_route(2)})
+        assert_equal(list(van.parallel_pager(fan, 'followers/ids', workers=3)), list(range(6)))
+        assert_less_equal(len(fan.calls), 2 + 3)
+
+    def test_fetch_ids(self):
+        route = page_route(3)
+        # 翻页过程中列表变化，相邻页之间出现重复的 id
+        fan = FakeFan({'friends/ids': lambda page, **params: ['u{}'.format(i // 2) for i in route(page)]})
+        ids = van.fetch_ids(fan, 'friends/ids', workers=2, compact=True, id='test')
+        assert_equal(ids, ('u0', 'u1', 'u2', 'u3', 'u4'))
+        assert_true(all(params['id'] == 'test' for _, params in fan.calls))
+        assert_equal(len(list(van.fetch_ids(fan, 'friends/ids', workers=2))), 9)
+
+
+class TestIdentityMap:
+    def setup(self):
+        self.fan = FakeFan({'statuses/show': lambda id, **params: {'id': id, 'text': 'new', 'user': {'id': 'a'}}},
+                           identity_map=True)
+
+    def test_shared(self):
+        a = Status.from_json(self.fan, {'id': 's1', 'text': 'old', 'user': {'id': 'a', 'name': 'A'}})
+        b = Status.from_json(self.fan, {'id': 's2', 'text': 'other', 'user': {'id': 'a'}})
+        assert_is(a.user, b.user)
+        assert_equal(b.user.name, 'A')
+
+        c = Status.from_id(self.fan, 's1')
+        assert_is(c, a)
+        assert_equal(a.text, 'new')
+
+    def test_types(self):
+        user = User.from_json(self.fan, {'id': 'x'})
+        status = Status.from_json(self.fan, {'id': 'x'})
+        assert_is_not(user, status)
+        assert_is_instance(user, User)
+
+    def test_weak(self):
+        Status.from_json(self.fan, {'id': 's1'})
+        gc.collect()
+        assert_equal(len(self.fan.identities), 0)
+
+    def test_disabled(self):
+        fan = FakeFan()
+        assert_is_none(fan.identities)
+        assert_is_not(Status.from_json(fan, {'id': 's1'}), Status.from_json(fan, {'id': 's1'}))
+
+
+class Interrupted(BaseException):
+    pass
+
+
+class TestHydrate:
+    def setup(self):
+        self.release = threading.Event()
+        self.error = None
+        self.fan = FakeFan({'users/show': self.show})
+
+    def show(self, id, **params):
+        self.release.wait(1)
+        if self.error is not None:
+            raise self.error
+        return {'id': id, 'name': id.upper(), 'description': id}
+
+    def load_concurrently(self, n=4):
+        results = [None] * n
+
+        def load(i):
+            try:
+                results[i] = self.fan._load_once('users/show', 'a')
+            except BaseException as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=load, args=(i,)) for i in range(n)]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+        self.release.set()
+        for t in threads:
+            t.join(1)
+        return results
+
+    def test_hydrate(self):
+        self.release.set()
+        users = [User.from_json(self.fan, {'id': id}) for id in ('a', 'b', 'a')]
+        users.append(User.from_json(self.fan, {'id': 'c', 'description': ''}))
+        assert_equal(self.fan.hydrate(users, attrs=('description',)), users)
+        assert_equal(sorted(params['id'] for _, params in self.fan.calls), ['a', 'b'])
+        assert_equal([u.name for u in users[:3]], ['A', 'B', 'A'])
+        assert_equal(users[3].description, '')
+
+    def test_load_once(self):
+        results = self.load_concurrently()
+        assert_equal(len(self.fan.calls), 1)
+        assert_true(all(r is results[0] for r in results))
+        assert_equal(self.fan._inflight, {})
+
+    def test_load_once_interrupted(self):
+        self.error = Interrupted()
+        results = self.load_concurrently()
+        assert_equal(len(self.fan.calls), 1)
+        assert_true(all(isinstance(r, Interrupted) for r in results))
+        assert_equal(self.fan._inflight, {})
+
+
+class TestSlots:
+    def setup(self):
+        self.fan = FakeFan({'users/show': lambda id, **params: {'id': id, 'name': id.upper()}})
+        self.status = Status.from_json(self.fan, {'id': 's1', 'text': 'hi', 'user': {'id': 'a'}, 'extra': 1,
+                                                  'created_at': 'Sat Jun 17 07:14:00 +0000 2017'})
+
+    def test_attributes(self):
+        assert_false(hasattr(self.status, '__dict__'))
+        assert_equal(self.status.text, 'hi')
+        assert_equal(self.status._extra, {'extra': 1})
+        assert_equal(self.status.dict['extra'], 1)
+        assert_raises(AttributeError, getattr, self.status, 'extra')
+        assert_raises(AttributeError, setattr, self.status, 'extra', 2)
+
+    def test_lazy(self):
+        user = self.status.user
+        assert_is_instance(user, User)
+        assert_equal(user.name, 'A')
+        assert_equal(len(self.fan.calls), 1)
+        # 加载过的对象缺失的字段直接返回 None
+        assert_is_none(user.location)
+        assert_equal(len(self.fan.calls), 1)
+
+    def test_pickle(self):
+        user = User.from_json(self.fan, {'id': 'a'})
+        copy = pickle.loads(pickle.dumps(user))
+        assert_equal(self.fan.calls, [])
+        assert_is_none(copy.fan)
+        assert_is_none(copy.name)
+
+        copy.fan = self.fan
+        assert_equal(copy.name, 'A')
+
+    def test_pickle_nested(self):
+        assert_equal(self.status.user.id, 'a')
+        copy = pickle.loads(pickle.dumps(self.status))
+        assert_equal(copy.dict, self.status.dict)
+        assert_equal(copy.user.id, 'a')
+        assert_equal(copy.created_at, self.status.created_at)
+
+
+class TestTimelineStore:
+    def setup(self):
+        self.fan = FakeFan()
+        self.store = van.TimelineStore(':memory:')
+        self.key = van.TimelineStore.key('statuses/home_timeline', 'test')
+        self.statuses = [van.Status.from_json(self.fan, {'id': 's{}'.format(i), 'rawid': i, 'text': str(i)})
+                         for i in range(10, 0, -1)]
+
+    def test_save(self):
+        self.store.save(self.key, self.statuses[:5])
+        self.store.save(self.key, self.statuses[5:])
+        assert_equal(self.store.cursor(self.key), ('s10', 10, 's1', 1))
+        assert_equal([s['rawid'] for s in self.store.older(self.key, 6, 3)], [5, 4, 3])
+        assert_equal([s['rawid'] for s in self.store.newer(self.key, 6, 3)], [9, 8, 7])
+
+    def test_clear(self):
+        self.store.save(self.key, self.statuses)
+        self.store.discard('s5')
+        assert_equal(len(self.store), 9)
+        self.store.clear(self.key)
+        assert_equal(len(self.store), 0)
+        assert_is_none(self.store.cursor(self.key))
+
+
+class TestTimelineWithStore:
+    def setup(self):
+        self.statuses = fake_statuses(100)
+        self.fan = FakeFan({'statuses/user_timeline': timeline_route(self.statuses)},
+                           store=van.TimelineStore(':memory:'))
+        assert_equal(len(list(van.Timeline(self.fan, 'test', 'statuses/user_timeline'))), 100)
+        self.fan.calls = []
+
+    def timeline(self):
+        return van.Timeline(self.fan, 'test', 'statuses/user_timeline')
+
+    def test_from_store(self):
+        tl = self.timeline()
+        assert_equal([s.rawid for s in tl.read(100)], list(range(100, 0, -1)))
+        assert_equal(self.fan.calls, [])
+
+    def test_rewind(self):
+        self.statuses[:0] = fake_statuses(103)[:3]
+        tl = self.timeline()
+        assert_equal(tl.rewind(), 0)
+        assert_equal([params.get('since_id') for _, params in self.fan.calls], ['status100'])
+        assert_equal([s.rawid for s in tl.read(103)], list(range(103, 0, -1)))
+        assert_equal(len(self.fan.calls), 1)
+
+
+class FakeTimeline:
+    _max_id = 'status0'
+
+    def __init__(self):
+        self.pending = []
+
+    def refresh(self):
+        rv, self.pending = self.pending, []
+        return rv
+
+
+class TestPoller:
+    def setup(self):
+        self.fan = FakeFan()
+        self.poller = van.Poller(min_interval=1, max_interval=60)
+        self.tl = FakeTimeline()
+        self.got = []
+        self.poller.add(self.tl, self.got.extend)
+
+    def poll(self, statuses=()):
+        self.tl.pending = [van.Status.from_json(self.fan, {'id': 's{}'.format(i), 'rawid': i,
+                                                           'created_at': 'Sat Jun 17 07:14:00 +0000 2017'})
+                           for i in statuses]
+        self.poller._poll(self.poller._jobs[self.tl])
+
+    def test_quiet(self):
+        for _ in range(10):
+            self.poll()
+        assert_equal(self.poller.interval(self.tl), 60)
+        assert_equal(self.poller.stats()['empty_polls'], 10)
+
+    def test_busy(self):
+        self.poll(range(60, 0, -1))
+        assert_equal(self.poller.interval(self.tl), 1)
+        assert_equal([s.rawid for s in self.got], list(range(1, 61)))
+        stats = self.poller.stats()
+        assert_equal(stats['delivered'], 60)
+        assert_greater(stats['latency_avg'], 0)
+
+
+class TestStreamFramer:
+    def setup(self):
+        self.framer = van.StreamFramer()
+
+    def test_split(self):
+        assert_equal(self.framer.feed(b'{"a": 1}\r'), [])
+        assert_equal(self.framer.feed(b'\n\r\n{"b"'), [b'{"a": 1}', b''])
+        assert_equal(len(self.framer), 4)
+        assert_equal(self.framer.feed(b': 2}\r\n'), [b'{"b": 2}'])
+        assert_equal(len(self.framer), 0)
+
+    def test_utf8(self):
+        data = '{"text": "你好"}\r\n'.encode('utf8')
+        frames = []
+        for i in range(len(data)):
+            frames.extend(self.framer.feed(data[i:i + 1]))
+        assert_equal([f.decode('utf8') for f in frames], ['{"text": "你好"}'])
+
+
+class TestListenerTable:
+    def setup(self):
+        self.fan = FakeFan()
+        self.table = van.ListenerTable()
+
+    def test_match(self):
+        message = self.table.install(van.Listener(Event.MESSAGE, 'message'))
+        self.table.install(van.Listener(Event.FAV_CREATE, 'fav'))
+        self.table.install(van.Listener(Event.ALL, 'all'))
+        assert_equal(self.table.actions(Event.MESSAGE_CREATE), ['message', 'all'])
+        assert_equal(self.table.actions(Event.FAV_CREATE), ['fav', 'all'])
+        assert_equal(self.table.actions(Event.FAV_DELETE), ['all'])
+
+        assert_equal(self.table.uninstall(message, 'fav'), 2)
+        assert_equal(self.table.actions(Event.MESSAGE_CREATE), ['all'])
+        assert_equal(len(self.table), 1)
+
+    def test_filter(self):
+        self.table.install(van.Listener(Event.MESSAGE, 'python', filter=van.Filter(keywords=['Python'])))
+        self.table.install(van.Listener(Event.MESSAGE, 'topic', filter=van.Filter(topics=['饭否'])))
+        self.table.install(van.Listener(Event.ALL, 'user', filter=van.Filter(users=['alice'], mentions=['bob'])))
+
+        def actions(text, user='carol'):
+            evt = Event(self.fan, Event.MESSAGE_CREATE, {'source': {'id': user},
+                                                         'object': {'text': text, 'user': {'id': user}}})
+            return self.table.actions(evt.type, evt)
+
+        assert_equal(actions('I love PYTHON'), ['python'])
+        assert_equal(actions('#<a href="/q/饭否">饭否</a># python'), ['python', 'topic'])
+        assert_equal(actions('@<a href="http://fanfou.com/bob" class="former">bob</a> hi'), [])
+        assert_equal(actions('@<a href="http://fanfou.com/bob" class="former">bob</a> hi', 'alice'), ['user'])
+
+        evt = Event(self.fan, Event.FRIENDS_CREATE, {'source': {'id': 'alice'}})
+        assert_equal(self.table.actions(evt.type, evt), [])
+
+    def test_mention_boundary(self):
+        self.table.install(van.Listener(Event.MESSAGE, 'bob', filter=van.Filter(mentions=['bob'])))
+        self.table.install(van.Listener(Event.MESSAGE, 'r&d', filter=van.Filter(keywords=['R&D'])))
+
+        def actions(text):
+            evt = Event(self.fan, Event.MESSAGE_CREATE, {'object': {'text': text, 'user': {'id': 'carol'}}})
+            return self.table.actions(evt.type, evt)
+
+        assert_equal(actions('@<a href="http://fanfou.com/bobby" class="former">bobby</a> hi'), [])
+        assert_equal(actions('@<a href="http://fanfou.com/bob" class="former">bob</a>你好'), ['bob'])
+        assert_equal(actions('@bobby @bob_1 hi'), [])
+        assert_equal(actions('@bobby @bob, hi'), ['bob'])
+        assert_equal(actions('@bob'), ['bob'])
+        assert_equal(actions('R&amp;D'), ['r&d'])
+
+    def test_ttl(self):
+        self.table.install(van.Listener(Event.ALL, 'once', ttl=1))
+        assert_equal(self.table.actions(Event.HEART_BEAT), ['once'])
+        assert_equal(self.table.actions(Event.HEART_BEAT), [])
+        assert_equal(len(self.table), 0)
+
+
+class TestPoolDispatcher:
+    def test_order(self):
+        dispatcher = van.PoolDispatcher(workers=4)
+        got = {'a': [], 'b': []}
+        actions = {name: got[name].append for name in got}
+        for i in range(100):
+            for name in ('a', 'b'):
+                dispatcher.submit(actions[name], i)
+        dispatcher.close()
+        assert_equal(got, {'a': list(range(100)), 'b': list(range(100))})
+        assert_equal(dispatcher.stats()['processed'], 200)
+
+    def test_overflow(self):
+        blocker = threading.Event()
+        got = []
+
+        def slow(evt):
+            blocker.wait()
+            got.append(evt)
+
+        for overflow, expected in (('drop_newest', [0, 1, 2]), ('drop_oldest', [0, 4, 5])):
+            blocker.clear()
+            del got[:]
+            dispatcher = van.PoolDispatcher(workers=1, maxsize=2, overflow=overflow)
+            dispatcher.submit(slow, 0)
+            time.sleep(0.1)  # 等待工作线程取走第一个事件
+            for i in range(1, 6):
+                dispatcher.submit(slow, i)
+            assert_equal(dispatcher.stats()['dropped'], 3)
+            blocker.set()
+            dispatcher.close()
+            assert_equal(got, expected)
+
+
+class TestStreamRecorder:
+    def setup(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'stream.rec')
+
+    def test_replay(self):
+        frames = [b'', b'{"event": "message.create"}', '{"text": "你好\\n"}'.encode('utf8')]
+        with van.StreamRecorder(self.path) as recorder:
+            for i, frame in enumerate(frames):
+                recorder.write(frame, timestamp=1000 + i)
+        assert_equal(list(van.StreamRecorder.read(self.path)),
+                     [(1000.0 + i, frame) for i, frame in enumerate(frames)])
+
+        source = van.ReplaySource(self.path, speed=None).open()
+        framer = van.StreamFramer()
+        replayed = []
+        for chunk in source.iter_content():
+            replayed.extend(framer.feed(chunk))
+        assert_equal(replayed, frames)
+
+
+def status_frame(id, rawid):
+    status = {'id': id, 'rawid': rawid, 'text': id, 'user': {'id': 'test'}}
+    return json.dumps({'event': 'message.create', 'source': status['user'], 'object': status}).encode('utf8')
+
+
+class FakeConnection:
+    """流式连接，发出所有帧后断开"""
+
+    def __init__(self, *frames):
+        self.frames = frames
+        self.closed = False
+
+    def iter_content(self, chunk_size=None):
+        for frame in self.frames:
+            yield frame + b'\r\n'
+        raise van.requests.ConnectionError('disconnected')
+
+    def close(self):
+        self.closed = True
+
+
+class FakeStreamFan:
+    """用固定的页面响应补齐请求的 Fan"""
+
+    def __init__(self, *pages):
+        self.pages = list(pages)
+        self.calls = []
+
+    def get(self, endpoint, **params):
+        self.calls.append(params)
+        page = self.pages.pop(0) if self.pages else []
+        if isinstance(page, Exception):
+            raise page
+        return page
+
+
+class FakeStream(Stream):
+    """依次使用给定的连接，用完后停止"""
+
+    def __init__(self, fan, connections, **kwargs):
+        self.connections = list(connections)
+        super().__init__(fan, backoff=0, **kwargs)
+
+    def _init(self):
+        if not self.connections:
+            self.stop()
+            raise OSError('no more connections')
+        self._conn = self.connections.pop(0)
+
+
+class TestStreamReconnect:
+    def received(self, stream):
+        ids = []
+        stream.on(Event.MESSAGE_CREATE)(lambda evt: ids.append(evt.raw['object']['id']))
+        stream.on(Event.ERROR)(lambda evt: ids.append('error'))
+        stream.run()
+        return ids
+
+    def test_backfill(self):
+        missed = [{'id': 's3', 'rawid': 3}, {'id': 's2', 'rawid': 2}, {'id': 's1', 'rawid': 1}]
+        fan = FakeStreamFan(missed)
+        stream = FakeStream(fan, [FakeConnection(status_frame('s1', 1)),
+                                  FakeConnection(status_frame('s3', 3), status_frame('s4', 4))])
+        assert_equal(self.received(stream), ['s1', 's2', 's3', 's4'])
+        assert_equal(fan.calls[0]['since_id'], 's1')
+        assert_equal(stream.reconnects, 1)
+        assert_equal(stream.last_status_id, 's4')
+
+    def test_backfill_pages(self):
+        pages = [[{'id': 's{}'.format(i), 'rawid': i} for i in range(n, n - 60, -1)] for n in (181, 121, 61)]
+        fan = FakeStreamFan(*pages)
+        stream = FakeStream(fan, [FakeConnection(status_frame('s1', 1)), FakeConnection()])
+        stream.backfill_pages = 2
+        warnings = []
+        van.logger.warning = lambda msg, *args: warnings.append(msg % args)
+        try:
+            received = self.received(stream)
+        finally:
+            del van.logger.warning
+        assert_equal(len(fan.calls), 2)
+        assert_equal(received, ['s1'] + ['s{}'.format(i) for i in range(62, 182)])
+        assert_equal(len(warnings), 1)
+        assert_in('statuses/home_timeline', warnings[0])
+
+    def test_backfill_failure(self):
+        fan = FakeStreamFan(van.NetworkError())
+        stream = FakeStream(fan, [FakeConnection(status_frame('s1', 1)), FakeConnection(status_frame('s2', 2))])
+        assert_equal(self.received(stream), ['s1', 's2'])
+        assert_equal(len(fan.calls), 1)
+
+    def test_since_id(self):
+        fan = FakeStreamFan([{'id': 's2', 'rawid': 2}])
+        stream = FakeStream(fan, [FakeConnection(status_frame('s3', 3))], since_id='s1')
+        assert_equal(self.received(stream), ['s2', 's3'])
+        assert_equal(fan.calls[0]['since_id'], 's1')
+
+    def test_frame_without_event(self):
+        stream = FakeStream(FakeStreamFan(), [FakeConnection(b'{"text": "test"}', b'[]', status_frame('s1', 1))])
+        assert_equal(self.received(stream), ['error', 'error', 's1'])
+
+
+class FakeContent:
+    def __init__(self, frames):
+        self.frames = iter(frames)
+
+    def iter_any(self):
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.frames) + b'\r\n'
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeResponse:
+    def __init__(self, frames):
+        self.content = FakeContent(frames)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, fan):
+        self.fan = fan
+
+    def post(self, url, **kwargs):
+        if not self.fan.connections:
+            raise van.aiohttp.ClientConnectionError('no more connections')
+        return FakeResponse(self.fan.connections.pop(0))
+
+
+class FakeMuxFan(FakeAsyncFan):
+    """每个连接依次发出 `connections` 中的一组帧"""
+
+    def __init__(self, *connections):
+        super().__init__()
+        self.connections = list(connections)
+
+    @property
+    def http(self):
+        return FakeSession(self)
+
+
+class FailingDispatcher(van.Dispatcher):
+    def submit(self, action, event):
+        if event.raw['object']['id'] == 's1':
+            raise ValueError('failed')
+        action(event)
+
+
+class TestStreamMux:
+    def setup(self):
+        self.mux = van.StreamMux(reconnect=False, dispatcher=FailingDispatcher())
+        self.received = []
+
+    def connect(self, fan):
+        self.mux._running = True
+        run(self.mux._connect(fan))
+
+    def test_handler_error(self):
+        self.mux.on(Event.MESSAGE_CREATE)(lambda evt: self.received.append(evt.raw['object']['id']))
+        self.connect(FakeMuxFan([status_frame('s1', 1), status_frame('s2', 2)]))
+        assert_equal(self.received, ['s2'])
+
+    def test_async_handler(self):
+        async def handle(evt):
+            if evt.raw['object']['id'] == 's2':
+                raise ValueError('failed')
+            self.received.append((evt.fan, evt.raw['object']['id']))
+
+        self.mux.dispatcher = van.Dispatcher()
+        self.mux.on(Event.MESSAGE_CREATE)(handle)
+        fan = FakeMuxFan([status_frame('s1', 1), b'[]', status_frame('s2', 2), status_frame('s3', 3)])
+
+        async def connect():
+            self.mux._running = True
+            await self.mux._connect(fan)
+            await asyncio.wait(list(self.mux._pending))
+
+        run(connect())
+        assert_equal(self.received, [(fan, 's1'), (fan, 's3')])
+
+    def test_partial_handler(self):
+        async def handle(tag, evt):
+            self.received.append((tag, evt.raw['object']['id']))
+
+        self.mux.on(Event.MESSAGE_CREATE)(functools.partial(handle, 'partial'))
+        self.mux.on(Event.MESSAGE_CREATE)(lambda evt: handle('lambda', evt))
+        fan = FakeMuxFan([status_frame('s2', 2)])
+
+        async def connect():
+            self.mux._running = True
+            await self.mux._connect(fan)
+            await asyncio.sleep(0)
+            await asyncio.wait(list(self.mux._pending))
+
+        run(connect())
+        assert_equal(sorted(self.received), [('lambda', 's2'), ('partial', 's2')])
+
+    def test_default_dispatcher(self):
+        mux = van.StreamMux(reconnect=False)
+        assert_is_instance(mux.dispatcher, van.PoolDispatcher)
+        threads = []
+        mux.on(Event.MESSAGE_CREATE)(lambda evt: threads.append(threading.current_thread()))
+        mux._running = True
+        run(mux._connect(FakeMuxFan([status_frame('s1', 1)])))
+        mux.dispatcher.close()
+        assert_equal(len(threads), 1)
+        assert_is_not(threads[0], threading.current_thread())
+
+    def test_reconnect(self):
+        self.mux.reconnect = True
+        self.mux.backoff = 0
+
+        def handle(evt):
+            self.received.append(evt.raw['object']['id'])
+            if len(self.received) == 2:
+                self.mux.stop()
+
+        self.mux.on(Event.MESSAGE_CREATE)(handle)
+        self.connect(FakeMuxFan([status_frame('s2', 2)], [status_frame('s3', 3)]))
+        assert_equal(self.received, ['s2', 's3'])
+        assert_equal(self.mux.reconnects, 1)
+
+
+class TestEvent:
+    def setup(self):
+        self.fan = FakeFan()
+        self.user = {'id': 'test', 'name': 'test'}
+        self.status = {'id': 'status1', 'rawid': 1, 'text': 'test', 'user': self.user}
+
+    def test_message(self):
+        evt = Event(self.fan, Event.MESSAGE_CREATE, {'event': 'message.create', 'source': self.user,
+                                                     'object': self.status})
+        assert_equal(evt.raw['object']['id'], 'status1')
+        assert_is_instance(evt.object, Status)
+        assert_equal(evt.object.text, 'test')
+        assert_is_instance(evt.source, User)
+        assert_is_none(evt.target)
+        assert_equal(evt.event, 'message.create')
+
+    def test_friends(self):
+        evt = Event(self.fan, Event.FRIENDS_CREATE, {'event': 'friends.create', 'source': self.user,
+                                                     'target': self.user, 'object': self.user})
+        assert_is_instance(evt.object, User)
+        assert_is_instance(evt.target, User)
+
+    def test_heart_beat(self):
+        evt = Event(self.fan, Event.HEART_BEAT, r'\r\n')
+        assert_equal(evt.object, r'\r\n')
+        assert_is_none(evt.created_at)
+
+
+class TestTransport:
+    def test_pool(self):
+        transport = van.Transport(pool_connections=2, pool_maxsize=8)
+        for prefix in ('http://', 'https://'):
+            adapter = transport.session.get_adapter(prefix + 'api.fanfou.com')
+            assert_equal(adapter._pool_connections, 2)
+            assert_equal(adapter._pool_maxsize, 8)
+        transport.close()
+
+    def test_shared(self):
+        transport = van.Transport.shared()
+        assert_is(van.Transport.shared(), transport)
+        other = Fan(CONSUMER_KEY, CONSUMER_SECRET, transport=transport)
+        assert_is(other.transport, transport)
+        assert_is_not(other.session, transport.session)
+
+
+class TestFastSigner:
+    def setup(self):
+        self.fan = Fan(CONSUMER_KEY, CONSUMER_SECRET, {'oauth_token': 'token', 'oauth_token_secret': 'secret'})
+        self.client = self.fan.session._client.client
+
+    def expected(self, method, url, params=None, data=None):
+        prepared = van.requests.Request(method, url, params=params, data=data).prepare()
+        self.client.nonce, self.client.timestamp = '12345', '1497683640'
+        try:
+            return van._to_str(self.fan.session.auth(prepared).headers['Authorization'])
+        finally:
+            self.client.nonce = self.client.timestamp = None
+
+    def test_same_as_oauthlib(self):
+        signer = self.fan._signer()
+        cases = [('GET', 'http://api.fanfou.com/users/show.json', {'id': '测试', 'count': 60, 'max_id': None}, None),
+                 ('POST', 'http://api.fanfou.com/statuses/update.json', None, {'status': "a b~!*()'&=+", 'a-b': 1}),
+                 ('GET', 'HTTP://API.fanfou.com:80/statuses/show.json', {'ids': ['1', '2']}, None)]
+        for method, url, params, data in cases:
+            assert_equal(signer.sign(method, url, params, data, nonce='12345', timestamp='1497683640'),
+                         self.expected(method, url, params, data))
+
+    def test_token_change(self):
+        signer = self.fan._signer()
+        assert_is(self.fan._signer(), signer)
+        self.fan.session._populate_attributes({'oauth_token': 'other', 'oauth_token_secret': 'secret'})
+        assert_is_not(self.fan._signer(), signer)
+
+
+class FakeAccountFan:
+    """只响应 account/rate_limit_status 的 Fan"""
+
+    def __init__(self, remaining, reset_in=3600):
+        self.session = Fan(CONSUMER_KEY, CONSUMER_SECRET).session
+        self.remaining = remaining
+        self.reset_in = reset_in
+        self.syncs = 0
+
+    def request(self, method, endpoint, **kwargs):
+        self.syncs += 1
+        return {'hourly_limit': 150, 'remaining_hits': self.remaining,
+                'reset_time_in_seconds': int(time.time() + self.reset_in)}
+
+
+class TestRequestScheduler:
+    def test_non_blocking(self):
+        scheduler = van.RequestScheduler()
+        fan = FakeAccountFan(remaining=2)
+        assert_false(scheduler.acquire(fan, blocking=False))
+        assert_true(scheduler.acquire(fan))
+        assert_true(scheduler.acquire(fan, blocking=False))
+        assert_false(scheduler.acquire(fan, blocking=False))
+        assert_equal(scheduler.status(fan)['remaining'], 0)
+        assert_equal(fan.syncs, 1)
+
+    def test_budget(self):
+        scheduler = van.RequestScheduler()
+        fan = FakeAccountFan(remaining=2)
+        scheduler.acquire(fan)
+        scheduler.acquire(fan, van.RequestScheduler.INTERACTIVE)
+        status = scheduler.status(fan)
+        assert_equal(status['limit'], 150)
+        assert_equal(status['remaining'], 0)
+        assert_equal(fan.syncs, 1)
+
+    def test_wait_for_reset(self):
+        scheduler = van.RequestScheduler()
+        fan = FakeAccountFan(remaining=0, reset_in=1)
+        start = time.time()
+        threading.Timer(0.5, lambda: setattr(fan, 'remaining', 150)).start()
+        scheduler.acquire(fan)
+        assert_greater(time.time() - start, 0.5)
+        assert_equal(scheduler.status(fan)['remaining'], 149)
+
+    def test_limited(self):
+        scheduler = van.RequestScheduler(backoff=0.5)
+        fan = FakeAccountFan(remaining=10, reset_in=3600)
+        scheduler.acquire(fan)
+        assert_false(scheduler.limited(fan, van.ApiRequestError('参数错误', status_code=400)))
+        assert_true(scheduler.limited(fan, van.ApiRequestError('Rate limit exceeded', status_code=400)))
+        assert_equal(scheduler.status(fan)['remaining'], 0)
+        assert_greater(scheduler.status(fan)['reset_at'], time.time() + 3000)
+
+        scheduler = van.RequestScheduler(backoff=0.5)
+        fan = FakeAccountFan(remaining=10, reset_in=0)
+        scheduler.acquire(fan)
+        scheduler.limited(fan, van.ApiRequestError('Rate limit exceeded', status_code=400))
+        start = time.time()
+        scheduler.acquire(fan)
+        # 服务器仍然报告有剩余额度，也要等到重置时间再校准
+        assert_greater(time.time() - start, 0.5)
+        assert_equal(fan.syncs, 2)
+
+    def test_max_requeues(self):
+        class LimitedFan(Fan):
+            calls = 0
+
+            def _call(self, method, endpoint, *args, **kwargs):
+                if endpoint == van.RequestScheduler.RATE_LIMIT_ENDPOINT:
+                    return {'hourly_limit': 150, 'remaining_hits': 150, 'reset_time_in_seconds': time.time()}
+                self.calls += 1
+                raise van.ApiRequestError('Rate limit exceeded', status_code=403)
+
+        fan = LimitedFan(CONSUMER_KEY, CONSUMER_SECRET, {'oauth_token': 'token', 'oauth_token_secret': 'secret'},
+                         scheduler=van.RequestScheduler(max_requeues=1, backoff=0.1))
+        assert_raises(van.ApiRequestError, fan.get, 'users/show')
+        assert_equal(fan.calls, 2)
+
+
+class TestRetryPolicy:
+    def setup(self):
+        self.policy = van.RetryPolicy(retries=2, backoff=0.001, min_samples=5, hedge=True)
+        self.calls = 0
+
+    def flaky(self, errors):
+        def send(timeout):
+            self.calls += 1
+            if self.calls <= len(errors):
+                raise errors[self.calls - 1]
+            return {'id': 'test'}
+        return send
+
+    def test_retry_get(self):
+        send = self.flaky([van.Timeout(), van.ApiRequestError('busy', status_code=503)])
+        assert_equal(self.policy.call('GET', 'users/show', send), {'id': 'test'})
+        assert_equal(self.calls, 3)
+        assert_equal(self.policy.stats()['users/show']['retries'], 2)
+
+    def test_no_retry(self):
+        send = self.flaky([van.NetworkError()])
+        assert_raises(van.NetworkError, self.policy.call, 'POST', 'statuses/update', send)
+        self.calls = 0
+        send = self.flaky([van.ApiRequestError('not found', status_code=404)])
+        assert_raises(van.ApiRequestError, self.policy.call, 'GET', 'users/show', send)
+        assert_equal(self.calls, 1)
+        self.calls = 0
+        send = self.flaky([van.NetworkError()] * 3)
+        assert_raises(van.NetworkError, self.policy.call, 'GET', 'users/show', send)
+        assert_equal(self.policy.stats()['users/show']['failures'], 2)
+
+    def test_adaptive_timeout(self):
+        assert_equal(self.policy.timeout('users/show'), (5, 5))
+        for _ in range(5):
+            self.policy.call('GET', 'users/show', lambda timeout: time.sleep(0.01))
+        assert_equal(self.policy.timeout('users/show'), (5, 1.0))
+
+    def test_hedge(self):
+        for _ in range(5):
+            self.policy.call('GET', 'users/show', lambda timeout: time.sleep(0.01))
+        delays = iter([1, 0])
+
+        def send(timeout):
+            time.sleep(next(delays))
+            return 'done'
+
+        start = time.time()
+        assert_equal(self.policy.call('GET', 'users/show', send), 'done')
+        assert_less(time.time() - start, 0.5)
+        stats = self.policy.stats()['users/show']
+        assert_equal(stats['hedges'], 1)
+        assert_equal(stats['hedge_wins'], 1)
+
+    def test_acquire(self):
+        acquired = []
+
+        def acquire(blocking=True):
+            acquired.append(blocking)
+            return False
+
+        send = self.flaky([van.Timeout(), van.NetworkError()])
+        assert_equal(self.policy.call('GET', 'users/show', send, acquire=acquire), {'id': 'test'})
+        assert_equal(acquired, [True, True])
+
+        for _ in range(5):
+            self.policy.call('GET', 'users/show', lambda timeout: time.sleep(0.01))
+        del acquired[:]
+        self.calls = 0
+
+        def slow(timeout):
+            self.calls += 1
+            time.sleep(0.2)
+            return 'done'
+
+        assert_equal(self.policy.call('GET', 'users/show', slow, acquire=acquire), 'done')
+        assert_equal(acquired, [False])
+        assert_equal(self.calls, 1)
+        stats = self.policy.stats()['users/show']
+        assert_equal(stats['hedge_skips'], 1)
+        assert_not_in('hedges', stats)
+
+    def test_scheduler(self):
+        class FlakyFan(Fan):
+            calls = 0
+
+            def _send(self, method, endpoint, *args, **kwargs):
+                if endpoint == van.RequestScheduler.RATE_LIMIT_ENDPOINT:
+                    return {'hourly_limit': 150, 'remaining_hits': 10, 'reset_time_in_seconds': time.time() + 3600}
+                self.calls += 1
+                if self.calls == 1:
+                    raise van.ApiRequestError('busy', status_code=503)
+                return {'id': 'test'}
+
+        scheduler = van.RequestScheduler()
+        fan = FlakyFan(CONSUMER_KEY, CONSUMER_SECRET, {'oauth_token': 'token', 'oauth_token_secret': 'secret'},
+                       scheduler=scheduler, retry=self.policy)
+        assert_equal(fan.get('users/show'), {'id': 'test'})
+        assert_equal(fan.calls, 2)
+        assert_equal(scheduler.status(fan)['remaining'], 8)
+
+
+class TestCircuitBreaker:
+    def setup(self):
+        self.breaker = van.CircuitBreaker(threshold=2, reset_timeout=0.1)
+
+    def fail(self):
+        raise van.ApiRequestError('busy', status_code=503)
+
+    def test_open(self):
+        for _ in range(2):
+            assert_raises(van.ApiRequestError, self.breaker.call, 'users/show', self.fail)
+        assert_equal(self.breaker.state('users/show'), van.CircuitBreaker.OPEN)
+        assert_raises(van.CircuitOpenError, self.breaker.call, 'users/show', lambda: 'ok')
+        assert_equal(self.breaker.state('statuses/update'), van.CircuitBreaker.CLOSED)
+        assert_equal(self.breaker.call('statuses/update', lambda: 'ok'), 'ok')
+
+    def not_found(self):
+        raise van.ApiRequestError('not found', status_code=404)
+
+    def test_client_error(self):
+        for _ in range(3):
+            assert_raises(van.ApiRequestError, self.breaker.call, 'users/show', self.not_found)
+        assert_equal(self.breaker.state('users/show'), van.CircuitBreaker.CLOSED)
+
+    def test_half_open(self):
+        for _ in range(2):
+            assert_raises(van.ApiRequestError, self.breaker.call, 'users/show', self.fail)
+        time.sleep(0.1)
+        assert_raises(van.ApiRequestError, self.breaker.call, 'users/show', self.fail)
+        assert_equal(self.breaker.state('users/show'), van.CircuitBreaker.OPEN)
+        time.sleep(0.1)
+        assert_true(self.breaker.before('users/show'))
+        assert_equal(self.breaker.state('users/show'), van.CircuitBreaker.HALF_OPEN)
+        assert_raises(van.CircuitOpenError, self.breaker.before, 'users/show')
+        self.breaker.record('users/show')
+        assert_equal(self.breaker.state('users/show'), van.CircuitBreaker.CLOSED)
+
+
+class UploadFan(FakeFan):
+    """记录上传的文件和读到的内容"""
+
+    def request(self, method, endpoint, params=None, data=None, files=None, **kwargs):
+        self.files = files
+        self.uploaded = files['photo'].read() if files else None
+        return super().request(method, endpoint, params, data, files, **kwargs)
+
+
+class TestPostStatus:
+    def setup(self):
+        self.fan = UploadFan({'photos/upload': lambda status, **params: {'id': 's1', 'text': status}})
+        fd, self.path = tempfile.mkstemp(suffix='.jpg')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(base64.b64decode(RAW_PHOTO))
+
+    def teardown(self):
+        os.remove(self.path)
+
+    def test_close_opened(self):
+        assert_equal(self.fan.update_status('hi', photo=self.path).text, 'hi')
+        assert_true(self.fan.files['photo'].closed)
+
+        self.fan.routes['photos/upload'] = fail
+        assert_raises(van.ApiRequestError, self.fan.update_status, 'hi', photo=self.path)
+        assert_true(self.fan.files['photo'].closed)
+
+    def test_unreadable(self):
+        assert_raises(ValueError, self.fan.update_status, 'hi', photo=self.path + '.missing')
+        assert_equal(self.fan.calls, [])
+        assert_equal(self.fan.draft_box, [])
+
+    def test_keep_callers_file(self):
+        with open(self.path, 'rb') as f:
+            self.fan.update_status('hi', photo=f)
+            assert_is(self.fan.files['photo'], f)
+            assert_false(f.closed)
+
+    def test_resend_file(self):
+        route = self.fan.routes['photos/upload']
+        self.fan.routes['photos/upload'] = fail
+        with open(self.path, 'rb') as f:
+            assert_raises(van.ApiRequestError, self.fan.update_status, 'hi', photo=f)
+        # 草稿中保存的是完整的图片，文件关闭后仍然可以重新发送
+        assert_equal(self.fan.draft_box[0]['photo'], base64.b64decode(RAW_PHOTO))
+        self.fan.routes['photos/upload'] = route
+        assert_equal(self.fan.resend_draft_box(), 1)
+        assert_equal(self.fan.uploaded, base64.b64decode(RAW_PHOTO))
+
+
+class OfflineFan(Fan):
+    """不联网发送消息的 Fan，`down` 为 `True` 时模拟网络错误"""
+
+    def __init__(self, outbox):
+        super().__init__(CONSUMER_KEY, CONSUMER_SECRET, {'oauth_token': 'token', 'oauth_token_secret': 'secret'},
+                         outbox=outbox)
+        self.down = False
+        self.error = None
+        self.sent = []
+        self.photos = []
+
+    def _post_status(self, data, photo=None):
+        if self.down:
+            raise van.NetworkError
+        if self.error is not None:
+            raise self.error
+        self.photos.append(photo)
+        if data['status'] == 'invalid':
+            raise van.ApiRequestError('invalid', status_code=400)
+        self.sent.append(data)
+        return {'id': 'status{}'.format(len(self.sent)), 'text': data['status'], 'user': {'id': 'test'}}
+
+
+class TestOutbox:
+    def setup(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'outbox.db')
+        self.outbox = van.Outbox(self.path, backoff=0)
+        self.fan = OfflineFan(self.outbox)
+
+    def test_send(self):
+        status = self.fan.update_status('test')
+        assert_equal(status.id, 'status1')
+        assert_equal([d.state for d in self.outbox.deliveries(self.fan)], [van.Outbox.SENT])
+        assert_equal(len(self.outbox), 0)
+
+    def test_chain(self):
+        self.fan.down = True
+        with assert_raises(van.NetworkError) as cm:
+            self.fan.update_status('first')
+        first = cm.exception.delivery
+        assert_raises(van.QueuedError, self.fan.update_status, 'reply', in_reply_to_status_id=first)
+
+        # 重启后继续发送
+        outbox = van.Outbox(self.path, backoff=0)
+        fan = OfflineFan(outbox)
+        assert_equal(len(outbox), 2)
+        assert_equal(fan.resend_draft_box(), 2)
+        assert_equal([data['status'] for data in fan.sent], ['first', 'reply'])
+        assert_equal(fan.sent[1]['in_reply_to_status_id'], 'status1')
+        assert_equal(outbox.status(first.id).status_id, 'status1')
+
+    def test_failed(self):
+        self.fan.down = True
+        assert_raises(van.NetworkError, self.fan.update_status, 'first')
+        with assert_raises(van.QueuedError) as cm:
+            self.fan.update_status('invalid')
+        invalid = cm.exception.delivery
+        with assert_raises(van.QueuedError) as cm:
+            self.fan.update_status('repost', repost_status_id=invalid)
+        repost = cm.exception.delivery
+        self.fan.down = False
+        assert_equal(self.fan.resend_draft_box(), 1)
+        assert_equal(self.outbox.status(invalid.id).state, van.Outbox.FAILED)
+        assert_equal(self.outbox.status(repost.id).state, van.Outbox.FAILED)
+
+    def test_missing_dependency(self):
+        reply = {'status': 'reply', 'in_reply_to_status_id': van.Delivery(42, van.Outbox.SENT)}
+        assert_raises(ValueError, self.outbox.put, self.fan, reply)
+        assert_equal(len(self.outbox), 0)
+
+        self.fan.down = True
+        with assert_raises(van.NetworkError) as cm:
+            self.fan.update_status('first')
+        first = cm.exception.delivery
+        with assert_raises(van.QueuedError) as cm:
+            self.fan.update_status('reply', in_reply_to_status_id=first)
+        reply = cm.exception.delivery
+        with self.outbox._cond:
+            self.outbox._db.execute('DELETE FROM outbox WHERE id = ?', (first.id,))
+        self.fan.down = False
+        assert_equal(self.fan.resend_draft_box(), 0)
+        assert_equal(self.outbox.status(reply.id).state, van.Outbox.FAILED)
+
+    def test_other_error(self):
+        self.outbox.max_attempts = 2
+        self.fan.error = OSError('broken')
+        with assert_raises(OSError) as cm:
+            self.fan.update_status('first')
+        first = cm.exception.delivery
+        assert_equal((first.state, first.attempts, first.error), (van.Outbox.PENDING, 1, 'broken'))
+        assert_raises(OSError, self.fan.resend_draft_box)
+        assert_equal(self.outbox.status(first.id).state, van.Outbox.FAILED)
+
+        # 失败的消息不再阻塞后面的消息
+        self.fan.error = None
+        assert_equal(self.fan.update_status('second').text, 'second')
+
+    def test_photo_path(self):
+        fd, path = tempfile.mkstemp(suffix='.jpg')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(base64.b64decode(RAW_PHOTO))
+        self.fan.down = True
+        assert_raises(van.NetworkError, self.fan.update_status, 'photo', photo=path)
+        # 写入发件箱时已经读取了图片
+        os.remove(path)
+        self.fan.down = False
+        assert_equal(self.fan.resend_draft_box(), 1)
+        assert_equal(self.fan.photos, [base64.b64decode(RAW_PHOTO)])
+
+        assert_raises(ValueError, self.fan.update_status, 'photo', photo=path)
+        assert_equal(len(self.outbox), 0)
+
+
+class TestParseTime:
+    def test_rest_format(self):
+        ts = 1497683640  # 2017-06-17T07:14:00+00:00
+        assert_equal(van.parse_time('Sat Jun 17 07:14:00 +0000 2017'), ts)
+        assert_equal(van.parse_time('Sat Jun 17 15:14:00 +0800 2017'), ts)
+
+    def test_stream_format(self):
+        assert_equal(van.parse_time('Sat, 17 Jun 2017 07:14:00 +0000'),
+                     van.parse_time('Sat Jun 17 07:14:00 +0000 2017'))
+
+    def test_invalid(self):
+        assert_raises(ValueError, van.parse_time, '2017-06-17')
@@ -3,20 +3,59 @@
 
 from __future__ import print_function, unicode_literals, absolute_import
 
+import asyncio
+import base64
+import calendar
+import collections
+import contextlib
 import functools
+import hashlib
+import heapq
+import hmac
+import html
+import inspect
+import io
+import itertools
 import json
 import logging
 import os
+import queue
+import random
 import re
+import sqlite3
 import threading
-from urllib.parse import urlparse
+import time
+import weakref
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from urllib.parse import quote, urlencode, urlparse
 
 import arrow
 import requests
+from requests.adapters import HTTPAdapter
 from requests_oauthlib.oauth1_session import OAuth1Session
 
+try:
+    import aiohttp
+    import yarl
+except ImportError:  # 异步客户端为可选功能
+    aiohttp = yarl = None
+
 __version__ = '0.0.5'
-__all__ = ['Fan', 'User', 'Status', 'Timeline']
+__all__ = [
+    'Fan',
+    'AsyncFan',
+    'User',
+    'Status',
+    'Timeline',
+    'TimelineStore',
+    'Poller',
+    'StreamMux',
+    'Transport',
+    'RequestScheduler',
+    'RetryPolicy',
+    'CircuitBreaker',
+    'Outbox',
+]
 logger = logging.getLogger(__name__)
 
 
@@ -24,7 +63,78 @@ def get_input(prompt=None):
     return input(prompt).strip()
 
 
-def get_photo(p):
+def _to_str(s, encoding='utf8'):
+    return s.decode(encoding) if isinstance(s, bytes) else s
+
+
+class Transport:
+    """
+    多个 :class:`Fan` 共享的 HTTP 连接池，每个 Fan 仍然使用自己的 OAuth 凭据签名::
+
+        transport = Transport(pool_maxsize=50)
+        transport.warm_up()
+        fans = [Fan(key, secret, token, transport=transport) for token in tokens]
+
+    :param int pool_connections: 保留连接池的主机数
+    :param int pool_maxsize: 每个主机最多保持的空闲连接数
+    :param int max_retries: 建立连接失败时的重试次数
+    :param bool pool_block: 连接数达到 `pool_maxsize` 时是否等待空闲连接，而不是临时新建连接
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, pool_connections=10, pool_maxsize=100, max_retries=0, pool_block=False):
+        self.pool_maxsize = pool_maxsize
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                              max_retries=max_retries, pool_block=pool_block)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def shared(cls):
+        """进程内默认的共享连接池"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def request(self, method, url, auth=None, **kwargs):
+        """使用共享的连接发出请求，`auth` 为各账号自己的签名方式"""
+        return self.session.request(method, url, auth=auth, **kwargs)
+
+    def warm_up(self, urls=('http://api.fanfou.com/',), connections=None, timeout=5):
+        """
+        预先建立连接，避免第一批请求等待 TCP 握手
+
+        :param urls: 需要建立连接的地址，每个主机一个即可
+        :param int connections: 每个主机建立的连接数，默认为 `pool_maxsize`
+        :return: 成功建立的连接数
+        :rtype: int
+        """
+        connections = connections or self.pool_maxsize
+
+        def touch(url):
+            try:
+                self.session.head(url, timeout=timeout).close()
+                return True
+            except requests.RequestException:
+                return False
+
+        # 并发请求才会同时占用多个连接，结束后全部留在连接池中
+        targets = [url for url in urls for _ in range(connections)]
+        with ThreadPoolExecutor(min(len(targets), 32) or 1) as executor:
+            return sum(executor.map(touch, targets))
+
+    def close(self):
+        self.session.close()
+
+
+def get_photo(p, transport=None):
+    """
+    :param transport: 下载图片使用的 :class:`Transport`，默认为 :meth:`Transport.shared`
+    """
     if p is None:
         return False
     elif hasattr(p, 'read'):
@@ -36,7 +146,7 @@ def get_photo(p):
         try:
             url = p.strip('\'').strip('"')
             if urlparse(url).scheme != '':
-                resp = requests.get(url, stream=True)
+                resp = (transport or Transport.shared()).session.get(url, stream=True)
                 resp.raise_for_status()
                 if not resp.headers.get('Content-Type', '').lower().startswith('image/'):
                     resp.close()
@@ -47,18 +157,181 @@ def get_photo(p):
     return False
 
 
-def pager(fan, endpoint, **params):
-    page = 1
-    while True:
-        _, rv = fan.get(endpoint, page=page, **params)
-        if _:
+def _draft_photo(photo):
+    """
+    上传失败后保存到草稿箱的图片。文件对象此时已经读到末尾，能够回退时保存完整内容，
+    这样重新发送时从头上传，调用方关闭文件也不受影响
+    """
+    seekable = getattr(photo, 'seekable', None)
+    if seekable is not None and seekable():
+        photo.seek(0)
+        return photo.read()
+    return photo
+
+
+class Prefetcher:
+    """
+    在后台线程中预先获取后续页面，最多缓存 `depth` 页。
+
+    :param fetch: 每次调用返回下一页的列表，返回空列表表示没有更多数据
+    :param int depth: 预读深度
+    """
+
+    def __init__(self, fetch, depth=1):
+        self._fetch = fetch
+        self._queue = queue.Queue(depth)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._closed.is_set():
+            try:
+                page = self._fetch()
+            except Exception as e:
+                self._queue.put((None, e))
+                return
+            self._queue.put((page, None))
+            if not page:
+                return
+
+    def get(self):
+        """取出下一页，必要时等待后台线程"""
+        page, error = self._queue.get()
+        if error is not None:
+            raise error
+        return page
+
+    def close(self):
+        """停止预读，丢弃已缓存的页面"""
+        self._closed.set()
+        # 清空队列，让阻塞在 put 上的后台线程退出
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+
+class _TokenBucket:
+    """令牌桶，平均每秒 `rate` 个令牌，最多积攒 `capacity` 个"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        取出一个令牌
+
+        :return: 成功时返回 0，否则返回需要等待的秒数
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+
+def pager(fan, endpoint, prefetch=None, **params):
+    """
+    按页码依次获取列表类 API 的全部数据
+
+    :param int prefetch: 预读的页数，默认使用 `fan.prefetch`，0 表示不预读
+    """
+    if prefetch is None:
+        prefetch = fan.prefetch
+    pages = itertools.count(1)
+
+    def fetch():
+        return fan.get(endpoint, page=next(pages), **params)
+
+    prefetcher = None
+    if prefetch:
+        prefetcher = Prefetcher(fetch, prefetch)
+        fetch = prefetcher.get
+    try:
+        while True:
+            rv = fetch()
             if not rv:
                 return
             for r in rv:
                 yield r
-            page += 1
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+
+def parallel_pager(fan, endpoint, workers=8, **params):
+    """
+    :func:`pager` 的并发版本，同时请求 `workers` 个页码，结果仍按页码顺序返回。
+    遇到第一个空页时停止，其后已发出的请求会被丢弃。
+
+    :param int workers: 同时进行的请求数
+    """
+    def fetch(page):
+        return fan.get(endpoint, page=page, **params)
+
+    pages = itertools.count(1)
+    with ThreadPoolExecutor(workers) as pool:
+        pending = collections.deque(pool.submit(fetch, next(pages)) for _ in range(workers))
+        try:
+            while pending:
+                rv = pending.popleft().result()
+                if not rv:
+                    return
+                pending.append(pool.submit(fetch, next(pages)))
+                for r in rv:
+                    yield r
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def fetch_ids(fan, endpoint, workers=8, compact=False, **params):
+    """
+    并发获取 id 列表类 API 的全部数据
+
+    :param bool compact: 为 `True` 时返回去重后的 tuple，否则返回按顺序产生 id 的生成器
+    """
+    ids = parallel_pager(fan, endpoint, workers, **params)
+    if compact:
+        # 翻页过程中列表可能变化，导致相邻页之间出现重复的 id
+        return tuple(collections.OrderedDict.fromkeys(ids))
+    return ids
+
+
+_MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+           'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
+
+def parse_time(s):
+    """
+    将饭否的时间字符串解析为 UTC 时间戳，比 arrow 基于格式串的解析快一个数量级。
+    支持 REST API 的 `Sat Jun 17 07:14:00 +0000 2017`
+    和 Streaming API 的 `Sat, 17 Jun 2017 07:14:00 +0000` 两种格式。
+
+    :rtype: int
+    """
+    parts = s.split()
+    try:
+        if parts[0].endswith(','):
+            _, day, month, year, hms = parts[:5]
+            tz = parts[5] if len(parts) > 5 else '+0000'
         else:
-            return
+            _, month, day, hms, tz, year = parts
+        hour, minute, second = hms.split(':')
+        ts = calendar.timegm((int(year), _MONTHS[month], int(day), int(hour), int(minute), int(second)))
+        offset = (int(tz[1:3]) * 60 + int(tz[3:5])) * 60
+    except (ValueError, KeyError):
+        raise ValueError('Unknown time format: {!r}'.format(s))
+    return ts - offset if tz[0] == '+' else ts + offset
 
 
 def log(func):
@@ -87,455 +360,2165 @@ class Timeout(NetworkError):
     pass
 
 
+class CircuitOpenError(NetworkError):
+    """接口的熔断器处于打开状态，请求没有发出"""
+
+
 class ApiRequestError(FanfouError):
     """API请求出错，参数错误、验证失败等"""
 
+    def __init__(self, *args, status_code=None):
+        super().__init__(*args)
+        #: HTTP 状态码，服务器没有正常响应时为 `None`
+        self.status_code = status_code
+
 
 class AuthError(ApiRequestError):
     pass
 
 
-class Fan:
-    """
-    API操作入口
+class QueuedError(FanfouError):
+    """消息已保存在 :class:`Outbox` 中，但前面还有未发出的消息，稍后按顺序发送"""
+
+    def __init__(self, delivery):
+        super().__init__(delivery.id)
+        self.delivery = delivery
+
+
+_MISSING = object()
+
+
+class Cache:
     """
+    :meth:`Fan.get` 的响应缓存基类，按接口设置过期时间，超过 `maxsize` 时淘汰最久未使用的条目。
+    子类实现 `_load`, `_store`, `_touch`, `_delete`, `_clear` 和 `__len__` 即可更换存储后端。
 
-    def __init__(self, consumer_key, consumer_secret, oauth_token=None, mobile=False):
-        self._consumer_key = consumer_key
-        self._consumer_secret = consumer_secret
-        self._oauth_token = oauth_token
-        self._session = OAuth1Session(consumer_key, consumer_secret)
-        if oauth_token:
-            self._session._populate_attributes(oauth_token)
-        self._request_token = None
-        self._oauth_type = None
+    :param dict ttls: 接口到过期秒数的映射，会覆盖 :attr:`DEFAULT_TTLS` 中的同名项
+    :param int default_ttl: 其他接口的过期时间，0 表示不缓存。时间线接口不使用此值
+    :param int maxsize: 最多缓存的条目数
+    """
+    DEFAULT_TTLS = {
+        'users/show': 300,
+        'statuses/show': 60,
+        'statuses/context_timeline': 60,
+        'friendships/show': 60,
+        'blocks/exists': 60,
+        'trends/list': 60,
+    }
+    # 会修改数据的接口，即使通过 GET 调用（如 friendships/accept）也从不缓存
+    _MUTATING_RE = re.compile(r'/(create|destroy|accept|deny|update|upload|new)(/|$)')
+    # 时间线按 since_id/max_id 翻页，内容随时变化，只有在 `ttls` 中显式指定时才缓存
+    _TIMELINE_RE = re.compile(r'_timeline$|^statuses/(mentions|replies)$')
+
+    def __init__(self, ttls=None, default_ttl=0, maxsize=1024):
+        self.ttls = dict(self.DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.default_ttl = default_ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
 
-        self.request_token_url = 'http://fanfou.com/oauth/request_token'
-        self.authorize_url = 'http://fanfou.com/oauth/authorize'
-        self.access_token_url = 'http://fanfou.com/oauth/access_token'
-        if mobile:
-            self.authorize_url = 'http://m.fanfou.com/oauth/authorize'
+    def ttl(self, endpoint):
+        """返回接口的过期时间，0 表示此接口不缓存"""
+        if self._MUTATING_RE.search(endpoint):
+            return 0
+        if endpoint in self.ttls:
+            return self.ttls[endpoint]
+        if self._TIMELINE_RE.search(endpoint):
+            return 0
+        return self.default_ttl
 
-        self._me = None
-        self.draft_box = []
-        self.mentions = Timeline(self, None, 'statuses/mentions')
-        self.replies = Timeline(self, None, 'statuses/replies')
-        self.public_timeline = Timeline(self, None, 'statuses/public_timeline')
+    @staticmethod
+    def make_key(endpoint, params):
+        return json.dumps([endpoint, sorted((k, v) for k, v in params.items() if v is not None)])
 
-    @property
-    def session(self):
-        """获取session"""
-        return self._session
+    def get(self, endpoint, params):
+        """返回缓存的响应，未命中或已过期时返回 `_MISSING`"""
+        key = self.make_key(endpoint, params)
+        with self._lock:
+            entry = self._load(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.time():
+                    self.hits += 1
+                    self._touch(key)
+                    return value
+                self._delete([key])
+            self.misses += 1
+            return _MISSING
+
+    def set(self, endpoint, params, value):
+        ttl = self.ttl(endpoint)
+        if not ttl:
+            return
+        key = self.make_key(endpoint, params)
+        with self._lock:
+            self._store(key, endpoint, params.get('id'), time.time() + ttl, value)
 
-    def authorization_url(self, oauth_callback='oob'):
+    def invalidate(self, endpoint, *ids):
         """
-        引导用户访问的授权页面URL
-        当 oauth_callback = 'oob' 时表示使用 PIN码授权
+        使缓存失效
+
+        :param str endpoint: 接口
+        :param ids: 只删除这些 id 对应的条目，省略时删除此接口的所有条目
         """
-        self._oauth_type = oauth_callback
-        token = self._session.fetch_request_token(self.request_token_url)
-        self._request_token = token
-        url = self._session.authorization_url(self.authorize_url, oauth_callback=oauth_callback)
-        return url
+        with self._lock:
+            self._invalidate(endpoint, ids)
 
-    def oauth(self, pin_code=None, redirect_url=None):
-        """通过授权后的PIN码或者浏览器重定向的URL获取最终的token"""
-        if pin_code and redirect_url:
-            raise ValueError('pin_code and redirect_url are mutually exclusive')
-        if pin_code:
-            token = self._session.fetch_access_token(self.access_token_url, verifier=pin_code)
-        elif redirect_url:
-            self._session.parse_authorization_response(redirect_url)
-            token = self._session.fetch_access_token(self.access_token_url, verifier='x')
-        else:
-            raise ValueError('Either pin_code nor redirect_url is valid')
-        self._oauth_token = token
-        self._session._populate_attributes(token)
-        return token
+    def clear(self):
+        with self._lock:
+            self._clear()
 
-    def xauth(self, username, password):
-        import oauthlib.oauth1.rfc5849.utils
-        # patch to allow x_auth_* params
-        oauthlib.oauth1.rfc5849.utils.filter_oauth_params = lambda _: _
+    def stats(self):
+        """返回命中统计"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
 
-        client = self._session._client.client
+    def _load(self, key):
+        raise NotImplementedError
 
-        class OAuth1Client(oauthlib.oauth1.rfc5849.Client):
-            def get_oauth_params(self, request):
-                params = super().get_oauth_params(request)
-                args = [
-                    ('x_auth_username', username),
-                    ('x_auth_password', password),
-                    ('x_auth_mode', 'client_auth')
-                ]
-                params += args
-                return params
+    def _store(self, key, endpoint, ident, expires, value):
+        raise NotImplementedError
 
-        sess = OAuth1Session(client.client_key, client.client_secret, client_class=OAuth1Client)
-        token = sess.fetch_access_token(self.access_token_url, verifier='x')
-        self._oauth_token = token
-        self._session._populate_attributes(token)
-        return token
+    def _touch(self, key):
+        raise NotImplementedError
 
-    @property
-    def authorized(self):
-        """当前会话是否已授权"""
-        return self._session.authorized
+    def _delete(self, keys):
+        raise NotImplementedError
 
-    def request(self, method, endpoint, params=None, data=None, files=None, **kwargs):
-        """发出请求"""
-        # 1-tuple (not a tuple at all)
-        # {fieldname: file_object}
-        # 2-tuple
-        # {fieldname: (filename, file_object)}
-        # 3-tuple
-        # {fieldname: (filename, file_object, content_type)}
-        # 4-tuple
-        # {fieldname: (filename, file_object, content_type, headers)}
-        kwargs.setdefault('timeout', (5, 5))
-        url = 'http://api.fanfou.com/{}.json'.format(endpoint)
+    def _invalidate(self, endpoint, ids):
+        raise NotImplementedError
 
-        try:
-            response = self._session.request(method, url, params=params, data=data, files=files, **kwargs)
-        except requests.Timeout:
-            raise Timeout
-        except requests.ConnectionError:
-            raise NetworkError
-        else:
-            try:
-                json_data = response.json()
-            except ValueError:
-                raise ApiRequestError('Invalid server response')
-            if response.status_code == 200:
-                return json_data
-            if json_data.get('error'):
-                raise ApiRequestError(json_data['error'])
-            raise ApiRequestError('Invalid error response')
+    def _clear(self):
+        raise NotImplementedError
 
-    def get(self, endpoint, **params):
-        params.setdefault('mode', 'lite')
-        params.setdefault('format', 'html')
-        return self.request('GET', endpoint, params=params)
+    def __len__(self):
+        raise NotImplementedError
 
-    def post(self, endpoint, files=None, **data):
-        data.setdefault('mode', 'lite')
-        data.setdefault('format', 'html')
-        return self.request('POST', endpoint, data=data, files=files)
 
-    @property
-    def me(self):
-        """获取授权用户的信息"""
-        if self._me is None:
-            me = User.from_id(self)
-            me.mentions = self.mentions
-            me.replies = self.replies
-            self._me = me
-        return self._me
+class MemoryCache(Cache):
+    """
+    内存中的 LRU 缓存。
+    返回的是缓存对象本身，调用者不应修改它。
+    """
 
-    @log
-    def update_status(self, status, photo=None,
-                      in_reply_to_user_id=None,
-                      in_reply_to_status_id=None,
-                      repost_status_id=None,
-                      location=None,
-                      source=None):
-        """
-        发表新状态，:meth:`Status.send()` 的快捷方式。
+    def __init__(self, ttls=None, default_ttl=0, maxsize=1024):
+        super().__init__(ttls, default_ttl, maxsize)
+        self._entries = collections.OrderedDict()
 
-        :param str text: 文字
-        :param str photo: 照片路径或者URL
-        :param str in_reply_to_user_id: 要回复的用户ID
-        :param str in_reply_to_status_id: 要回复的消息ID
-        :param str repost_status_id: 要转发的消息ID
-        :param str location: 位置信息，使用'地点名称' 或 '一个半角逗号分隔的经纬度坐标'
-        :param str source: source 消息来源
-        """
-        data = dict(status=status,
-                    in_reply_to_user_id=in_reply_to_user_id,
-                    in_reply_to_status_id=in_reply_to_status_id,
-                    repost_status_id=repost_status_id,
-                    locaion=location, source=source)
-        try:
-            if photo is not None:
-                result = self.post('photos/upload', files=dict(photo=photo), **data)
-            else:
-                result = self.post('statuses/update', **data)
-        except FanfouError:
-            data['photo'] = photo
-            self.draft_box.append(data)
-            raise
+    def _load(self, key):
+        entry = self._entries.get(key)
+        return entry and entry[2:]
 
-        return Status.from_json(self, result)
+    def _store(self, key, endpoint, ident, expires, value):
+        self._entries[key] = (endpoint, ident, expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
 
-    def resend_draft_box(self):
-        pass
+    def _touch(self, key):
+        self._entries.move_to_end(key)
 
-    # 以下是不需要 id 参数，即只能获取当前用户信息的API
-    @log
-    def follow(self, user):
-        """
-        关注用户
+    def _delete(self, keys):
+        for key in keys:
+            self._entries.pop(key, None)
 
-        :param User|str user: 被关注的用户, User对象，或id，或 loginname
-        """
-        if isinstance(user, User):
-            user = user.id
-        rs = self.post('friendships/create', id=user)
-        return rs
+    def _invalidate(self, endpoint, ids):
+        self._delete([key for key, (ep, ident, _, _) in self._entries.items()
+                      if ep == endpoint and (not ids or ident in ids)])
 
-    @log
-    def unfollow(self, user):
-        """
-        取消关注用户
+    def _clear(self):
+        self._entries.clear()
 
-        :param User|str user: 被关注的用户, User对象，或id，或 loginname
-        """
-        if isinstance(user, User):
-            user = user.id
-        rs = self.post('friendships/destroy', id=user)
-        return rs
+    def __len__(self):
+        return len(self._entries)
 
-    @property
-    @log
-    def follow_requests(self, count=60):
-        """
-        返回请求关注当前用户的列表
 
-        :rtype: (bool, [User])
-        """
-        for fo in pager(self, 'friendships/requests', count=count):
-            yield User.from_json(self, fo)
+class SqliteCache(Cache):
+    """
+    保存在 SQLite 数据库中的 LRU 缓存，进程重启后仍然有效
 
-    @log
-    def accept_follower(self, user):
-        """
-        接受关注请求
+    :param str path: 数据库文件路径
+    """
 
-        :param User|str user: User对象，或id，或 loginname
-        :rtype: (bool, User)
-        """
-        if isinstance(user, User):
-            user = user.id
-        rv = self.get('friendships/accept', id=user)
-        return rv
+    def __init__(self, path, ttls=None, default_ttl=0, maxsize=1024):
+        super().__init__(ttls, default_ttl, maxsize)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS cache ('
+                         'key TEXT PRIMARY KEY, endpoint TEXT, ident TEXT, '
+                         'expires REAL, accessed REAL, value TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS cache_endpoint ON cache (endpoint, ident)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+
+    def _load(self, key):
+        row = self._db.execute('SELECT expires, value FROM cache WHERE key = ?', (key,)).fetchone()
+        return row and (row[0], json.loads(row[1]))
+
+    def _store(self, key, endpoint, ident, expires, value):
+        self._db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)',
+                         (key, endpoint, ident, expires, time.time(), json.dumps(value)))
+        self._db.execute('DELETE FROM cache WHERE key IN ('
+                         'SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.maxsize,))
+
+    def _touch(self, key):
+        self._db.execute('UPDATE cache SET accessed = ? WHERE key = ?', (time.time(), key))
+
+    def _delete(self, keys):
+        self._db.executemany('DELETE FROM cache WHERE key = ?', [(key,) for key in keys])
+
+    def _invalidate(self, endpoint, ids):
+        if not ids:
+            self._db.execute('DELETE FROM cache WHERE endpoint = ?', (endpoint,))
+        else:
+            self._db.executemany('DELETE FROM cache WHERE endpoint = ? AND ident IS ?',
+                                 [(endpoint, ident) for ident in ids])
 
-    @log
-    def deny_follower(self, user):
+    def _clear(self):
+        self._db.execute('DELETE FROM cache')
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+
+class TimelineStore:
+    """
+    把时间线的消息和游标保存在 SQLite 数据库中，进程重启后可以继续增量同步
+
+    每条时间线以 endpoint 和 user_id 区分，保存的是一段连续的消息。
+    mentions 等时间线没有 user_id，多个账号请使用不同的数据库文件。
+
+    :param str path: 数据库文件路径
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._db.execute('CREATE TABLE IF NOT EXISTS statuses ('
+                         'timeline TEXT, rawid INTEGER, id TEXT, value TEXT, '
+                         'PRIMARY KEY (timeline, rawid))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS statuses_id ON statuses (id)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS cursors ('
+                         'timeline TEXT PRIMARY KEY, max_id TEXT, max_rawid INTEGER, '
+                         'since_id TEXT, since_rawid INTEGER)')
+
+    @staticmethod
+    def key(endpoint, user_id):
+        return '{}:{}'.format(endpoint, user_id or '')
+
+    def cursor(self, key):
         """
-        拒绝关注请求
+        已保存区间的边界
 
-        :param User|str user: User对象，或id，或 loginname
-        :rtype: (bool, User)
+        :return: `(max_id, max_rawid, since_id, since_rawid)`，没有记录时返回 `None`
         """
-        if isinstance(user, User):
-            user = user.id
-        rv = self.post('friendships/deny', id=user)
-        return rv
+        return self._db.execute('SELECT max_id, max_rawid, since_id, since_rawid '
+                                'FROM cursors WHERE timeline = ?', (key,)).fetchone()
+
+    def older(self, key, rawid, count=60):
+        """比 rawid 旧的最多 count 条消息，从新到旧排列"""
+        rows = self._db.execute('SELECT value FROM statuses WHERE timeline = ? AND rawid < ? '
+                                'ORDER BY rawid DESC LIMIT ?', (key, rawid, count)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def newer(self, key, rawid, count=60):
+        """比 rawid 新的最多 count 条消息，从新到旧排列"""
+        rows = self._db.execute('SELECT value FROM statuses WHERE timeline = ? AND rawid > ? '
+                                'ORDER BY rawid ASC LIMIT ?', (key, rawid, count)).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+    def save(self, key, statuses):
+        """
+        保存与已保存区间相邻的一段消息，并扩展区间的边界
 
-    @log
-    def block(self, user):
+        :param [Status] statuses: 从新到旧排列的消息
         """
-        屏蔽用户
+        if not statuses:
+            return
+        rows = [(key, s.rawid, s.id, json.dumps(s.dict)) for s in statuses]
+        newest, oldest = statuses[0], statuses[-1]
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                self._db.executemany('INSERT OR REPLACE INTO statuses VALUES (?, ?, ?, ?)', rows)
+                cursor = self.cursor(key)
+                if cursor is None:
+                    cursor = (newest.id, newest.rawid, oldest.id, oldest.rawid)
+                else:
+                    if newest.rawid > cursor[1]:
+                        cursor = (newest.id, newest.rawid) + cursor[2:]
+                    if oldest.rawid < cursor[3]:
+                        cursor = cursor[:2] + (oldest.id, oldest.rawid)
+                self._db.execute('INSERT OR REPLACE INTO cursors VALUES (?, ?, ?, ?, ?)', (key,) + tuple(cursor))
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def discard(self, *ids):
+        """删除指定 id 的消息，例如消息被删除之后"""
+        with self._lock:
+            self._db.executemany('DELETE FROM statuses WHERE id = ?', [(id,) for id in ids])
 
-        :param str|User user: 被屏蔽的用户User对象或者id，loginname
-        :rtype: (bool, User)
+    def clear(self, key=None):
+        """清空指定时间线，`key` 为 `None` 时清空所有时间线"""
+        with self._lock:
+            if key is None:
+                self._db.execute('DELETE FROM statuses')
+                self._db.execute('DELETE FROM cursors')
+            else:
+                self._db.execute('DELETE FROM statuses WHERE timeline = ?', (key,))
+                self._db.execute('DELETE FROM cursors WHERE timeline = ?', (key,))
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM statuses').fetchone()[0]
+
+
+class Delivery:
+    """:class:`Outbox` 中一条消息的发送状态"""
+
+    __slots__ = ('id', 'state', 'status_id', 'attempts', 'error', 'created_at')
+
+    def __init__(self, id, state, status_id=None, attempts=0, error=None, created_at=None):
+        self.id = id
+        #: :attr:`Outbox.PENDING`, :attr:`Outbox.SENDING`, :attr:`Outbox.SENT` 或 :attr:`Outbox.FAILED`
+        self.state = state
+        #: 发送成功后的消息 id
+        self.status_id = status_id
+        self.attempts = attempts
+        #: 最近一次失败的原因
+        self.error = error
+        self.created_at = created_at
+
+    def __repr__(self):
+        return '<Delivery {} {}>'.format(self.id, self.state)
+
+
+class Outbox(threading.Thread):
+    """
+    :meth:`Fan.update_status` 的持久化发件箱。消息先写入 SQLite 再发送，发送失败的消息在进程重启后仍然保留，
+    由后台线程按顺序重试::
+
+        outbox = Outbox('outbox.db')
+        fan = Fan(key, secret, token, outbox=outbox)
+        outbox.start()
+        try:
+            fan.update_status('hello')
+        except FanfouError as e:
+            # 消息仍在发件箱中，由后台线程重试
+            print(outbox.status(e.delivery.id).state)
+
+    同一账号的消息严格按写入顺序发送；`in_reply_to_status_id` 和 `repost_status_id` 可以是尚未发出的 :class:`Delivery`，
+    发送时替换为真实的消息 id。设置了 :class:`RequestScheduler` 时，额度用完的账号等到下一周期再一起发送。
+    4xx 错误不会重试，消息标记为 :attr:`FAILED`，依赖它的回复和转发也一并失败。
+
+    消息在发送过程中进程退出时，重启后会重新发送，可能重复。
+
+    :param str path: 数据库文件路径
+    :param float interval: 后台线程检查待发消息的间隔（秒）
+    :param float backoff: 第一次重试前的等待秒数
+    :param float max_backoff: 重试等待的上限（秒）
+    :param int max_attempts: 最多发送次数，`None` 表示一直重试
+    """
+
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    _CHAIN = ('in_reply_to_status_id', 'repost_status_id')
+
+    def __init__(self, path, interval=5.0, backoff=5.0, max_backoff=600.0, max_attempts=None):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self._fans = weakref.WeakSet()
+        self._cond = threading.Condition()
+        self._running = True
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS outbox ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, account TEXT, data TEXT, photo BLOB, '
+                         'state TEXT, attempts INTEGER, next_at REAL, error TEXT, status_id TEXT, created_at REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS outbox_account ON outbox (account, state, id)')
+        # 上次退出时正在发送的消息不知道是否成功，重新发送
+        self._db.execute('UPDATE outbox SET state = ? WHERE state = ?', (self.PENDING, self.SENDING))
+
+    @staticmethod
+    def _account(fan):
+        return '{}:{}'.format(*RequestScheduler._key(fan))
+
+    def register(self, fan):
+        """由后台线程发送此账号的消息，:class:`Fan` 设置了 `outbox` 时会自动调用"""
+        with self._cond:
+            self._fans.add(fan)
+
+    def put(self, fan, data, photo=None):
         """
-        if isinstance(user, User):
-            user = user.id
-        rs = self.post('blocks/create', id=user)
-        return rs
+        写入一条待发送的消息
 
-    @log
-    def unblock(self, user):
+        :param dict data: `statuses/update` 的参数
+        :param photo: 照片路径、URL、文件对象或 bytes，写入时读取后保存，发送时不再依赖文件或网络
+        :rtype: Delivery
+        :raises ValueError: `data` 引用的 :class:`Delivery` 不在队列中
         """
-        解除屏蔽
+        data = {k: {'delivery': v.id} if isinstance(v, Delivery) else v for k, v in data.items()}
+        if photo is not None and not isinstance(photo, bytes):
+            photo = self._read_photo(fan, photo)
+        now = time.time()
+        with self._cond:
+            for value in data.values():
+                if isinstance(value, dict) and self._db.execute('SELECT 1 FROM outbox WHERE id = ?',
+                                                                (value['delivery'],)).fetchone() is None:
+                    raise ValueError('Unknown delivery: {}'.format(value['delivery']))
+            cursor = self._db.execute('INSERT INTO outbox (account, data, photo, state, attempts, next_at, created_at) '
+                                      'VALUES (?, ?, ?, ?, 0, 0, ?)',
+                                      (self._account(fan), json.dumps(data), photo, self.PENDING, now))
+            self._cond.notify_all()
+        return Delivery(cursor.lastrowid, self.PENDING, created_at=now)
 
-        :param str|User user: 被屏蔽的用户User对象或者id，loginname
-        :rtype: (bool, str)
+    @staticmethod
+    def _read_photo(fan, photo):
+        upload = get_photo(photo, fan.transport)
+        if not upload:
+            raise ValueError('Cannot read photo: {!r}'.format(photo))
+        try:
+            return upload.read()
+        finally:
+            if upload is not photo:
+                upload.close()
+
+    def status(self, id):
         """
-        if isinstance(user, User):
-            user = user.id
-        rs = self.post('blocks/destroy', id=user)
-        return rs
+        查询一条消息的发送状态
 
-    def is_blocked(self, user):
+        :param int id: :attr:`Delivery.id`
+        :rtype: Delivery
         """
-        检查是否屏蔽用户
+        with self._cond:
+            row = self._db.execute('SELECT id, state, status_id, attempts, error, created_at '
+                                   'FROM outbox WHERE id = ?', (id,)).fetchone()
+        return row and Delivery(*row)
 
-        :param str|User user: 用户User对象或者id，loginname
-        :rtype: (bool, str)
+    def deliveries(self, fan=None, state=None):
         """
-        if isinstance(user, User):
-            user = user.id
-        return self.get('blocks/exists', id=user)
+        按写入顺序列出消息的发送状态
 
-    @property
-    def blocked_users(self):
+        :param Fan fan: 只列出此账号的消息
+        :param str state: 只列出此状态的消息
+        :rtype: [Delivery]
         """
-        返回黑名单上用户列表
+        sql, args = 'SELECT id, state, status_id, attempts, error, created_at FROM outbox WHERE 1', []
+        if fan is not None:
+            sql += ' AND account = ?'
+            args.append(self._account(fan))
+        if state is not None:
+            sql += ' AND state = ?'
+            args.append(state)
+        with self._cond:
+            rows = self._db.execute(sql + ' ORDER BY id', args).fetchall()
+        return [Delivery(*row) for row in rows]
+
+    def retry(self, id):
+        """把 :attr:`FAILED` 的消息重新放回队列"""
+        with self._cond:
+            self._db.execute('UPDATE outbox SET state = ?, next_at = 0 WHERE id = ? AND state = ?',
+                             (self.PENDING, id, self.FAILED))
+            self._cond.notify_all()
+
+    def _fail(self, ids, error):
+        # 调用方持有锁；依赖失败消息的回复和转发也无法发送
+        while ids:
+            self._db.executemany('UPDATE outbox SET state = ?, error = ? WHERE id = ?',
+                                 [(self.FAILED, error, id) for id in ids])
+            ids = [row[0] for row in self._db.execute('SELECT id, data FROM outbox WHERE state = ?', (self.PENDING,))
+                   if any(isinstance(v, dict) and v.get('delivery') in ids for v in json.loads(row[1]).values())]
+            error = 'dependency failed'
+
+    def _claim(self, fan, id):
+        # 只有账号中最早的未发送消息可以发送，返回 (data, photo)，否则返回 None
+        with self._cond:
+            row = self._db.execute('SELECT id, data, photo, state, next_at FROM outbox '
+                                   'WHERE account = ? AND state IN (?, ?) ORDER BY id LIMIT 1',
+                                   (self._account(fan), self.PENDING, self.SENDING)).fetchone()
+            if row is None or row[0] != id or row[3] != self.PENDING or row[4] > time.time():
+                return None
+            data = json.loads(row[1])
+            for key in self._CHAIN:
+                ref = data.get(key)
+                if not isinstance(ref, dict):
+                    continue
+                dependency = self._db.execute('SELECT state, status_id FROM outbox WHERE id = ?',
+                                              (ref['delivery'],)).fetchone()
+                # 依赖的消息不存在时（例如被清理掉）也不可能再发出
+                if dependency is None or dependency[0] == self.FAILED:
+                    self._fail([id], 'dependency failed')
+                    return None
+                if dependency[0] != self.SENT:
+                    return None
+                data[key] = dependency[1]
+            self._db.execute('UPDATE outbox SET state = ?, attempts = attempts + 1 WHERE id = ?', (self.SENDING, id))
+        return data, row[2]
+
+    def deliver(self, fan, delivery):
+        """
+        立即发送一条消息，它前面还有未发出的消息时抛出 :class:`QueuedError`。
+        发送失败时抛出原来的异常，异常的 `delivery` 属性为此消息
 
-        :rtype: (bool, [User])
+        :param Delivery delivery: :meth:`put` 返回的消息
+        :return: 服务器返回的消息
+        :rtype: dict
         """
-        for bl in pager(self, 'blocks/blocking'):
-            yield User.from_json(self, bl)
+        claim = self._claim(fan, delivery.id)
+        if claim is None:
+            delivery = self.status(delivery.id)
+            if delivery.state == self.FAILED:
+                error = ApiRequestError(delivery.error)
+                error.delivery = delivery
+                raise error
+            raise QueuedError(delivery)
+        data, photo = claim
+        try:
+            result = fan._post_status(data, photo)
+        except Exception as e:
+            # 读取图片出错等非网络异常同样按失败处理，否则这条消息会一直卡在队首
+            self._failed(delivery.id, e)
+            e.delivery = self.status(delivery.id)
+            raise
+        except BaseException:
+            with self._cond:
+                self._db.execute('UPDATE outbox SET state = ? WHERE id = ?', (self.PENDING, delivery.id))
+            raise
+        with self._cond:
+            self._db.execute('UPDATE outbox SET state = ?, status_id = ?, error = NULL, photo = NULL WHERE id = ?',
+                             (self.SENT, result.get('id'), delivery.id))
+            self._cond.notify_all()
+        fan._status_changed(*[data.get(key) for key in self._CHAIN])
+        return result
 
-    @property
-    @log
-    def blocked_users_id(self):
+    def _failed(self, id, error):
+        with self._cond:
+            attempts = self._db.execute('SELECT attempts FROM outbox WHERE id = ?', (id,)).fetchone()[0]
+            status_code = getattr(error, 'status_code', None)
+            if RequestScheduler.is_rate_limited(error):
+                # 额度用完，不计入失败次数，等待较长时间后和其他消息一起发送
+                self._db.execute('UPDATE outbox SET state = ?, attempts = attempts - 1, next_at = ?, error = ? '
+                                 'WHERE id = ?', (self.PENDING, time.time() + self.max_backoff, str(error), id))
+            elif (status_code and 400 <= status_code < 500) or attempts == self.max_attempts:
+                self._fail([id], str(error) or type(error).__name__)
+            else:
+                delay = _backoff(self.backoff, self.max_backoff, attempts - 1)
+                self._db.execute('UPDATE outbox SET state = ?, next_at = ?, error = ? WHERE id = ?',
+                                 (self.PENDING, time.time() + delay, str(error) or type(error).__name__, id))
+
+    def flush(self, fan):
         """
-        获取用户黑名单id列表
+        按顺序发送账号中到期的消息，遇到发送失败或额度用完时停止
 
-        :rtype: (bool, [str])
+        :return: 成功发送的消息数
+        :rtype: int
         """
-        for bl in pager(self, 'blocks/ids'):
-            yield bl
+        sent = 0
+        while True:
+            scheduler = fan.scheduler
+            if scheduler is not None:
+                budget = scheduler.status(fan)
+                if budget['limit'] and budget['remaining'] <= 0 and budget['reset_at'] > time.time():
+                    break
+            with self._cond:
+                row = self._db.execute('SELECT id FROM outbox WHERE account = ? AND state = ? ORDER BY id LIMIT 1',
+                                       (self._account(fan), self.PENDING)).fetchone()
+            if row is None:
+                break
+            try:
+                self.deliver(fan, Delivery(row[0], self.PENDING))
+            except QueuedError:
+                break
+            except FanfouError as e:
+                if e.delivery.state != self.FAILED:
+                    break
+                continue
+            sent += 1
+        return sent
 
-    @property
-    @log
-    def trends(self):
-        return self.get('trends/list')
+    def run(self):
+        while True:
+            with self._cond:
+                if self._running:
+                    self._cond.wait(self.interval)
+                if not self._running:
+                    return
+                fans = list(self._fans)
+            for fan in fans:
+                try:
+                    self.flush(fan)
+                except Exception:
+                    logger.exception('Failed to flush outbox')
 
+    def stop(self):
+        """停止后台线程"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
 
-class Base:
+    def __len__(self):
+        with self._cond:
+            return self._db.execute('SELECT COUNT(*) FROM outbox WHERE state IN (?, ?)',
+                                    (self.PENDING, self.SENDING)).fetchone()[0]
+
+
+@functools.lru_cache(maxsize=4096)
+def _escape(s):
+    # RFC 5849 3.6，与 oauthlib.oauth1.rfc5849.utils.escape 相同
+    return quote(s, safe='~')
+
+
+@functools.lru_cache(maxsize=4096)
+def _escape_pair(key, value):
+    return _escape(key), _escape(value)
+
+
+@functools.lru_cache(maxsize=64)
+def _base_uri(url):
+    # RFC 5849 3.4.1.2
+    parts = urlparse(url)
+    scheme, netloc = parts.scheme.lower(), parts.netloc.lower()
+    host, _, port = netloc.rpartition(':')
+    if (scheme, port) in (('http', '80'), ('https', '443')):
+        netloc = host
+    return _escape('{}://{}{}'.format(scheme, netloc, parts.path or '/').replace(' ', '%20'))
+
+
+class _FastSigner:
     """
-    :class:`User` 和 :class:`Status` 的基类。
-    为子类提供对象缓存和自动加载功能。
+    HMAC-SHA1 签名的快速实现，结果与 oauthlib 完全一致。
+    签名密钥和固定的 oauth 参数只计算一次，每次请求只编码变化的参数。
     """
-    endpiont = None
-    attrs = ('id',)
 
-    def __init__(self, fan, **kwargs):
-        self.fan = fan  # type: Fan
-        self.dict = kwargs  # type: dict
+    _random = random.SystemRandom()
 
-    def __getattr__(self, item):
-        if item in self.attrs:
-            if item not in self.dict:
-                id = self.dict.get('id')
-                result = self.fan.get(self.endpiont, id=id)
-                self.dict.update(result.copy())
-            return self.dict.get(item)
-        raise AttributeError
+    def __init__(self, client):
+        self.key = '{}&{}'.format(_escape(client.client_secret or ''),
+                                  _escape(client.resource_owner_secret or '')).encode('utf8')
+        static = [('oauth_version', '1.0'),
+                  ('oauth_signature_method', client.signature_method),
+                  ('oauth_consumer_key', client.client_key)]
+        if client.resource_owner_key:
+            static.append(('oauth_token', client.resource_owner_key))
+        self._static = [_escape_pair(k, v) for k, v in static]
+        self._header = ', '.join('{}="{}"'.format(k, v) for k, v in self._static)
 
-    @classmethod
-    def from_json(cls, fan, data):
-        if not data:
-            return None
+    @staticmethod
+    def supports(client):
+        """只处理普通的 HMAC-SHA1 头部签名，授权流程等其他情况交给 oauthlib"""
+        return (client.signature_method == 'HMAC-SHA1' and client.signature_type == 'AUTH_HEADER'
+                and not (client.callback_uri or client.verifier or client.realm or client.nonce or client.timestamp))
+
+    @staticmethod
+    def _pairs(source):
+        # 与 requests 编码 params 和表单 data 的方式一致：跳过 None，展开列表
+        for key, values in (source or {}).items():
+            if isinstance(values, (str, bytes)) or not hasattr(values, '__iter__'):
+                values = (values,)
+            for value in values:
+                if value is not None:
+                    yield _escape_pair(_to_str(key), _to_str(value) if isinstance(value, bytes) else str(value))
+
+    def sign(self, method, url, params=None, data=None, nonce=None, timestamp=None):
+        """
+        :param params: 查询参数
+        :param data: 表单参数，multipart 请求的参数不参与签名，不应使用此方法
+        :return: Authorization 头部
+        :rtype: str
+        """
+        timestamp = timestamp or str(int(time.time()))
+        nonce = nonce or str(self._random.getrandbits(64)) + timestamp
+        pairs = self._static + [('oauth_nonce', _escape(nonce)), ('oauth_timestamp', _escape(timestamp))]
+        pairs.extend(self._pairs(params))
+        pairs.extend(self._pairs(data))
+        pairs.sort()
+        normalized = '&'.join(k + '=' + v for k, v in pairs)
+        base = '{}&{}&{}'.format(_escape(method.upper()), _base_uri(url), _escape(normalized))
+        digest = hmac.new(self.key, base.encode('utf8'), hashlib.sha1).digest()
+        return 'OAuth oauth_nonce="{}", oauth_timestamp="{}", {}, oauth_signature="{}"'.format(
+            _escape(nonce), _escape(timestamp), self._header, _escape(base64.b64encode(digest).decode('ascii')))
 
-        data = data.copy()
-        return cls(fan, **data)
 
-    @classmethod
-    def from_id(cls, fan, id=None):
-        result = fan.get(cls.endpiont, id=id)
-        return cls.from_json(fan, result)
+def _signed(request):
+    # 已经由 _FastSigner 签名，阻止 session 上的 OAuth1 再签名一次
+    return request
 
-    def to_dict(self):
-        return self.dict
 
+class _Account:
+    """:class:`RequestScheduler` 中一个账号的请求额度"""
 
-class Timeline:
+    __slots__ = ('limit', 'remaining', 'reset_at', 'synced_at', 'syncing', 'waiting')
+
+    def __init__(self):
+        self.limit = self.remaining = 0
+        self.reset_at = self.synced_at = 0.0
+        self.syncing = False
+        self.waiting = []  # (priority, seq)
+
+
+class RequestScheduler:
     """
-    时间线管理类
+    按账号调度 :meth:`Fan.request`。每个账号一个令牌桶，额度从 `account/rate_limit_status` 获取并定期校准；
+    额度用完时请求排队等待下一个周期，而不是失败。排队的请求按优先级发出，数值越小越优先::
+
+        scheduler = RequestScheduler()
+        fan = Fan(key, secret, token, scheduler=scheduler)
+        with fan.priority(RequestScheduler.BACKGROUND):
+            crawl(fan)
+
+    写操作默认使用 :attr:`INTERACTIVE`，读操作默认使用 :attr:`NORMAL`。
+    饭否的额度每小时重置一次，所以令牌在 `reset_time` 时一次补满，而不是匀速补充。
+
+    :param int default_limit: 无法获取额度时假定的每小时请求数
+    :param float sync_interval: 与服务器校准额度的间隔（秒），同一账号在其他地方也有请求时，本地计数会偏多
+    :param int max_requeues: 因超出额度失败的请求最多重新排队的次数，超过后抛出原来的异常
+    :param float backoff: 因超出额度失败后至少等待的秒数，重置时间更晚时等到重置时间
     """
 
-    def __init__(self, fan, user_id, endpoint):
-        self.fan = fan
-        self.user_id = user_id  # type:User
-        """:class:`~van.User` 时间线的主人"""
-        self.endpoint = endpoint
-        self._pool = []  # type: [Status]
-        self._max_id = None
-        self._max_rawid = -1
-        self._since_id = None
-        self._since_rawid = 1 << 32  # 什么时候饭否消息会达到这个数字呢？
-        self._curr = 0
+    INTERACTIVE = 0
+    NORMAL = 1
+    BACKGROUND = 2
 
-    def tell(self):
+    RATE_LIMIT_ENDPOINT = 'account/rate_limit_status'
+    RATE_LIMIT_MESSAGES = ('rate limit',)
+
+    def __init__(self, default_limit=150, sync_interval=300.0, max_requeues=3, backoff=60.0):
+        self.default_limit = default_limit
+        self.sync_interval = sync_interval
+        self.max_requeues = max_requeues
+        self.backoff = backoff
+        self._accounts = {}
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+
+    @staticmethod
+    def _key(fan):
+        client = fan.session._client.client
+        return client.client_key, client.resource_owner_key
+
+    def _account(self, fan):
+        key = self._key(fan)
+        account = self._accounts.get(key)
+        if account is None:
+            account = self._accounts[key] = _Account()
+        return account
+
+    def _sync(self, fan, account):
+        # 在锁外发出请求，查询额度本身不消耗额度
+        now = time.time()
+        try:
+            rv = fan.request('GET', self.RATE_LIMIT_ENDPOINT)
+            limit, remaining = int(rv['hourly_limit']), int(rv['remaining_hits'])
+            reset_at = float(rv.get('reset_time_in_seconds') or parse_time(rv['reset_time']))
+        except (FanfouError, KeyError, TypeError, ValueError) as e:
+            logger.warning('Failed to sync rate limit status: %r', e)
+            limit = account.limit or self.default_limit
+            remaining = account.remaining if account.limit else limit
+            reset_at = account.reset_at if account.reset_at > now else now + 3600
+        with self._cond:
+            account.limit, account.remaining = limit, remaining
+            # 防止本地时钟偏差导致反复校准
+            account.reset_at = max(reset_at, now + 1)
+            account.synced_at = now
+            account.syncing = False
+            self._cond.notify_all()
+
+    def acquire(self, fan, priority=NORMAL, blocking=True):
         """
-        返回当前游标的位置
+        等到账号有剩余额度并且没有更优先的请求排队，然后占用一次额度
 
-        :rtype: int
+        :param Fan fan: 发出请求的账号
+        :param int priority: 优先级，数值越小越优先
+        :param bool blocking: 为 False 时不等待，额度用完、有请求排队或者需要校准额度时直接返回 False
+        :return: 是否占用了额度
+        :rtype: bool
         """
-        return self._curr
+        with self._cond:
+            account = self._account(fan)
+            if not blocking:
+                now = time.time()
+                if (account.syncing or account.waiting or account.remaining <= 0 or now >= account.reset_at or
+                        now - account.synced_at >= self.sync_interval):
+                    return False
+                account.remaining -= 1
+                return True
+            ticket = (priority, next(self._seq))
+            heapq.heappush(account.waiting, ticket)
+            try:
+                while True:
+                    now = time.time()
+                    if account.syncing:
+                        self._cond.wait()
+                        continue
+                    if now >= account.reset_at or now - account.synced_at >= self.sync_interval:
+                        account.syncing = True
+                        self._cond.release()
+                        try:
+                            self._sync(fan, account)
+                        finally:
+                            self._cond.acquire()
+                        continue
+                    if account.remaining > 0 and account.waiting[0] == ticket:
+                        heapq.heappop(account.waiting)
+                        account.remaining -= 1
+                        self._cond.notify_all()
+                        return True
+                    self._cond.wait(account.reset_at - now if account.remaining <= 0 else None)
+            except BaseException:
+                if ticket in account.waiting:
+                    account.waiting.remove(ticket)
+                    heapq.heapify(account.waiting)
+                    self._cond.notify_all()
+                raise
 
-    def rewind(self):
+    @classmethod
+    def is_rate_limited(cls, error):
+        """请求是否因为超出额度而失败"""
+        if not isinstance(error, ApiRequestError):
+            return False
+        message = str(error).lower()
+        return error.status_code == 429 or any(text in message for text in cls.RATE_LIMIT_MESSAGES)
+
+    def limited(self, fan, error):
         """
-        获取最新的状态插入到时间线的头部，并将指针置为0（指向最新的状态）
+        请求失败后调用。因超出额度失败时清空本地额度，等到重置时间（至少 `backoff` 秒）后重新校准
 
-        :rtype: int
+        :return: 请求是否应该重新排队
+        :rtype: bool
         """
-        self._fetch_newer()
-        self._curr = 0
-        return 0
+        if not self.is_rate_limited(error):
+            return False
+        with self._cond:
+            account = self._account(fan)
+            account.remaining = 0
+            # 服务器可能仍然报告有剩余额度，立即校准会让请求不停地重发
+            account.reset_at = max(account.reset_at, time.time() + self.backoff)
+            self._cond.notify_all()
+        return True
+
+    def status(self, fan):
+        """
+        账号当前的额度
 
-    def seek(self, offset=None, whence=0):
+        :return: `limit`, `remaining`, `reset_at` （Unix 时间戳）和排队中的请求数 `waiting`
+        :rtype: dict
         """
-        移动游标的位置
+        with self._cond:
+            account = self._account(fan)
+            return dict(limit=account.limit, remaining=account.remaining, reset_at=account.reset_at,
+                        waiting=len(account.waiting))
 
-        :param int offset: 偏移量
-        :param int whence: 相对位置
 
-            * 0 -- 相对于时间线开始位置，偏移量必须 >= 0
-            * 1 -- 相对于当前游标位置，偏移量可正可负，超出范围的偏移量会被纠正为边界值
-            * 2 -- 相对于时间线结尾，偏移量 <=0
+def _transient(error):
+    """网络错误和 5xx 响应是暂时的故障，熔断器拒绝的请求没有发出，不算在内"""
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, NetworkError):
+        return True
+    return isinstance(error, ApiRequestError) and (error.status_code or 0) >= 500
 
-        .. attention::
 
-            此函数只能在有限范围满足索引要求，超出范围太多的偏移量会被自动纠正为合法值。
+def _in_thread(fn, *args):
+    """在新的守护线程中调用 `fn(*args)`，返回 Future。不使用线程池，没有需要关闭的线程"""
+    future = Future()
 
-        :return: 移动后的游标位置
-        :rtype: int
-        """
-        if not self._pool:
-            self._fetch_older()
+    def run():
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
 
-        if whence == 0:
-            if offset < 0:
-                raise ValueError('offset should be zero or positive while whence=0')
-            self._curr = min(offset, max(len(self._pool) - 1, 0))
-        elif whence == 1:
-            self._curr += offset
-            self._curr = min(max(self._curr, 0), len(self._pool) - 1)
-        else:
-            if offset > 0:
-                raise ValueError('offset should be zero or negative while whence=2')
-            else:
-                self._curr = max(len(self._pool) + offset, 0)
-        return self._curr
+    threading.Thread(target=run, daemon=True).start()
+    return future
 
-    def read(self, count=10):
-        """
-        从当前游标位置处往后读取 `count` 条消息, 数组长度可能小于要求的大小。
 
-        :param int count: 读取数量
-        :return: :class:`Status` 数组
-        :rtype: [Status]
-        """
-        while self._curr + count >= len(self._pool):
-            if self._fetch_older() == 0:
-                break
-        rv = self._pool[self._curr:self._curr + count]
-        self._curr += len(rv)
-        return rv
+class _Latency:
+    """一个接口最近 `size` 次成功请求的耗时"""
 
-    def fetch(self, since_id=None, max_id=None, count=60):
-        """
-        调用 API 获取数据。
-        可以自己控制 `since_id`, `max_id` 和 `count` 参数，获取的结果不加入内部缓存。
+    __slots__ = ('samples', '_sorted')
 
-        :param since_id: 开始的消息ID
-        :param max_id: 结束的消息ID
-        :param count: 获取数量，最大为60
-        :return: :class:`Status` 数组
-        :rtype: [Status]
-        """
-        rv = self.fan.get(self.endpoint, id=self.user_id,
-                          since_id=since_id, max_id=max_id, count=count)
-        return [Status.from_json(self.fan, s) for s in rv]
+    def __init__(self, size):
+        self.samples = collections.deque(maxlen=size)
+        self._sorted = None
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self._sorted = None
+
+    def percentile(self, p):
+        if self._sorted is None:
+            self._sorted = sorted(self.samples)
+        return self._sorted[min(len(self._sorted) - 1, int(p * len(self._sorted)))]
+
+
+class RetryPolicy:
+    """
+    :meth:`Fan.request` 的重试策略，只重试幂等的 GET 请求。
+    网络错误、超时和 5xx 响应按指数退避加随机抖动重试；
+    根据每个接口最近的耗时收紧读超时，并且可以在请求慢于 p95 时再发一份相同的请求（hedged request），
+    先返回的结果有效::
+
+        fan = Fan(key, secret, token, retry=RetryPolicy(retries=3, hedge=True))
+        fan.retry.stats()
+
+    :param int retries: 最多重试次数
+    :param float backoff: 第一次重试前的等待秒数
+    :param float max_backoff: 重试等待的上限（秒）
+    :param tuple timeout: 默认的 (连接超时, 读超时)，也是自适应读超时的上限
+    :param bool adaptive: 是否根据耗时自动调整读超时
+    :param float min_timeout: 自适应读超时的下限（秒）
+    :param bool hedge: 是否对慢请求发出第二份请求
+    :param int window: 每个接口保留的耗时样本数
+    :param int min_samples: 样本数达到此值后才调整超时和发出第二份请求
+
+    设置了 :attr:`Fan.scheduler` 时，每次重试和第二份请求都要占用一次额度；
+    额度不足时不发出第二份请求，只等待第一份。
+    """
+
+    timeout_factor = 3.0
+
+    def __init__(self, retries=2, backoff=0.5, max_backoff=8.0, timeout=(5, 5), adaptive=True, min_timeout=1.0,
+                 hedge=False, window=200, min_samples=20):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.default_timeout = timeout
+        self.adaptive = adaptive
+        self.min_timeout = min_timeout
+        self.hedge = hedge
+        self.window = window
+        self.min_samples = min_samples
+        self._latency = {}
+        self._counters = collections.defaultdict(collections.Counter)
+        self._lock = threading.Lock()
+
+    def _percentile(self, endpoint, p):
+        with self._lock:
+            latency = self._latency.get(endpoint)
+            if latency is None or len(latency.samples) < self.min_samples:
+                return None
+            return latency.percentile(p)
+
+    def _record(self, endpoint, seconds):
+        with self._lock:
+            latency = self._latency.get(endpoint)
+            if latency is None:
+                latency = self._latency[endpoint] = _Latency(self.window)
+            latency.add(seconds)
+
+    def _count(self, endpoint, key):
+        with self._lock:
+            self._counters[endpoint][key] += 1
+
+    def timeout(self, endpoint):
+        """接口当前使用的 (连接超时, 读超时)"""
+        connect, read = self.default_timeout
+        p99 = self._percentile(endpoint, 0.99) if self.adaptive else None
+        if p99 is not None:
+            read = min(read, max(self.min_timeout, p99 * self.timeout_factor))
+        return connect, read
+
+    def hedge_delay(self, endpoint):
+        """请求耗时超过此秒数时发出第二份请求，样本不足时返回 `None`"""
+        return self._percentile(endpoint, 0.95) if self.hedge else None
+
+    def retryable(self, error):
+        """网络错误和 5xx 响应可以重试"""
+        return _transient(error)
+
+    def call(self, method, endpoint, send, timeout=None, acquire=None):
+        """
+        按策略调用 `send`
+
+        :param send: 接受超时参数、发出一次请求的函数，每次重试都会重新签名
+        :param timeout: 调用方指定的超时，指定后不再自适应调整
+        :param acquire: 第一次之后每次调用 `send` 前占用额度的函数。重试前以 `acquire()` 等到有额度；
+            第二份请求前以 `acquire(blocking=False)` 调用，返回 False 时不发出
+        """
+        if method.upper() != 'GET':
+            return send(timeout or self.default_timeout)
+
+        self._count(endpoint, 'requests')
+        failures = 0
+        while True:
+            try:
+                return self._attempt(endpoint, send, timeout, acquire)
+            except FanfouError as e:
+                if not self.retryable(e) or failures >= self.retries:
+                    self._count(endpoint, 'failures')
+                    raise
+                failures += 1
+                self._count(endpoint, 'retries')
+                logger.debug('Retrying %s after %r (%d/%d)', endpoint, e, failures, self.retries)
+                time.sleep(_backoff(self.backoff, self.max_backoff, failures - 1))
+                if acquire is not None:
+                    acquire()
+
+    def _attempt(self, endpoint, send, timeout, acquire=None):
+        delay = self.hedge_delay(endpoint)
+        timeout = timeout or self.timeout(endpoint)
+        start = time.monotonic()
+        if delay is None:
+            rv = send(timeout)
+            self._record(endpoint, time.monotonic() - start)
+            return rv
+
+        first = _in_thread(send, timeout)
+        done, _ = wait([first], timeout=delay)
+        if not done and acquire is not None and not acquire(blocking=False):
+            # 额度不足，第二份请求会占用排队请求的额度
+            self._count(endpoint, 'hedge_skips')
+            wait([first])
+            done = {first}
+        if done:
+            rv = first.result()
+            self._record(endpoint, time.monotonic() - start)
+            return rv
+
+        # 第一份请求慢于 p95，再发一份，先成功的有效
+        self._count(endpoint, 'hedges')
+        second = _in_thread(send, timeout)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self._count(endpoint, 'hedge_wins')
+                    self._record(endpoint, time.monotonic() - start)
+                    return future.result()
+        return first.result()
+
+    def stats(self):
+        """
+        每个接口的计数：`requests`, `retries`, `failures`, `hedges`, `hedge_wins` （第二份请求先返回）
+        和 `hedge_skips` （额度不足没有发出第二份请求）
+
+        :rtype: dict
+        """
+        with self._lock:
+            rv = {}
+            for endpoint, counter in self._counters.items():
+                latency = self._latency.get(endpoint)
+                rv[endpoint] = dict(counter, samples=len(latency.samples) if latency else 0)
+            return rv
+
+
+class _Circuit:
+    """:class:`CircuitBreaker` 中一个接口的状态"""
+
+    __slots__ = ('state', 'failures', 'opened_at', 'trials')
+
+    def __init__(self):
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trials = 0
+
+
+class CircuitBreaker:
+    """
+    按接口熔断。接口连续 `threshold` 次网络错误或 5xx 响应后打开，之后的请求立即抛出 :class:`CircuitOpenError`，
+    不再等待超时；`reset_timeout` 秒后进入半开状态，放行少量试探请求，试探成功则关闭，失败则重新打开::
+
+        breaker = CircuitBreaker(threshold=5, reset_timeout=30)
+        fan = Fan(key, secret, token, breaker=breaker)
+        breaker.state('statuses/update')
+
+    :param int threshold: 打开前允许的连续失败次数
+    :param float reset_timeout: 打开后等待多少秒进入半开状态
+    :param int half_open_trials: 半开状态下同时放行的试探请求数
+    :param on_change: 状态变化时调用的函数，参数为 `(endpoint, old_state, new_state)`
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=5, reset_timeout=30.0, half_open_trials=1, on_change=None):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_trials = half_open_trials
+        self.on_change = on_change
+        self._circuits = collections.defaultdict(_Circuit)
+        self._lock = threading.Lock()
+
+    def _transition(self, endpoint, circuit, state):
+        # 调用方持有锁，返回需要在锁外通知的变化
+        old, circuit.state = circuit.state, state
+        if state == self.OPEN:
+            circuit.opened_at = time.monotonic()
+        circuit.trials = 0
+        return endpoint, old, state
+
+    def _notify(self, change):
+        if change is None:
+            return
+        logger.warning('Circuit for %s: %s -> %s', *change)
+        if self.on_change is not None:
+            self.on_change(*change)
+
+    def before(self, endpoint):
+        """
+        请求发出前调用，熔断器打开时抛出 :class:`CircuitOpenError`
+
+        :return: 此请求是否为半开状态下的试探请求
+        :rtype: bool
+        """
+        change = None
+        with self._lock:
+            circuit = self._circuits[endpoint]
+            if circuit.state == self.OPEN:
+                if time.monotonic() - circuit.opened_at < self.reset_timeout:
+                    raise CircuitOpenError(endpoint)
+                change = self._transition(endpoint, circuit, self.HALF_OPEN)
+            trial = circuit.state == self.HALF_OPEN
+            if trial:
+                if circuit.trials >= self.half_open_trials:
+                    raise CircuitOpenError(endpoint)
+                circuit.trials += 1
+        self._notify(change)
+        return trial
+
+    def failed(self, error):
+        """网络错误和 5xx 响应计为失败，其他错误说明服务器工作正常"""
+        return _transient(error)
+
+    def record(self, endpoint, error=None):
+        """请求结束后调用，`error` 为 `None` 表示成功"""
+        change = None
+        with self._lock:
+            circuit = self._circuits[endpoint]
+            if error is None or not self.failed(error):
+                circuit.failures = 0
+                if circuit.state == self.HALF_OPEN:
+                    change = self._transition(endpoint, circuit, self.CLOSED)
+            else:
+                circuit.failures += 1
+                if circuit.state == self.HALF_OPEN or (circuit.state == self.CLOSED
+                                                       and circuit.failures >= self.threshold):
+                    change = self._transition(endpoint, circuit, self.OPEN)
+        self._notify(change)
+
+    def call(self, endpoint, send):
+        """经过熔断器调用 `send`"""
+        trial = self.before(endpoint)
+        try:
+            rv = send()
+        except FanfouError as e:
+            self.record(endpoint, e)
+            raise
+        except BaseException:
+            # 与服务器状态无关的异常，只归还试探名额
+            if trial:
+                with self._lock:
+                    circuit = self._circuits[endpoint]
+                    circuit.trials = max(0, circuit.trials - 1)
+            raise
+        self.record(endpoint)
+        return rv
+
+    def state(self, endpoint):
+        """
+        接口当前的状态：:attr:`CLOSED`, :attr:`OPEN` 或 :attr:`HALF_OPEN`。
+        打开超过 `reset_timeout` 的接口在下一次请求时才会变为半开状态。
+        """
+        with self._lock:
+            circuit = self._circuits.get(endpoint)
+            return circuit.state if circuit is not None else self.CLOSED
+
+    def states(self):
+        """
+        所有请求过的接口的状态
+
+        :return: 接口到 `state`, `failures` 的映射
+        :rtype: dict
+        """
+        with self._lock:
+            return {endpoint: dict(state=circuit.state, failures=circuit.failures)
+                    for endpoint, circuit in self._circuits.items()}
+
+    def reset(self, endpoint=None):
+        """手动关闭一个接口的熔断器，`endpoint` 为 `None` 时关闭全部"""
+        with self._lock:
+            if endpoint is None:
+                self._circuits.clear()
+            else:
+                self._circuits.pop(endpoint, None)
+
+
+class Fan:
+    """
+    API操作入口
+    """
+
+    def __init__(self, consumer_key, consumer_secret, oauth_token=None, mobile=False, prefetch=0, cache=None,
+                 identity_map=False, store=None, transport=None, scheduler=None, retry=None, breaker=None,
+                 outbox=None):
+        """
+        :param int prefetch: :func:`pager` 和 :class:`Timeline` 默认的预读页数，0 表示不预读
+        :param Cache cache: GET 请求的响应缓存，`None` 表示不缓存
+        :param bool identity_map: 为 `True` 时，相同 id 的 :class:`User` 和 :class:`Status` 共享同一个对象
+        :param TimelineStore store: :class:`Timeline` 默认使用的持久化存储，`None` 表示不保存
+        :param Transport transport: 与其他 Fan 共享的连接池，`None` 表示使用自己的连接
+        :param RequestScheduler scheduler: 按额度和优先级调度请求，`None` 表示立即发出
+        :param RetryPolicy retry: GET 请求的重试策略，`None` 表示不重试
+        :param CircuitBreaker breaker: 按接口熔断，`None` 表示不熔断
+        :param Outbox outbox: :meth:`update_status` 使用的持久化发件箱，`None` 表示发送失败的消息只保存在 `draft_box` 中
+        """
+        self._consumer_key = consumer_key
+        self._consumer_secret = consumer_secret
+        self._oauth_token = oauth_token
+        self._session = OAuth1Session(consumer_key, consumer_secret)
+        if oauth_token:
+            self._session._populate_attributes(oauth_token)
+        self._request_token = None
+        self._oauth_type = None
+
+        self.request_token_url = 'http://fanfou.com/oauth/request_token'
+        self.authorize_url = 'http://fanfou.com/oauth/authorize'
+        self.access_token_url = 'http://fanfou.com/oauth/access_token'
+        self.api_url = 'http://api.fanfou.com/{}.json'
+        if mobile:
+            self.authorize_url = 'http://m.fanfou.com/oauth/authorize'
+
+        self.prefetch = prefetch
+        self.cache = cache  # type: Cache
+        self.store = store  # type: TimelineStore
+        self.transport = transport  # type: Transport
+        self.scheduler = scheduler  # type: RequestScheduler
+        self.retry = retry  # type: RetryPolicy
+        self.breaker = breaker  # type: CircuitBreaker
+        self.outbox = outbox  # type: Outbox
+        if outbox is not None:
+            outbox.register(self)
+        self._priority = threading.local()
+        self.identities = weakref.WeakValueDictionary() if identity_map else None
+        self._identities_lock = threading.Lock()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._me = None
+        self._signer_state = None
+        self.draft_box = []
+        self.mentions = Timeline(self, None, 'statuses/mentions')
+        self.replies = Timeline(self, None, 'statuses/replies')
+        self.public_timeline = Timeline(self, None, 'statuses/public_timeline')
+
+    @property
+    def session(self):
+        """获取session"""
+        return self._session
+
+    def authorization_url(self, oauth_callback='oob'):
+        """
+        引导用户访问的授权页面URL
+        当 oauth_callback = 'oob' 时表示使用 PIN码授权
+        """
+        self._oauth_type = oauth_callback
+        token = self._session.fetch_request_token(self.request_token_url)
+        self._request_token = token
+        url = self._session.authorization_url(self.authorize_url, oauth_callback=oauth_callback)
+        return url
+
+    def oauth(self, pin_code=None, redirect_url=None):
+        """通过授权后的PIN码或者浏览器重定向的URL获取最终的token"""
+        if pin_code and redirect_url:
+            raise ValueError('pin_code and redirect_url are mutually exclusive')
+        if pin_code:
+            token = self._session.fetch_access_token(self.access_token_url, verifier=pin_code)
+        elif redirect_url:
+            self._session.parse_authorization_response(redirect_url)
+            token = self._session.fetch_access_token(self.access_token_url, verifier='x')
+        else:
+            raise ValueError('Either pin_code nor redirect_url is valid')
+        self._oauth_token = token
+        self._session._populate_attributes(token)
+        return token
+
+    def xauth(self, username, password):
+        import oauthlib.oauth1.rfc5849.utils
+        # patch to allow x_auth_* params
+        oauthlib.oauth1.rfc5849.utils.filter_oauth_params = lambda _: _
+
+        client = self._session._client.client
+
+        class OAuth1Client(oauthlib.oauth1.rfc5849.Client):
+            def get_oauth_params(self, request):
+                params = super().get_oauth_params(request)
+                args = [
+                    ('x_auth_username', username),
+                    ('x_auth_password', password),
+                    ('x_auth_mode', 'client_auth')
+                ]
+                params += args
+                return params
+
+        sess = OAuth1Session(client.client_key, client.client_secret, client_class=OAuth1Client)
+        token = sess.fetch_access_token(self.access_token_url, verifier='x')
+        self._oauth_token = token
+        self._session._populate_attributes(token)
+        return token
+
+    @property
+    def authorized(self):
+        """当前会话是否已授权"""
+        return self._session.authorized
+
+    def _signer(self):
+        # 凭据在授权后会变化，凭据不变时复用同一个签名器
+        client = self._session._client.client
+        key = (client.client_key, client.client_secret, client.resource_owner_key, client.resource_owner_secret)
+        state = self._signer_state
+        if state is None or state[0] != key:
+            state = self._signer_state = (key, _FastSigner(client) if _FastSigner.supports(client) else None)
+        return state[1]
+
+    @contextlib.contextmanager
+    def priority(self, level):
+        """
+        当前线程在 `with` 语句中发出的请求使用指定的优先级::
+
+            with fan.priority(RequestScheduler.BACKGROUND):
+                ...
+
+        :param int level: :attr:`RequestScheduler.INTERACTIVE` 等优先级
+        """
+        previous = getattr(self._priority, 'level', None)
+        self._priority.level = level
+        try:
+            yield
+        finally:
+            self._priority.level = previous
+
+    def request(self, method, endpoint, params=None, data=None, files=None, **kwargs):
+        """发出请求，设置了 :attr:`scheduler` 时先排队等待额度，超出额度的请求重新排队"""
+        scheduler = self.scheduler
+        if scheduler is None or endpoint == scheduler.RATE_LIMIT_ENDPOINT:
+            return self._call(method, endpoint, params, data, files, **kwargs)
+
+        level = self._level(method)
+        for requeues in itertools.count():
+            scheduler.acquire(self, level)
+            try:
+                return self._call(method, endpoint, params, data, files, **kwargs)
+            except ApiRequestError as e:
+                if not scheduler.limited(self, e) or requeues >= scheduler.max_requeues:
+                    raise
+
+    def _level(self, method):
+        level = getattr(self._priority, 'level', None)
+        if level is None:
+            level = self.scheduler.NORMAL if method.upper() == 'GET' else self.scheduler.INTERACTIVE
+        return level
+
+    def _call(self, method, endpoint, params=None, data=None, files=None, **kwargs):
+        if self.breaker is not None:
+            return self.breaker.call(endpoint, lambda: self._retry(method, endpoint, params, data, files, **kwargs))
+        return self._retry(method, endpoint, params, data, files, **kwargs)
+
+    def _retry(self, method, endpoint, params=None, data=None, files=None, **kwargs):
+        if self.retry is None:
+            return self._send(method, endpoint, params, data, files, **kwargs)
+
+        def send(timeout):
+            return self._send(method, endpoint, params, data, files, **dict(kwargs, timeout=timeout))
+
+        # 第一次请求已经在 request 中占用了额度，重试和第二份请求需要另外占用
+        scheduler = self.scheduler
+        acquire = None
+        if scheduler is not None and endpoint != scheduler.RATE_LIMIT_ENDPOINT:
+            acquire = functools.partial(scheduler.acquire, self, self._level(method))
+        return self.retry.call(method, endpoint, send, kwargs.pop('timeout', None), acquire)
+
+    def _send(self, method, endpoint, params=None, data=None, files=None, **kwargs):
+        # 1-tuple (not a tuple at all)
+        # {fieldname: file_object}
+        # 2-tuple
+        # {fieldname: (filename, file_object)}
+        # 3-tuple
+        # {fieldname: (filename, file_object, content_type)}
+        # 4-tuple
+        # {fieldname: (filename, file_object, content_type, headers)}
+        kwargs.setdefault('timeout', (5, 5))
+        url = self.api_url.format(endpoint)
+
+        auth = self._session.auth
+        signer = self._signer() if files is None else None
+        if signer is not None and isinstance(params, (dict, type(None))) and isinstance(data, (dict, type(None))):
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, Authorization=signer.sign(method, url, params, data))
+            auth = _signed
+
+        try:
+            if self.transport is not None:
+                response = self.transport.request(method, url, auth=auth,
+                                                  params=params, data=data, files=files, **kwargs)
+            else:
+                response = self._session.request(method, url, auth=auth,
+                                                 params=params, data=data, files=files, **kwargs)
+        except requests.Timeout:
+            raise Timeout
+        except requests.ConnectionError:
+            raise NetworkError
+        else:
+            try:
+                json_data = response.json()
+            except ValueError:
+                raise ApiRequestError('Invalid server response', status_code=response.status_code)
+            if response.status_code == 200:
+                return json_data
+            if json_data.get('error'):
+                raise ApiRequestError(json_data['error'], status_code=response.status_code)
+            raise ApiRequestError('Invalid error response', status_code=response.status_code)
+
+    def get(self, endpoint, **params):
+        params.setdefault('mode', 'lite')
+        params.setdefault('format', 'html')
+        cache = self._cache_for(endpoint)
+        if cache is not None:
+            rv = cache.get(endpoint, params)
+            if rv is not _MISSING:
+                return rv
+        rv = self.request('GET', endpoint, params=params)
+        if cache is not None:
+            cache.set(endpoint, params, rv)
+        return rv
+
+    def _load_once(self, endpoint, id):
+        # 合并对同一对象的并发加载请求
+        key = (endpoint, id)
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            rv = self.get(endpoint, id=id)
+        except BaseException as e:
+            # KeyboardInterrupt 等也要通知等待者，否则它们会一直阻塞
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(rv)
+            return rv
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+    def hydrate(self, objects, attrs=None, workers=8):
+        """
+        并发加载一组 :class:`User` 或 :class:`Status` 对象缺失的属性::
+
+            users = [User.from_json(fan, {'id': id}) for id in me.followers_id]
+            fan.hydrate(users, attrs=('description',))
+
+        :param objects: 需要加载的对象
+        :param attrs: 需要的属性，已经拥有这些属性的对象会被跳过；
+            省略时跳过已经加载过或属性完整的对象
+        :param int workers: 同时进行的请求数
+        :return: `objects`
+        """
+        objects = list(objects)
+        groups = collections.OrderedDict()
+        for obj in objects:
+            if not obj._filled(attrs):
+                groups.setdefault((obj.endpiont, obj._raw('id')), []).append(obj)
+
+        def load(key):
+            result = self._load_once(*key)
+            for obj in groups[key]:
+                obj._update(result)
+                obj._loaded = True
+
+        if groups:
+            with ThreadPoolExecutor(min(workers, len(groups))) as pool:
+                list(pool.map(load, groups))
+        return objects
+
+    def _cache_for(self, endpoint):
+        if self.cache is not None and self.cache.ttl(endpoint):
+            return self.cache
+        return None
+
+    def invalidate(self, endpoint, *ids):
+        """
+        使 `endpoint` 接口的缓存失效，写操作之后调用
+
+        :param ids: 只删除这些 id 对应的条目，省略时删除此接口的所有条目
+        """
+        if self.cache is not None:
+            self.cache.invalidate(endpoint, *ids)
+
+    def _user_changed(self, user):
+        # 关注、屏蔽等操作会同时改变对方和自己的资料以及双方关系
+        me = self._me._raw('id') if self._me is not None else None
+        self.invalidate('users/show', user, None, me)
+        self.invalidate('friendships/show')
+        self.invalidate('blocks/exists', user)
+
+    def _status_changed(self, *ids):
+        me = self._me._raw('id') if self._me is not None else None
+        self.invalidate('users/show', None, me)
+        ids = [id for id in ids if id]
+        if ids:
+            self.invalidate('statuses/show', *ids)
+        self.invalidate('statuses/context_timeline')
+
+    def post(self, endpoint, files=None, **data):
+        data.setdefault('mode', 'lite')
+        data.setdefault('format', 'html')
+        return self.request('POST', endpoint, data=data, files=files)
+
+    @property
+    def me(self):
+        """获取授权用户的信息"""
+        if self._me is None:
+            me = User.from_id(self)
+            me.mentions = self.mentions
+            me.replies = self.replies
+            self._me = me
+        return self._me
+
+    @log
+    def update_status(self, status, photo=None,
+                      in_reply_to_user_id=None,
+                      in_reply_to_status_id=None,
+                      repost_status_id=None,
+                      location=None,
+                      source=None):
+        """
+        发表新状态，:meth:`Status.send()` 的快捷方式。
+
+        :param str text: 文字
+        :param str photo: 照片路径或者URL
+        :param str in_reply_to_user_id: 要回复的用户ID
+        :param str in_reply_to_status_id: 要回复的消息ID
+        :param str repost_status_id: 要转发的消息ID
+        :param str location: 位置信息，使用'地点名称' 或 '一个半角逗号分隔的经纬度坐标'
+        :param str source: source 消息来源
+
+        设置了 :class:`Outbox` 时，消息先写入发件箱，`in_reply_to_status_id` 和 `repost_status_id` 可以是
+        尚未发出的 :class:`Delivery`；前面还有未发出的消息时抛出 :class:`QueuedError`，稍后按顺序发送。
+        """
+        data = dict(status=status,
+                    in_reply_to_user_id=in_reply_to_user_id,
+                    in_reply_to_status_id=in_reply_to_status_id,
+                    repost_status_id=repost_status_id,
+                    locaion=location, source=source)
+        if self.outbox is not None:
+            delivery = self.outbox.put(self, data, photo)
+            return Status.from_json(self, self.outbox.deliver(self, delivery))
+
+        try:
+            result = self._post_status(data, photo)
+        except FanfouError:
+            data['photo'] = _draft_photo(photo)
+            self.draft_box.append(data)
+            raise
+
+        self._status_changed(in_reply_to_status_id, repost_status_id)
+        return Status.from_json(self, result)
+
+    def _post_status(self, data, photo=None):
+        if isinstance(photo, bytes):
+            photo = io.BytesIO(photo)
+        if photo is not None:
+            # 路径和 URL 先读取为文件对象，下载图片同样走共享连接池
+            upload = get_photo(photo, self.transport)
+            if not upload:
+                raise ValueError('Cannot read photo: {!r}'.format(photo))
+            try:
+                return self.post('photos/upload', files=dict(photo=upload), **data)
+            finally:
+                # 只关闭这里打开的文件和下载连接，调用方传入的文件对象由调用方负责
+                if upload is not photo and hasattr(upload, 'close'):
+                    upload.close()
+        return self.post('statuses/update', **data)
+
+    def resend_draft_box(self):
+        """
+        重新发送之前发送失败的消息。设置了 :class:`Outbox` 时按顺序发送发件箱中到期的消息，
+        否则依次发送 `draft_box` 中的消息，遇到失败时停止
+
+        :return: 成功发送的消息数
+        :rtype: int
+        """
+        if self.outbox is not None:
+            return self.outbox.flush(self)
+
+        sent = 0
+        while self.draft_box:
+            data = dict(self.draft_box[0])
+            photo = data.pop('photo', None)
+            try:
+                self._post_status(data, photo)
+            except FanfouError as e:
+                logger.warning('Failed to resend draft: %r', e)
+                break
+            self.draft_box.pop(0)
+            self._status_changed(data.get('in_reply_to_status_id'), data.get('repost_status_id'))
+            sent += 1
+        return sent
+
+    # 以下是不需要 id 参数，即只能获取当前用户信息的API
+    @log
+    def follow(self, user):
+        """
+        关注用户
+
+        :param User|str user: 被关注的用户, User对象，或id，或 loginname
+        """
+        if isinstance(user, User):
+            user = user.id
+        rs = self.post('friendships/create', id=user)
+        self._user_changed(user)
+        return rs
+
+    @log
+    def unfollow(self, user):
+        """
+        取消关注用户
+
+        :param User|str user: 被关注的用户, User对象，或id，或 loginname
+        """
+        if isinstance(user, User):
+            user = user.id
+        rs = self.post('friendships/destroy', id=user)
+        self._user_changed(user)
+        return rs
+
+    @property
+    @log
+    def follow_requests(self, count=60):
+        """
+        返回请求关注当前用户的列表
+
+        :rtype: (bool, [User])
+        """
+        for fo in pager(self, 'friendships/requests', count=count):
+            yield User.from_json(self, fo)
+
+    @log
+    def accept_follower(self, user):
+        """
+        接受关注请求
+
+        :param User|str user: User对象，或id，或 loginname
+        :rtype: (bool, User)
+        """
+        if isinstance(user, User):
+            user = user.id
+        rv = self.get('friendships/accept', id=user)
+        self._user_changed(user)
+        return rv
+
+    @log
+    def deny_follower(self, user):
+        """
+        拒绝关注请求
+
+        :param User|str user: User对象，或id，或 loginname
+        :rtype: (bool, User)
+        """
+        if isinstance(user, User):
+            user = user.id
+        rv = self.post('friendships/deny', id=user)
+        self._user_changed(user)
+        return rv
+
+    @log
+    def block(self, user):
+        """
+        屏蔽用户
+
+        :param str|User user: 被屏蔽的用户User对象或者id，loginname
+        :rtype: (bool, User)
+        """
+        if isinstance(user, User):
+            user = user.id
+        rs = self.post('blocks/create', id=user)
+        self._user_changed(user)
+        return rs
+
+    @log
+    def unblock(self, user):
+        """
+        解除屏蔽
+
+        :param str|User user: 被屏蔽的用户User对象或者id，loginname
+        :rtype: (bool, str)
+        """
+        if isinstance(user, User):
+            user = user.id
+        rs = self.post('blocks/destroy', id=user)
+        self._user_changed(user)
+        return rs
+
+    def is_blocked(self, user):
+        """
+        检查是否屏蔽用户
+
+        :param str|User user: 用户User对象或者id，loginname
+        :rtype: (bool, str)
+        """
+        if isinstance(user, User):
+            user = user.id
+        return self.get('blocks/exists', id=user)
+
+    @property
+    def blocked_users(self):
+        """
+        返回黑名单上用户列表
+
+        :rtype: (bool, [User])
+        """
+        for bl in pager(self, 'blocks/blocking'):
+            yield User.from_json(self, bl)
+
+    @property
+    @log
+    def blocked_users_id(self):
+        """
+        获取用户黑名单id列表
+
+        :rtype: (bool, [str])
+        """
+        for bl in pager(self, 'blocks/ids'):
+            yield bl
+
+    def fetch_blocked_users_id(self, workers=8, compact=False):
+        """
+        并发获取用户黑名单id列表
+
+        :param int workers: 同时进行的请求数
+        :param bool compact: 为 `True` 时返回去重后的 tuple
+        """
+        return fetch_ids(self, 'blocks/ids', workers, compact)
+
+    @property
+    @log
+    def trends(self):
+        return self.get('trends/list')
+
+
+def _field_slots(attrs, converted=()):
+    """
+    为 `attrs` 中的字段生成 slot 名，`converted` 中的字段会被转换为对象，
+    原始值保存在 `_raw_` 前缀的 slot 中。
+
+    :return: 字段名到 slot 名的映射
+    """
+    return collections.OrderedDict((a, '_raw_' + a if a in converted else a) for a in attrs)
+
+
+_getattribute = object.__getattribute__
+
+
+class Base:
+    """
+    :class:`User` 和 :class:`Status` 的基类。
+    为子类提供对象缓存和自动加载功能。
+
+    已知的字段保存在 `__slots__` 中，未知的字段保存在 `_extra` 字典中，
+    未赋值的 slot 即表示缺失的字段，访问时自动加载。
+
+    可以用 pickle 序列化，但不包含 `fan`：反序列化后 `fan` 为 `None`，缺失的字段返回 `None`，
+    重新设置 `fan` 后才会自动加载。
+    """
+    __slots__ = ('fan', '_extra', '_loaded', '_timestamp', '_created_at', '__weakref__')
+    endpiont = None
+    attrs = ('id',)
+    _fields = {}  # 字段名到 slot 名的映射，由子类定义
+
+    def __init__(self, fan, **kwargs):
+        self.fan = fan  # type: Fan
+        self._extra = None  # type: dict
+        self._loaded = False
+        self._timestamp = None
+        self._created_at = None
+        self._assign(kwargs)
+
+    def __getattr__(self, item):
+        if item in self.attrs:
+            return self._lazy(item)
+        raise AttributeError(item)
+
+    def __getstate__(self):
+        # 默认实现会逐个读取 slot，未赋值的 slot 会触发加载；fan 持有连接和锁，无法序列化
+        return self.dict, self._loaded
+
+    def __setstate__(self, state):
+        data, loaded = state
+        self.fan = None
+        self._extra = None
+        self._loaded = loaded
+        self._timestamp = None
+        self._created_at = None
+        self._assign(data)
+
+    def _assign(self, data):
+        fields = self._fields
+        for k, v in data.items():
+            slot = fields.get(k)
+            if slot is not None:
+                setattr(self, slot, v)
+            else:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[k] = v
+
+    def _raw(self, item, default=None):
+        """返回字段的原始值，不会触发加载"""
+        slot = self._fields.get(item)
+        if slot is None:
+            extra = self._extra
+            return extra.get(item, default) if extra else default
+        try:
+            return _getattribute(self, slot)
+        except AttributeError:
+            return default
+
+    def _lazy(self, item):
+        rv = self._raw(item, _MISSING)
+        if rv is _MISSING:
+            if self._loaded or self.fan is None:
+                return None
+            self.load()
+            rv = self._raw(item)
+        return rv
+
+    @property
+    def dict(self):
+        """对象的所有字段，返回的是副本"""
+        rv = {}
+        for k in self._fields:
+            v = self._raw(k, _MISSING)
+            if v is not _MISSING:
+                rv[k] = v
+        if self._extra:
+            rv.update(self._extra)
+        return rv
+
+    @property
+    def created_at_raw(self):
+        """服务器返回的原始 created_at 字符串"""
+        return self._lazy('created_at')
+
+    @property
+    def timestamp(self):
+        """created_at 对应的 UTC 时间戳，适合用来排序"""
+        if self._timestamp is None:
+            raw = self.created_at_raw
+            if raw is None:
+                return None
+            self._timestamp = parse_time(raw)
+        return self._timestamp
+
+    @property
+    def created_at(self):
+        """创建时间，首次访问时才解析
+
+        :rtype: arrow.Arrow
+        """
+        if self._created_at is None:
+            ts = self.timestamp
+            if ts is None:
+                return None
+            self._created_at = arrow.Arrow.utcfromtimestamp(ts)
+        return self._created_at
+
+    def load(self):
+        """从服务器获取完整的对象属性，同一 id 的并发加载只会发出一个请求"""
+        result = self.fan._load_once(self.endpiont, self._raw('id'))
+        self._update(result)
+        self._loaded = True
+        return self
+
+    def _filled(self, attrs=None):
+        if attrs is None:
+            if self._loaded:
+                return True
+            attrs = self.attrs
+        return all(self._raw(a, _MISSING) is not _MISSING for a in attrs)
+
+    def _update(self, data):
+        """用服务器返回的数据刷新对象"""
+        changed = {k: v for k, v in data.items() if self._raw(k, _MISSING) != v}
+        if changed:
+            self._assign(changed)
+            if 'created_at' in changed:
+                self._timestamp = self._created_at = None
+            self._convert(changed)
+
+    def _convert(self, data):
+        """`data` 中的字段发生了变化，子类在此清除由这些字段转换得到的对象"""
+
+    def _forget(self, *slots):
+        for slot in slots:
+            try:
+                delattr(self, slot)
+            except AttributeError:
+                pass
+
+    @classmethod
+    def from_json(cls, fan, data):
+        if not data:
+            return None
+
+        identities = fan.identities if fan is not None else None
+        if identities is None or 'id' not in data:
+            return cls(fan, **data)
+
+        key = (cls, data['id'])
+        obj = identities.get(key)
+        if obj is None:
+            # 构造对象时会递归调用 from_json，不能持有锁
+            new = cls(fan, **data)
+            with fan._identities_lock:
+                obj = identities.get(key)
+                if obj is None:
+                    identities[key] = new
+                    return new
+        obj._update(data)
+        return obj
+
+    @classmethod
+    def from_id(cls, fan, id=None):
+        result = fan.get(cls.endpiont, id=id)
+        return cls.from_json(fan, result)
+
+    def to_dict(self):
+        return self.dict
+
+
+class Timeline:
+    """
+    时间线管理类
+
+    :param int max_items: 内存中最多保留的消息数，`None` 表示不限制。
+        超出时从离游标较远的一端淘汰，再次访问被淘汰的区间时会重新获取游标处的一页。
+        头部被淘汰的消息只保留 id，超过 :attr:`max_evicted` 条时最早的部分被遗忘，之后的位置整体前移。
+    :param TimelineStore store: 持久化存储，默认使用 `fan.store`。
+        向后读取时先从数据库中读取，`rewind()` 只获取比已保存的消息更新的部分。
+    """
+
+    max_evicted = 10000
+
+    def __init__(self, fan, user_id, endpoint, max_items=None, store=None):
+        self.fan = fan
+        self.user_id = user_id  # type:User
+        """:class:`~van.User` 时间线的主人"""
+        self.endpoint = endpoint
+        self.max_items = max_items
+        self.store = fan.store if store is None else store  # type: TimelineStore
+        self._pool = []  # type: [Status]
+        self._base = 0  # _pool[0] 在时间线中的位置，即头部被淘汰的消息数
+        self._evicted = []  # 头部被淘汰的消息的 (id, rawid)，按位置排列
+        self._max_id = None
+        self._max_rawid = -1
+        self._since_id = None
+        self._since_rawid = 1 << 32  # 什么时候饭否消息会达到这个数字呢？
+        self._curr = 0
+        self.prefetch = None
+        """向后读取时预读的页数，`None` 表示使用 `fan.prefetch`"""
+        self._prefetcher = None  # type: Prefetcher
+        if self.store is not None:
+            self._store_key = TimelineStore.key(endpoint, user_id)
+            cursor = self.store.cursor(self._store_key)
+            if cursor is not None:
+                self._max_id, self._max_rawid = cursor[:2]
+
+    def tell(self):
+        """
+        返回当前游标的位置
+
+        :rtype: int
+        """
+        return self._curr
+
+    def rewind(self):
+        """
+        获取最新的状态插入到时间线的头部，并将指针置为0（指向最新的状态）
+
+        :rtype: int
+        """
+        if self._base:
+            self._reset()
+        self._fetch_newer()
+        self._curr = 0
+        self._refill()
+        return 0
+
+    def _reset(self):
+        # 头部已被淘汰时，从最新的消息重新开始，不逐页恢复读过的部分
+        self.close()
+        self._pool = []
+        self._evicted = []
+        self._base = self._curr = 0
+        self._since_id = None
+        self._since_rawid = 1 << 32
+
+    def seek(self, offset=None, whence=0):
+        """
+        移动游标的位置
+
+        :param int offset: 偏移量
+        :param int whence: 相对位置
+
+            * 0 -- 相对于时间线开始位置，偏移量必须 >= 0
+            * 1 -- 相对于当前游标位置，偏移量可正可负，超出范围的偏移量会被纠正为边界值
+            * 2 -- 相对于时间线结尾，偏移量 <=0
+
+        .. attention::
+
+            此函数只能在有限范围满足索引要求，超出范围太多的偏移量会被自动纠正为合法值。
+
+        :return: 移动后的游标位置
+        :rtype: int
+        """
+        if not self._pool:
+            self._fetch_older()
+        self._seek(offset, whence)
+        self._refill()
+        return self._curr
+
+    def _seek(self, offset, whence):
+        length = len(self)
+        if whence == 0:
+            if offset < 0:
+                raise ValueError('offset should be zero or positive while whence=0')
+            self._curr = min(offset, max(length - 1, 0))
+        elif whence == 1:
+            self._curr += offset
+            self._curr = min(max(self._curr, 0), length - 1)
+        else:
+            if offset > 0:
+                raise ValueError('offset should be zero or negative while whence=2')
+            else:
+                self._curr = max(length + offset, 0)
+        return self._curr
+
+    def read(self, count=10):
+        """
+        从当前游标位置处往后读取 `count` 条消息, 数组长度可能小于要求的大小。
+
+        :param int count: 读取数量
+        :return: :class:`Status` 数组
+        :rtype: [Status]
+        """
+        rv = []
+        while len(rv) < count:
+            if self._curr >= len(self):
+                if self._fetch_older() == 0:
+                    break
+            rv.extend(self._take(count - len(rv)))
+        return rv
+
+    def _take(self, count):
+        start = self._curr - self._base
+        rv = self._pool[start:start + count]
+        self._curr += len(rv)
+        return rv
+
+    def fetch(self, since_id=None, max_id=None, count=60):
+        """
+        调用 API 获取数据。
+        可以自己控制 `since_id`, `max_id` 和 `count` 参数，获取的结果不加入内部缓存。
+
+        :param since_id: 开始的消息ID
+        :param max_id: 结束的消息ID
+        :param count: 获取数量，最大为60
+        :return: :class:`Status` 数组
+        :rtype: [Status]
+        """
+        rv = self.fan.get(self.endpoint, id=self.user_id,
+                          since_id=since_id, max_id=max_id, count=count)
+        return [Status.from_json(self.fan, s) for s in rv]
+
+    def close(self):
+        """停止后台预读"""
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+
+    def _older_pages(self):
+        cursor = [self._since_id]
+
+        def fetch():
+            rv = self.fetch(max_id=cursor[0])
+            if rv:
+                cursor[0] = rv[-1].id
+            return rv
+
+        return fetch
 
     def _fetch_older(self):
-        rv = self.fetch(max_id=self._since_id)
+        rv = self._load_older()
+        if rv:
+            return self._extend(rv)
+
+        depth = self.fan.prefetch if self.prefetch is None else self.prefetch
+        if not depth:
+            rv = self.fetch(max_id=self._since_id)
+            self._save(rv)
+            return self._extend(rv)
+
+        if self._prefetcher is None:
+            self._prefetcher = Prefetcher(self._older_pages(), depth)
+        try:
+            rv = self._prefetcher.get()
+        except Exception:
+            self.close()
+            raise
+        if not rv:
+            # 已经到达末尾，下次重新从 _since_id 开始获取
+            self.close()
+        self._save(rv)
+        return self._extend(rv)
+
+    def _from_store(self, rows):
+        return [Status.from_json(self.fan, s) for s in rows]
+
+    def _load_older(self):
+        if self.store is None:
+            return []
+        return self._from_store(self.store.older(self._store_key, self._since_rawid))
+
+    def _load_at(self, position):
+        # 数据库中有位置 position 的消息时，返回从它开始的一页
+        if self.store is None:
+            return None
+        id, rawid = self._evicted[position]
+        rows = self.store.older(self._store_key, rawid + 1)
+        if not rows or rows[0]['id'] != id:
+            return None
+        return self._from_store(rows)
+
+    def _save(self, rv):
+        # 只保存与已保存区间相邻的消息，数据库中始终是连续的一段
+        if self.store is not None and rv:
+            self.store.save(self._store_key, rv)
+
+    def _gap(self, newest, page):
+        """如果 page 是新消息的完整一页，返回继续获取更早的新消息的参数"""
+        if self.store is None or self._max_id is None or len(page) < 60:
+            return None
+        return dict(since_id=self._max_id, max_id=newest[-1].id)
+
+    def _older_than(self, newest, page):
+        return [s for s in page if s.rawid < newest[-1].rawid]
+
+    def _extend(self, rv):
+        # max_id 包含边界时，第一条消息与当前末尾重复
+        rv = [s for s in rv if s.rawid < self._since_rawid]
         if rv:
             self._since_id = rv[-1].id
             self._since_rawid = rv[-1].rawid
@@ -543,319 +2526,1931 @@ class Timeline:
                 self._max_id = rv[0].id
                 self._max_rawid = rv[0].rawid
             self._pool.extend(rv)
+            self._trim()
+            return len(rv)
+        return 0
+
+    def refresh(self):
+        """
+        获取最新的状态插入到时间线的头部，游标仍指向原来的消息
+
+        :return: 新的 :class:`Status` 数组，从新到旧排列
+        :rtype: [Status]
+        """
+        rv = page = self.fetch(since_id=self._max_id)
+        # 有持久化存储时，补齐新消息与已保存区间之间的空缺
+        params = self._gap(rv, page)
+        while params:
+            page = self.fetch(**params)
+            older = self._older_than(rv, page)
+            if not older:
+                break
+            rv = rv + older
+            params = self._gap(rv, page)
+        self._save(rv)
+        self._prepend(rv)
+        return rv
+
+    def _fetch_newer(self):
+        return len(self.refresh())
+
+    def _prepend(self, rv):
+        if rv:
+            self._max_id = rv[0].id
+            self._max_rawid = rv[0].rawid
+            if rv[0].rawid < self._since_rawid:
+                self._since_id = rv[-1].id
+                self._since_rawid = rv[-1].rawid
+            if self._base:
+                # 头部已有消息被淘汰，新消息与内存中的消息不相邻，只记录 id
+                self._evicted[:0] = [(s.id, s.rawid) for s in rv]
+                self._base += len(rv)
+            else:
+                self._pool[:0] = rv
+            self._curr += len(rv)
+            self._trim()
             return len(rv)
         return 0
 
-    def _fetch_newer(self):
-        rv = self.fetch(since_id=self._max_id)
-        if rv:
-            self._max_id = rv[0].id
-            self._max_rawid = rv[0].rawid
-            if rv[0].rawid < self._since_rawid:
-                self._since_id = rv[-1].id
-                self._since_rawid = rv[-1].rawid
-            self._pool = rv + self._pool
-            self._curr += len(rv)
-            return len(rv)
-        return 0
+    def _trim(self):
+        """淘汰超出 max_items 的消息，保留以游标为中心的部分"""
+        if self.max_items is None:
+            return
+        pool = self._pool
+        excess = len(pool) - self.max_items
+        if excess > 0:
+            head = min(excess, max(0, self._curr - self._base - self.max_items // 2))
+            tail = excess - head
+            if head:
+                self._evicted.extend((s.id, s.rawid) for s in pool[:head])
+                del pool[:head]
+                self._base += head
+            if tail:
+                del pool[-tail:]
+                self._since_id = pool[-1].id
+                self._since_rawid = pool[-1].rawid
+                # 预读的页面与新的末尾不再相邻
+                self.close()
+        forget = len(self._evicted) - self.max_evicted
+        if forget > 0:
+            del self._evicted[:forget]
+            self._base -= forget
+            self._curr = max(self._curr - forget, 0)
+
+    def _refill(self):
+        """游标移动到已被淘汰的头部区间时，重新获取游标处的一页消息"""
+        if self._curr >= self._base:
+            return
+        page = self._load_at(self._curr)
+        if page is None:
+            page = self.fetch(max_id=self._refill_max_id(), count=60)
+        self._restore(page)
+        self._trim()
+
+    def _refill_max_id(self):
+        # 无论 max_id 是否包含边界，都能取到游标位置及之后的消息
+        return self._evicted[self._curr - 1][0] if self._curr > 0 else None
+
+    def _restore(self, page):
+        """
+        把从游标位置开始的一页消息放回内存，已被删除的消息从时间线中去掉。
+        这一页与内存中的消息不相邻时丢弃内存中的消息，之后向后读取时重新获取
+        """
+        found = {s.id: s for s in page}
+        lowest = min(s.rawid for s in page) if page else None
+        restored = []
+        end = self._curr
+        while end < self._base:
+            id, rawid = self._evicted[end]
+            if lowest is not None and rawid < lowest:
+                break
+            if id in found:
+                restored.append(found[id])
+            end += 1
+        adjacent = end == self._base
+        del self._evicted[self._curr:]
+        self._base = self._curr
+        if adjacent:
+            self._pool[:0] = restored
+        else:
+            self._pool = restored
+            oldest = min(page, key=lambda s: s.rawid)
+            self._since_id = oldest.id
+            self._since_rawid = oldest.rawid
+            self.close()
+
+    def __iter__(self):
+        """
+        从当前游标位置开始获取消息，可以像普通数组一样在循环中使用。
+        :return: :class:`Status`
+        """
+        try:
+            while True:
+                if self._curr >= len(self):
+                    if self._fetch_older() == 0:
+                        return
+                self._refill()
+                yield self._pool[self._curr - self._base]
+                self._curr += 1
+        finally:
+            self.close()
+
+    def __len__(self):
+        return self._base + len(self._pool)
+
+
+class _PollJob:
+    __slots__ = ('timeline', 'callback', 'interval', 'rate', 'due', 'last', 'primed', 'removed')
+
+    def __init__(self, timeline, callback, interval, primed):
+        self.timeline = timeline
+        self.callback = callback
+        self.interval = interval
+        self.rate = None  # 新消息到达速度的滑动平均，条/秒
+        self.due = 0
+        self.last = None
+        self.primed = primed
+        self.removed = False
+
+    def __lt__(self, other):
+        return self.due < other.due
+
+
+class Poller(threading.Thread):
+    """
+    自适应轮询多个时间线，把新消息推送给回调函数。
+
+    每条时间线的轮询间隔根据新消息到达的速度调整，冷清的时间线逐渐放慢，活跃的时间线加快，
+    所有轮询共享一个全局的请求预算。
+
+    .. attention::
+
+        轮询在后台线程中调用 :meth:`Timeline.refresh`，不要在其他线程中同时读取同一个时间线。
+
+    :param float rate: 全局请求预算，平均每秒最多发出的请求数
+    :param float min_interval: 单个时间线的最短轮询间隔（秒）
+    :param float max_interval: 单个时间线的最长轮询间隔（秒）
+    :param float target: 期望每次轮询获取到的新消息数，用来从到达速度计算间隔
+    """
+
+    smoothing = 0.3
+
+    def __init__(self, rate=1.0, min_interval=5.0, max_interval=300.0, target=1.0):
+        super().__init__(daemon=True)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target = target
+        self._bucket = _TokenBucket(rate)
+        self._jobs = {}
+        self._heap = []
+        self._cond = threading.Condition()
+        self._running = True
+        self._stats = collections.Counter()
+        self._latency_max = 0.0
+
+    def add(self, timeline, callback, interval=None, backlog=False):
+        """
+        开始轮询一个时间线
+
+        :param Timeline timeline: 时间线，如 `fan.mentions`, `user.timeline`
+        :param callback: 接受新消息数组（按时间先后排列）的函数
+        :param float interval: 初始轮询间隔，默认为 `min_interval`
+        :param bool backlog: 为 `False` 时，时间线第一次获取到的消息不推送
+        """
+        interval = interval or self.min_interval
+        primed = backlog or timeline._max_id is not None
+        job = _PollJob(timeline, callback, interval, primed)
+        # 错开各时间线的第一次轮询
+        job.due = time.monotonic() + random.uniform(0, min(interval, self.min_interval))
+        with self._cond:
+            old = self._jobs.pop(timeline, None)
+            if old is not None:
+                old.removed = True
+            self._jobs[timeline] = job
+            heapq.heappush(self._heap, job)
+            self._cond.notify()
+
+    def remove(self, timeline):
+        """停止轮询一个时间线"""
+        with self._cond:
+            job = self._jobs.pop(timeline, None)
+            if job is not None:
+                job.removed = True
+
+    def interval(self, timeline):
+        """时间线当前的轮询间隔"""
+        return self._jobs[timeline].interval
+
+    def stats(self):
+        """
+        轮询统计
+
+        * polls -- 轮询次数
+        * empty_polls -- 没有新消息的轮询次数
+        * errors -- 出错的轮询次数
+        * delivered -- 推送的消息数
+        * latency_avg, latency_max -- 消息从发出到推送的平均、最大延迟（秒）
+        """
+        rv = dict(self._stats)
+        for key in ('polls', 'empty_polls', 'errors', 'delivered'):
+            rv.setdefault(key, 0)
+        latency = rv.pop('latency', 0.0)
+        timed = rv.pop('timed', 0)
+        rv['latency_avg'] = latency / timed if timed else 0.0
+        rv['latency_max'] = self._latency_max
+        return rv
+
+    def stop(self):
+        """停止轮询"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    def run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            self._poll(job)
+            with self._cond:
+                if not job.removed:
+                    job.due = time.monotonic() + job.interval * random.uniform(0.9, 1.1)
+                    heapq.heappush(self._heap, job)
+
+    def _next_job(self):
+        with self._cond:
+            while self._running:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = self._heap[0].due - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                job = heapq.heappop(self._heap)
+                if job.removed:
+                    continue
+                # 等待全局预算
+                delay = self._bucket.take()
+                while delay and self._running:
+                    self._cond.wait(delay)
+                    delay = self._bucket.take()
+                return job if self._running else None
+        return None
+
+    def _poll(self, job):
+        try:
+            rv = job.timeline.refresh()
+        except Exception as e:
+            logger.error(e)
+            self._stats['errors'] += 1
+            job.interval = min(job.interval * 2, self.max_interval)
+            return
+        now = time.monotonic()
+        self._stats['polls'] += 1
+        if not rv:
+            self._stats['empty_polls'] += 1
+        if not job.primed:
+            # 第一次获取的是已有的消息，不计入到达速度
+            job.primed = True
+            job.last = now
+            return
+        self._adjust(job, len(rv), now)
+        if rv:
+            self._deliver(job, rv)
+
+    def _adjust(self, job, count, now):
+        elapsed = now - job.last if job.last is not None else job.interval
+        job.last = now
+        rate = count / max(elapsed, 1e-3)
+        job.rate = rate if job.rate is None else self.smoothing * rate + (1 - self.smoothing) * job.rate
+        if count >= 60:
+            # 一页装不下，可能还有没取到的消息
+            interval = self.min_interval
+        elif job.rate > 0:
+            interval = self.target / job.rate
+        else:
+            # 还没有见过新消息，逐步放慢
+            interval = job.interval * 2
+        job.interval = min(max(interval, self.min_interval), self.max_interval)
+
+    def _deliver(self, job, statuses):
+        now = time.time()
+        for status in statuses:
+            timestamp = status.timestamp
+            if timestamp is not None:
+                latency = max(now - timestamp, 0.0)
+                self._stats['latency'] += latency
+                self._stats['timed'] += 1
+                self._latency_max = max(self._latency_max, latency)
+        self._stats['delivered'] += len(statuses)
+        try:
+            job.callback(statuses[::-1])
+        except Exception as e:
+            logger.error(e)
+
+
+class User(Base):
+    """
+    用户类
+    """
+    # 需要 id 参数，可查看其他用户信息的 API 在此类中（也可以省略 id 表示当前用户）
+    endpiont = 'users/show'
+    attrs = ('id', 'unique_id', 'name', 'screen_name', 'location', 'gender', 'birthday',
+             'description', 'url', 'protected', 'followers_count', 'friends_count', 'favourites_count',
+             'statuses_count', 'photo_count', 'following', 'notifications', 'created_at', 'utc_offset',
+             'profile_image_url', 'profile_image_url_large')
+    _fields = _field_slots(attrs, converted=('created_at',))
+    __slots__ = tuple(_fields.values()) + ('_timeline', '_statues', '_photos', 'mentions', 'replies')
+    timeline_class = Timeline
+
+    def __init__(self, fan, **kwargs):
+        """
+        :param str id: 用户ID
+        :param str name: 用户名字
+        :param str screen_name: 用户昵称
+        :param str location: 位置
+        :param str gender: 性别
+        :param str birthday: 用户生日信息
+        :param str description: 用户自述
+        :param str url: 用户主页
+        :param bool protected: 用户是否设置隐私保护
+        :param int followers_count: 用户关注用户数
+        :param int friends_count: 用户好友数
+        :param int favourites_count: 用户收藏消息数
+        :param int statuses_count: 用户消息数
+        :param bool following: 该用户是被当前登录用户关注
+        :param bool notifications: 当前登录用户是否已对该用户发出关注请求
+        :param str created_at: 用户注册时间
+        :param int utc_offset: UTC offset
+        """
+        super().__init__(fan, **kwargs)
+        self._timeline = self._statues = self._photos = None
+
+    @property
+    def timeline(self):
+        """返回此用户看到的时间线"""
+        if self._timeline is None:
+            self._timeline = self.timeline_class(self.fan, self.id, 'statuses/home_timeline')
+        return self._timeline
+
+    @property
+    def statues(self):
+        """返回此用户已发送的消息"""
+        if self._statues is None:
+            self._statues = self.timeline_class(self.fan, self.id, 'statuses/user_timeline')
+        return self._statues
+
+    @property
+    def photos(self):
+        """浏览指定用户的图片"""
+        if self._photos is None:
+            self._photos = self.timeline_class(self.fan, self.id, 'photos/user_timeline')
+        return self._photos
+
+    @property
+    def followers(self, count=60):
+        """
+        返回此用户的关注者
+        此用户为当前用户的关注对象或未设置隐私
+
+        :param int count: 每次获取的数量
+        """
+        for fo in pager(self.fan, 'statuses/followers', id=self.id, count=count):
+            yield User.from_json(self.fan, fo)
+
+    @property
+    def followers_id(self, count=60):
+        """
+        返回此用户关注者的id列表
+
+        :param int count: 每次获取的数量
+        """
+        for fo in pager(self.fan, 'followers/ids', id=self.id, count=count):
+            yield fo
+
+    @property
+    def friends(self, count=60):
+        """
+        返回此用户的关注对象
+        此用户为当前用户的关注对象或未设置隐私
+        """
+        for fr in pager(self.fan, 'statuses/friends', id=self.id, count=count):
+            yield User.from_json(self.fan, fr)
+
+    @property
+    def friends_id(self, count=60):
+        """返回此用户关注对象的id列表"""
+        for fr in pager(self.fan, 'friends/ids', id=self.id, count=count):
+            yield fr
+
+    def fetch_followers_id(self, workers=8, count=60, compact=False):
+        """
+        并发获取此用户关注者的id列表
+
+        :param int workers: 同时进行的请求数
+        :param int count: 每次获取的数量
+        :param bool compact: 为 `True` 时返回去重后的 tuple
+        """
+        return fetch_ids(self.fan, 'followers/ids', workers, compact, id=self.id, count=count)
+
+    def fetch_friends_id(self, workers=8, count=60, compact=False):
+        """
+        并发获取此用户关注对象的id列表
+
+        :param int workers: 同时进行的请求数
+        :param int count: 每次获取的数量
+        :param bool compact: 为 `True` 时返回去重后的 tuple
+        """
+        return fetch_ids(self.fan, 'friends/ids', workers, compact, id=self.id, count=count)
+
+    @property
+    def favorites(self, count=60):
+        """浏览此用户收藏的消息"""
+        for fo in pager(self.fan, 'favorites/id', id=self.id, count=count):
+            yield Status.from_json(self.fan, fo)
+
+    def relationship(self, other):
+        """
+        返回此用户与 other 的关系： 是否屏蔽，是否关注，是否被关注
+
+        :param str|User other: 其他用户
+        :rtype: (a_blocked_b, a_following_b, a_followed_b)
+        """
+        if isinstance(other, User):
+            other = other.id
+        rv = self.fan.get('friendships/show', source_id=self.id, target_id=other)
+        source = rv['relationship']['source']
+        rv = (source['blocking'] == 'true', source['following'] == 'true', source['followed_by'] == 'true')
+        return rv
+
+    def __str__(self):
+        return '<User ({}@{})>'.format(self.name, self.id)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    __repr__ = __str__
+
+
+class Photo:
+    """https://www.mtyun.com/doc/api/mss/mss/tu-pian-chu-li-fu-wu-api#图片处理服务状态码"""
+
+    def __init__(self, photo_url):
+        self.default_url = photo_url
+        self.origin_url = self.parse(photo_url)[0]
+        self._params = {}
+        self._format = ''
+
+    @property
+    def url(self):
+        params = {}
+        for key, param in self._params.items():
+            if isinstance(param, (tuple, list)):
+                param = '-'.join(param)
+            params[key] = param
+        s = '_'.join('{}{}'.format(v, k) for k, v in params.items() if v is not None)
+
+        format = self._format
+        if format and not format.startswith('.'):
+            format = '.' + format
+        return '{}@{}{}'.format(self.origin_url, s, format)
+
+    @staticmethod
+    def parse(url):
+        url, params = url.rsplit('@', 1)
+        return url, params
+
+    @staticmethod
+    def check_length(v, name, length):
+        if isinstance(v, (list, tuple)):
+            if len(v) != length:
+                raise ValueError('{} should have length of {}'.format(name, length))
+
+    def resize(self, width=None, height=None, edge=None,
+               larger=None, percentage=None, background_color=None):
+        """
+        图片缩放
+        :param width: 1-4096 指定目标缩略图的宽度
+        :param height: 1-4096 指定目标缩略图的高度
+        :param edge: 0/1/2/4，默认值为0 缩略优先边。0代表长边优先；1代表短边优先；2代表强制缩略；4代表短边优先缩略后填充
+        :param larger: 0/1，默认值为0 目标缩略图大于原图是否处理。0代表处理；1代表不处理
+        :param percentage: 1-1000 倍数百分比。100为原图；大于100为放大；小于100为缩小
+        :param background_color: red, green, blue[0-255] 填充部分的背景色。默认不指定（白色填充）。例如：100-100-100bgc
+        :return: 图片URL
+        """
+        self.check_length(background_color, 'background_color', 3)
+
+        params = {
+            'w': width,
+            'h': height,
+            'e': edge,
+            'l': larger,
+            'p': percentage,
+            'bgc': background_color
+        }
+        self._params.update(params)
+
+    def crop(self, cut=None, advanced_cut=None, region_cut=None):
+        self.check_length(advanced_cut, 'advanced_cut', 4)
+        self.check_length(region_cut, 'region_cut', 3)
+
+        """图片裁剪"""
+        params = {
+            'c': cut,
+            'a': advanced_cut,
+            'rc': '{0}x{1}-{2}'.format(*region_cut)
+        }
+
+        self._params.update(params)
+
+    def rotate(self, rotate):
+        params = {'r': rotate}
+        self._params.update(params)
+
+    def orient(self, orient):
+        params = {'o': orient}
+        self._params.update(params)
+
+    def quality(self, quality, relative=True):
+        code = 'q'
+        if not relative:
+            code = 'Q'
+        params = {code: quality}
+        self._params.update(params)
+
+    def change_format(self, format):
+        self._format = format
+
+    @property
+    def exif(self):
+        return
+
+    @property
+    def infoexif(self):
+        return
+
+    def __str__(self):
+        return self.default_url
+
+
+class Status(Base):
+    """
+    消息类
+    """
+    endpiont = 'statuses/show'
+    attrs = ('id', 'text', 'photo', 'created_at', 'in_reply_to_user_id', 'in_reply_to_status_id',
+             'in_reply_to_screen_name', 'repost_status_id', 'repost_status', 'repost_user_id',
+             'repost_screen_name', 'favorited', 'rawid', 'source', 'truncated', 'is_self', 'location')
+    _fields = _field_slots(attrs + ('user',), converted=('created_at', 'photo', 'repost_status', 'user'))
+    __slots__ = tuple(_fields.values()) + ('_user', '_photo', '_repost_status')
+    user_class = User
+
+    def __init__(self, fan, **kwargs):
+        """
+        :param str text: 消息内容
+        :param str id: status id
+        :param bool fill: 是否立即发起请求，填充对象属性。默认为False，当省略该值，并且只提供了id时，fill为True
+        :param dict|File photo: 图片URL字典 imageurl=图片地址 thumburl=缩略图地址 largeurl=图片原图地址
+        :param Status|dict repost_status: 被转发消息的详细信息
+        :param User|dict user: 消息的主人
+        """
+        super().__init__(fan, **kwargs)
+
+    def _convert(self, data):
+        if 'user' in data:
+            self._forget('_user')
+        if 'repost_status' in data:
+            self._forget('_repost_status')
+        if 'photo' in data:
+            self._forget('_photo')
+
+    @property
+    def dict(self):
+        rv = Base.dict.fget(self)
+        for key, slot in (('user', '_user'), ('repost_status', '_repost_status')):
+            if key not in rv:
+                try:
+                    obj = _getattribute(self, slot)
+                except AttributeError:
+                    continue
+                if obj is not None:
+                    rv[key] = obj.dict
+        return rv
+
+    @property
+    def user(self):
+        """消息的主人
+
+        :rtype: User
+        """
+        try:
+            return _getattribute(self, '_user')
+        except AttributeError:
+            self._user = self.user_class.from_json(self.fan, self._lazy('user'))
+            # 转换后不再保留原始字典
+            self._forget('_raw_user')
+            return self._user
+
+    @property
+    def repost_status(self):
+        """被转发的消息
+
+        :rtype: Status
+        """
+        try:
+            return _getattribute(self, '_repost_status')
+        except AttributeError:
+            self._repost_status = type(self).from_json(self.fan, self._lazy('repost_status'))
+            if self._repost_status is not None:
+                self._forget('_raw_repost_status')
+            return self._repost_status
+
+    @property
+    def photo(self):
+        """消息中的图片
+
+        :rtype: Photo
+        """
+        try:
+            return _getattribute(self, '_photo')
+        except AttributeError:
+            raw = self._lazy('photo')
+            self._photo = Photo(raw['imageurl']) if raw else None
+            return self._photo
+
+    @staticmethod
+    def process_text(text):
+        at_re = re.compile(r'@<a.*?>(.*?)</a>', re.I)
+        topic_re = re.compile(r'#<a.*?>(.*?)</a>#', re.I)
+        link_re = re.compile(r'<a.*?rel="nofollow" target="_blank">(.*)</a>', re.I)
+
+        text = at_re.sub(r'@\1', text)
+        text = topic_re.sub(r'#\1#', text)
+        text = link_re.sub(r'\1', text)
+        return text
+
+    @staticmethod
+    def process_photo_link(photo):
+        large_url = photo['largeurl']
+        origin_url = re.sub(r'@.+\..+$', '', large_url)
+        type = re.match(r'^.+\.(.+)$', origin_url).group(1)
+        photo['originurl'] = origin_url
+        photo['type'] = type
+        return photo
+
+    def delete(self):
+        """删除此消息（当前用户发出的消息）"""
+        result = self.fan.post('statuses/destroy', id=self.id)
+        self.fan._status_changed(self.id)
+        if self.fan.store is not None:
+            self.fan.store.discard(self.id)
+        result = Status.from_json(self.fan, result)
+        return result
+
+    @property
+    def context(self):
+        """按照时间先后顺序显示消息上下文"""
+        result = self.fan.get('statuses/context_timeline', id=self.id)
+        context = [Status.from_json(self.fan, s) for s in result]
+        return context
+
+    def reply(self, response, photo=None, location=None, format='@{poster} {response}', **kwargs):
+        """回复这条消息"""
+        text = format.format(response=response,
+                             poster=self.user.screen_name,
+                             **kwargs)
+        data = dict(status=text,
+                    photo=photo,
+                    location=location,
+                    in_reply_to_user_id=self.user.id,
+                    in_reply_to_status_id=self.id)
+        result = self.fan.update_status(**data)
+        return result
+
+    def repost(self, repost, photo=None, location=None,
+               format='{repost}{repost_style_left}@{name} {origin}{repost_style_right}',
+               **kwargs):
+        """转发这条消息"""
+        kwargs.setdefault('repost_style_left', ' ')
+        kwargs.setdefault('repost_style_right', '')
 
-    def __iter__(self):
+        text = format.format(repost=repost,
+                             name=self.user.screen_name,
+                             origin=self.process_text(self.text),
+                             **kwargs)
+        data = dict(status=text,
+                    photo=photo,
+                    location=location,
+                    repost_status_id=self.id)
+        result = self.fan.update_status(**data)
+        return result
+
+    def favorite(self):
+        """收藏此消息"""
+        # fuck, 为啥就这一个API不一样…
+        result = self.fan.post('favorites/create/' + self.id)
+        self.fan.invalidate('statuses/show', self.id)
+        return Status.from_json(self.fan, result)
+
+    def unfavorite(self):
+        """取消收藏此消息"""
+        result = self.fan.post('favorites/destroy/' + self.id)
+        self.fan.invalidate('statuses/show', self.id)
+        return Status.from_json(self.fan, result)
+
+    def __str__(self):
+        return '<Status ("{}" @{})>'.format(self.text, self.user.id)
+
+    __repr__ = __str__
+
+
+class Event:
+    """
+    事件对象，模拟一个事件发生时相关的数据
+
+    每个事件都有一个类型，当前可用的类型有：
+
+        * MESSAGE_CREATE： 当前用户发布一条状态。source为当前用户，如果消息中@其他人，则target为被提及用户，object为发布的状态
+        * MESSAGE_DELETE： 当前用户删除一条状态
+        * MESSAGE： 与 MESSAGE 相关的所有类型的事件，即 `MESSAGE_CREATE` 与 `MESSAGE_DELETE` 的合事件。
+        * FRIENDS_CREATE：当前用户关注其他用户。source为当前用户，target为被关注的对象
+        * FRIENDS_DELETE： 当前用户取消关注其他用户
+        * FRIENDS_REQUEST： 当前用户对其他用户发起关注请求
+        * FRIENDS：FRIENDS 相关的所有类型的事件
+        * FAV_CREATE：当前用户收藏一条状态。 source 为发起收藏操作的用户，target为状态被收藏的用户，object为被收藏的状态
+        * FAV_DELETE：当前用户取消收藏一条状态
+        * FAV：FAV 相关的所有事件
+        * DM_CREATE： 用户收到一条私信
+        * USER_UPDATE_PROFILE：当前用户更新个人资料
+        * ALL：所有事件
+    """
+
+    HEART_BEAT = 0b000001000
+    ERROR = 0b000010000
+
+    MESSAGE_CREATE = 0b000100001
+    MESSAGE_DELETE = 0b000100010
+    MESSAGE = MESSAGE_CREATE | MESSAGE_DELETE
+
+    FRIENDS_CREATE = 0b001000001
+    FRIENDS_DELETE = 0b001000010
+    FRIENDS_REQUEST = 0b01000100
+    FRIENDS = FRIENDS_CREATE | FRIENDS_DELETE | FRIENDS_REQUEST
+
+    FAV_CREATE = 0b010000001
+    FAV_DELETE = 0b010000010
+    FAV = FAV_CREATE | FAV_DELETE
+
+    USER_UPDATE_PROFILE = 0b100000001
+    USER = USER_UPDATE_PROFILE
+
+    ALL = MESSAGE | FRIENDS | FAV | USER | HEART_BEAT | ERROR
+
+    TYPES = (HEART_BEAT, ERROR, MESSAGE_CREATE, MESSAGE_DELETE, FRIENDS_CREATE, FRIENDS_DELETE,
+             FRIENDS_REQUEST, FAV_CREATE, FAV_DELETE, USER_UPDATE_PROFILE)
+    """所有具体的事件类型，:attr:`Event.type` 总是其中之一"""
+
+    STATUS_TYPES = frozenset((MESSAGE_CREATE, MESSAGE_DELETE, FAV_CREATE, FAV_DELETE))
+
+    __slots__ = ('fan', 'type', 'raw', '_source', '_target', '_object', '_timestamp', '_created_at')
+
+    user_class = User
+    status_class = Status
+
+    def __init__(self, fan, type, data=None):
+        self.fan = fan
+        self.type = type
+        self.raw = data if isinstance(data, dict) else dict(object=data)
+        """服务器返回的原始数据，只需要个别字段时直接读取可以避免构造对象"""
+        self._timestamp = None
+        self._created_at = None
+
+    def _convert(self, slot, key, cls):
+        try:
+            return _getattribute(self, slot)
+        except AttributeError:
+            value = self.raw.get(key)
+            if isinstance(value, dict):
+                value = cls.from_json(self.fan, value)
+            setattr(self, slot, value)
+            return value
+
+    @property
+    def source(self):
+        """发起动作的用户
+
+        :rtype: User
         """
-        从当前游标位置开始获取消息，可以像普通数组一样在循环中使用。
-        :return: :class:`Status`
+        return self._convert('_source', 'source', self.user_class)
+
+    @property
+    def target(self):
+        """动作的对象用户
+
+        :rtype: User
+        """
+        return self._convert('_target', 'target', self.user_class)
+
+    @property
+    def object(self):
+        """事件相关的对象，消息和收藏事件为 :class:`Status`，其他事件为 :class:`User`"""
+        cls = self.status_class if self.type in self.STATUS_TYPES else self.user_class
+        return self._convert('_object', 'object', cls)
+
+    @property
+    def event(self):
+        """原始的事件名称，如 `message.create`"""
+        return self.raw.get('event')
+
+    @property
+    def created_at_raw(self):
+        return self.raw.get('created_at')
+
+    @property
+    def timestamp(self):
+        """事件发生时的 UTC 时间戳"""
+        if self._timestamp is None and self.created_at_raw:
+            self._timestamp = parse_time(self.created_at_raw)
+        return self._timestamp
+
+    @property
+    def created_at(self):
+        """事件发生的时间，首次访问时才解析
+
+        :rtype: arrow.Arrow
+        """
+        if self._created_at is None and self.timestamp is not None:
+            self._created_at = arrow.Arrow.utcfromtimestamp(self.timestamp)
+        return self._created_at
+
+    def __str__(self):
+        return '<Event {0.type} {0.source} {0.target} {0.object} {0.event} {0.created_at}>'.format(self)
+
+
+class Listener:
+    def __init__(self, on, action, ttl=None, filter=None):
+        self.on = on
+        self.action = action
+        self.ttl = ttl
+        self.filter = filter  # type: Filter
+
+    def matches(self, type):
+        """是否监听具体的事件类型 `type`"""
+        return self.on & type == type
+
+
+class Filter:
+    """
+    监听器的过滤条件，事件需要满足所有给出的条件，每个条件满足其中一项即可。
+
+    :param users: 用户 id，事件的发起者或者消息的作者是其中之一
+    :param keywords: 关键词，消息中包含其中之一，不区分大小写
+    :param topics: 话题（不带 `#`），消息中包含 `#话题#`
+    :param mentions: 用户名（不带 `@`），消息中包含 `@用户名`，`@bob` 不匹配 `@bobby`
+    """
+
+    __slots__ = ('users', 'keywords', 'topics', 'mentions')
+
+    def __init__(self, users=None, keywords=None, topics=None, mentions=None):
+        self.users = frozenset(users or ())
+        self.keywords = tuple(k.lower() for k in keywords or ())
+        self.topics = tuple('#{}#'.format(t).lower() for t in topics or ())
+        self.mentions = tuple('@{}'.format(m).lower() for m in mentions or ())
+
+    @property
+    def patterns(self):
+        """需要在消息中查找的所有字符串"""
+        return self.keywords + self.topics + self.mentions
+
+    def accepts(self, users, found):
+        """
+        :param users: 事件相关的用户 id
+        :param found: 消息中找到的字符串
+        """
+        if self.users and self.users.isdisjoint(users):
+            return False
+        for patterns in (self.keywords, self.topics, self.mentions):
+            if patterns and found.isdisjoint(patterns):
+                return False
+        return True
+
+
+class _Automaton:
+    """Aho-Corasick 自动机，一次扫描找出文本中出现的所有模式串"""
+
+    def __init__(self, patterns):
+        goto = [{}]
+        output = [()]
+        for pattern in patterns:
+            state = 0
+            for ch in pattern:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = goto[state][ch] = len(goto)
+                    goto.append({})
+                    output.append(())
+                state = nxt
+            output[state] += (pattern,)
+
+        fail = [0] * len(goto)
+        queue_ = collections.deque(goto[0].values())
+        while queue_:
+            state = queue_.popleft()
+            for ch, nxt in goto[state].items():
+                queue_.append(nxt)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                output[nxt] += output[fail[nxt]]
+        self._goto = goto
+        self._fail = fail
+        self._output = output
+
+    def search(self, text):
+        """
+        :return: 文本中出现的模式串
+        :rtype: set
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+_TAG_RE = re.compile(r'<[^>]*>')
+_MENTION_RE = re.compile(r'@<a[^>]*>(.*?)</a>', re.I)
+
+
+def _mentioned(text, pattern, names):
+    """
+    `text` 中是否提到了 `pattern`（`@用户名`），`@bob` 不匹配 `@bobby`
+
+    :param names: HTML 中以链接形式出现的 `@用户名`，链接的结尾就是用户名的边界
+    """
+    if names is not None and pattern in names:
+        return True
+    start = text.find(pattern)
+    while start >= 0:
+        end = start + len(pattern)
+        if end == len(text) or not (text[end].isalnum() or text[end] == '_'):
+            return True
+        start = text.find(pattern, start + 1)
+    return False
+
+
+class ListenerTable:
+    """
+    按具体事件类型索引的监听器表。
+
+    安装和卸载时在锁内生成新的索引再整体替换（写时复制），分发事件时直接读取当前索引，不需要加锁。
+    次数用完的监听器会被自动移除。
+    所有监听器的过滤条件编译为同一个自动机，每个事件只扫描一次，而且在构造载荷对象之前完成，
+    只有找到的字符串对应的监听器才会被检查。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners = ()  # 按安装顺序排列
+        self._patterns = collections.Counter()
+        self._order = {}  # 监听器 -> 安装序号
+        self._counter = itertools.count()
+        # (类型 -> 没有过滤条件的监听器, 类型 -> {字符串 -> 有过滤条件的监听器}, 自动机)
+        # 只有用户条件的监听器放在 None 下
+        self._snapshot = ({}, {}, None)
+
+    @property
+    def listeners(self):
+        """所有监听器，按安装顺序排列"""
+        return list(self._listeners)
+
+    def install(self, listener):
+        """
+        添加监听器
+
+        :param Listener listener: 监听器
+        :return: 监听器本身，可用于 :meth:`uninstall`
+        """
+        with self._lock:
+            self._listeners += (listener,)
+            self._order[listener] = next(self._counter)
+            index, by_pattern, matcher = self._snapshot
+            index = dict(index)
+            by_pattern = dict(by_pattern)
+            if listener.filter is not None:
+                patterns = set(listener.filter.patterns) or {None}
+            for type in Event.TYPES:
+                if not listener.matches(type):
+                    continue
+                if listener.filter is None:
+                    index[type] = index.get(type, ()) + (listener,)
+                    continue
+                table = by_pattern[type] = dict(by_pattern.get(type, {}))
+                for pattern in patterns:
+                    table[pattern] = table.get(pattern, ()) + (listener,)
+            self._snapshot = (index, by_pattern, self._compile([listener], 1, matcher))
+        return listener
+
+    def uninstall(self, *items):
+        """
+        移除监听器
+
+        :param items: :class:`Listener` 对象或者监听器的回调函数
+        :return: 移除的监听器数量
+        """
+        with self._lock:
+            removed = {lsn for lsn in self._listeners if lsn in items or lsn.action in items}
+            if not removed:
+                return 0
+            self._listeners = tuple(lsn for lsn in self._listeners if lsn not in removed)
+            for lsn in removed:
+                del self._order[lsn]
+            index, by_pattern, matcher = self._snapshot
+            index = {type: tuple(lsn for lsn in listeners if lsn not in removed)
+                     for type, listeners in index.items()}
+            by_pattern = {type: {pattern: tuple(lsn for lsn in listeners if lsn not in removed)
+                                 for pattern, listeners in table.items()}
+                          for type, table in by_pattern.items()}
+            self._snapshot = (index, by_pattern, self._compile(removed, -1, matcher))
+        return len(removed)
+
+    def _compile(self, listeners, delta, matcher):
+        """更新模式串的引用计数，模式串集合变化时重新生成自动机"""
+        changed = False
+        for lsn in listeners:
+            if lsn.filter is None:
+                continue
+            for pattern in lsn.filter.patterns:
+                count = self._patterns[pattern]
+                changed |= (count == 0) if delta > 0 else (count == 1)
+                self._patterns[pattern] = count + delta
+        if not changed:
+            return matcher
+        self._patterns += collections.Counter()  # 去掉计数为 0 的模式串
+        return _Automaton(self._patterns) if self._patterns else None
+
+    def actions(self, type, event=None):
+        """
+        取出监听具体事件类型 `type` 的回调函数，并扣减监听器的剩余次数
+
+        :param Event event: 事件，用于检查监听器的过滤条件
+        :rtype: list
+        """
+        index, by_pattern, matcher = self._snapshot
+        listeners = index.get(type, ())
+        table = by_pattern.get(type)
+        if table:
+            users, found = self._context(event, matcher)
+            candidates = set(table.get(None, ()))
+            for pattern in found:
+                candidates.update(table.get(pattern, ()))
+            matched = [lsn for lsn in candidates if lsn.filter.accepts(users, found)]
+            if matched:
+                order = self._order
+                listeners = sorted(matched + list(listeners), key=lambda lsn: order.get(lsn, -1))
+
+        rv = []
+        expired = []
+        for lsn in listeners:
+            ttl = lsn.ttl
+            if ttl is not None:
+                if ttl <= 0:
+                    continue
+                lsn.ttl = ttl - 1
+                if ttl == 1:
+                    expired.append(lsn)
+            rv.append(lsn.action)
+        if expired:
+            self.uninstall(*expired)
+        return rv
+
+    @staticmethod
+    def _context(event, matcher):
+        """从原始数据中取出事件相关的用户 id 和消息中出现的模式串"""
+        users = set()
+        found = set()
+        raw = event.raw if event is not None else {}
+        source = raw.get('source')
+        if isinstance(source, dict):
+            users.add(source.get('id'))
+        status = raw.get('object')
+        if isinstance(status, dict) and event.type in Event.STATUS_TYPES:
+            author = status.get('user')
+            if isinstance(author, dict):
+                users.add(author.get('id'))
+            text = status.get('text')
+            if text and matcher is not None:
+                names = None
+                if '<' in text:
+                    names = {'@' + html.unescape(name).lower() for name in _MENTION_RE.findall(text)}
+                    text = _TAG_RE.sub('', text)
+                if '&' in text:
+                    text = html.unescape(text)
+                text = text.lower()
+                found = matcher.search(text)
+                # 自动机只做子串匹配，还需要检查用户名的边界
+                for pattern in [p for p in found if p[0] == '@']:
+                    if not _mentioned(text, pattern, names):
+                        found.discard(pattern)
+        return users, found
+
+    def __len__(self):
+        return len(self._listeners)
+
+
+class Dispatcher:
+    """
+    调用监听器的策略，默认在读取连接的线程中直接调用。
+
+    子类实现 :meth:`submit` 即可把监听器放到其他地方执行。
+    """
+
+    def __init__(self):
+        self._stats_lock = threading.Lock()
+        self._stats = collections.Counter()
+        self._latency_max = 0.0
+
+    def submit(self, action, event):
+        """调用监听器的回调函数 `action(event)`"""
+        self._run(action, event)
+
+    def _run(self, action, event):
+        start = time.perf_counter()
+        error = False
+        try:
+            action(event)
+        except Exception as e:
+            error = True
+            logger.error(e)
+        self._record(time.perf_counter() - start, error)
+
+    def _record(self, latency, error):
+        with self._stats_lock:
+            self._stats['processed'] += 1
+            self._stats['errors'] += error
+            self._stats['latency'] += latency
+            self._latency_max = max(self._latency_max, latency)
+
+    def stats(self):
+        """
+        分发统计
+
+        * processed -- 已执行的回调数
+        * errors -- 抛出异常的回调数
+        * dropped -- 因队列已满而丢弃的事件数
+        * queue_depth, max_depth -- 当前、最大的排队事件数
+        * latency_avg, latency_max -- 回调的平均、最长执行时间（秒）
         """
+        with self._stats_lock:
+            rv = dict(self._stats)
+            latency_max = self._latency_max
+        for key in ('processed', 'errors', 'dropped', 'max_depth'):
+            rv.setdefault(key, 0)
+        latency = rv.pop('latency', 0.0)
+        rv['latency_avg'] = latency / rv['processed'] if rv['processed'] else 0.0
+        rv['latency_max'] = latency_max
+        rv['queue_depth'] = self.depth()
+        return rv
+
+    def depth(self):
+        """正在排队的事件数"""
+        return 0
+
+    def close(self, wait=True):
+        """停止分发"""
+
+
+class PoolDispatcher(Dispatcher):
+    """
+    在线程池中调用监听器，读取连接的线程不会被慢的回调阻塞。
+
+    每个工作线程有自己的有界队列，事件按 `key` 分配到固定的线程，同一个 key 的事件按收到的顺序执行。
+
+    :param int workers: 工作线程数
+    :param int maxsize: 每个队列的最大长度
+    :param str overflow: 队列已满时的处理方式
+
+        * block -- 等待队列空出位置，读取连接的线程会暂停
+        * drop_oldest -- 丢弃队列中最早的事件
+        * drop_newest -- 丢弃新的事件
+
+    :param key: 接受 :class:`Event` 返回分组依据的函数，默认每个监听器一组
+    """
+
+    OVERFLOW = ('block', 'drop_oldest', 'drop_newest')
+
+    def __init__(self, workers=4, maxsize=1000, overflow='block', key=None):
+        super().__init__()
+        if overflow not in self.OVERFLOW:
+            raise ValueError('overflow should be one of {}'.format(', '.join(self.OVERFLOW)))
+        self.overflow = overflow
+        self.key = key
+        self._queues = [queue.Queue(maxsize) for _ in range(workers)]
+        self._threads = [threading.Thread(target=self._work, args=(q,), daemon=True) for q in self._queues]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, action, event):
+        key = action if self.key is None else self.key(event)
+        q = self._queues[hash(key) % len(self._queues)]
+        item = (action, event)
+        if self.overflow == 'block':
+            q.put(item)
+        elif self.overflow == 'drop_newest':
+            try:
+                q.put_nowait(item)
+            except queue.Full:
+                self._drop()
+                return
+        else:
+            while True:
+                try:
+                    q.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        continue
+                    self._drop()
+        depth = q.qsize()
+        if depth > self._stats['max_depth']:
+            with self._stats_lock:
+                self._stats['max_depth'] = max(self._stats['max_depth'], depth)
+
+    def _drop(self):
+        with self._stats_lock:
+            self._stats['dropped'] += 1
+
+    def _work(self, q):
         while True:
-            if self._curr >= len(self._pool):
-                if self._fetch_older() == 0:
+            item = q.get()
+            if item is None:
+                return
+            self._run(*item)
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def close(self, wait=True):
+        """
+        停止工作线程
+
+        :param bool wait: 是否等待队列中的事件执行完毕
+        """
+        for q in self._queues:
+            if not wait:
+                while True:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+            q.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class StreamFramer:
+    """
+    把流式连接收到的字节切分为帧，每帧以 `\\r\\n` 结尾，空帧是心跳。
+
+    网络上收到的数据块可能只包含半帧，也可能包含多帧，不完整的部分留在缓冲区中等待后续数据。
+    """
+
+    delimiter = b'\r\n'
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._scan = 0  # 下次从这里开始查找分隔符
+
+    def feed(self, data):
+        """
+        添加收到的数据
+
+        :param bytes data: 收到的数据块
+        :return: 已经完整的帧（不含分隔符）
+        :rtype: [bytes]
+        """
+        buf = self._buf
+        buf += data
+        frames = []
+        start = 0
+        find = buf.find
+        delimiter = self.delimiter
+        i = find(delimiter, self._scan)
+        while i >= 0:
+            frames.append(bytes(buf[start:i]))
+            start = i + len(delimiter)
+            i = find(delimiter, start)
+        if start:
+            del buf[:start]
+        # 分隔符可能被拆到两个数据块中
+        self._scan = max(len(buf) - 1, 0)
+        return frames
+
+    def __len__(self):
+        """缓冲区中尚未完整的字节数"""
+        return len(self._buf)
+
+
+class StreamRecorder:
+    """
+    把 :class:`Stream` 收到的原始帧连同接收时间写入文件，之后可以用 :class:`ReplaySource` 回放。
+
+    每帧的格式为 `<时间戳> <长度>\\n<帧>\\n`。
+
+    :param str path: 文件路径，已存在时追加
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+        self._lock = threading.Lock()
+        self.frames = 0
+        """已写入的帧数"""
+
+    def write(self, frame, timestamp=None):
+        """写入一帧"""
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            self._file.write(b'%.6f %d\n' % (timestamp, len(frame)))
+            self._file.write(frame)
+            self._file.write(b'\n')
+            self.frames += 1
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def read(path):
+        """
+        依次读出文件中的帧
+
+        :return: `(timestamp, frame)` 的迭代器
+        """
+        with open(path, 'rb') as f:
+            while True:
+                header = f.readline()
+                if not header:
+                    return
+                timestamp, length = header.split()
+                frame = f.read(int(length))
+                f.read(1)
+                yield float(timestamp), frame
+
+
+class ReplaySource:
+    """
+    回放 :class:`StreamRecorder` 录制的文件，代替真实的连接传给 :class:`Stream`::
+
+        stream = Stream(fan, source=ReplaySource('stream.rec', speed=10))
+
+    :param str path: 录制的文件
+    :param float speed: 回放速度，1 为原速，`None` 表示不等待，尽快回放
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self._closed = threading.Event()
+
+    def open(self):
+        """开始回放，返回的对象与 `requests.Response` 一样可以调用 `iter_content`"""
+        self._closed.clear()
+        return self
+
+    def iter_content(self, chunk_size=None):
+        start = origin = None
+        for timestamp, frame in StreamRecorder.read(self.path):
+            if self._closed.is_set():
+                return
+            if self.speed:
+                if origin is None:
+                    start, origin = time.monotonic(), timestamp
+                delay = start + (timestamp - origin) / self.speed - time.monotonic()
+                if delay > 0 and self._closed.wait(delay):
                     return
-            yield self._pool[self._curr]
-            self._curr += 1
+            yield frame + StreamFramer.delimiter
 
-    def __len__(self):
-        return len(self._pool)
+    def close(self):
+        self._closed.set()
 
 
-class User(Base):
-    """
-    用户类
-    """
-    # 需要 id 参数，可查看其他用户信息的 API 在此类中（也可以省略 id 表示当前用户）
-    endpiont = 'users/show'
-    attrs = ('id', 'unique_id', 'name', 'screen_name', 'location', 'gender', 'birthday',
-             'description', 'url', 'protected', 'followers_count', 'friends_count', 'favourites_count',
-             'statuses_count', 'photo_count', 'following', 'notifications', 'created_at', 'utc_offset',
-             'profile_image_url', 'profile_image_url_large')
+def _parse_frame(fan, frame, remember=None, event_class=None):
+    """把一帧数据转换为 :class:`Event`，`remember` 返回 False 表示消息重复，此时返回 None"""
+    event_class = event_class or Event
+    if not frame:
+        return event_class(fan, Event.HEART_BEAT, r'\r\n')
 
-    def __init__(self, fan, **kwargs):
-        """
-        :param str id: 用户ID
-        :param str name: 用户名字
-        :param str screen_name: 用户昵称
-        :param str location: 位置
-        :param str gender: 性别
-        :param str birthday: 用户生日信息
-        :param str description: 用户自述
-        :param str url: 用户主页
-        :param bool protected: 用户是否设置隐私保护
-        :param int followers_count: 用户关注用户数
-        :param int friends_count: 用户好友数
-        :param int favourites_count: 用户收藏消息数
-        :param int statuses_count: 用户消息数
-        :param bool following: 该用户是被当前登录用户关注
-        :param bool notifications: 当前登录用户是否已对该用户发出关注请求
-        :param str created_at: 用户注册时间
-        :param int utc_offset: UTC offset
-        """
-        super().__init__(fan, **kwargs)
-        self.created_at = arrow.get(self.dict['created_at'], 'ddd MMM DD HH:mm:ss Z YYYY')
+    try:
+        data = json.loads(frame.decode('utf8'))
+    except ValueError as e:
+        logger.error(e)
+        return event_class(fan, Event.ERROR, e)
+
+    event_name = data.get('event') if isinstance(data, dict) else None
+    if isinstance(event_name, str):
+        type = getattr(Event, event_name.upper().replace('.', '_'), Event.ERROR)
+    else:
+        type = Event.ERROR
+    if remember is not None and type == Event.MESSAGE_CREATE and isinstance(data.get('object'), dict):
+        if not remember(data['object']):
+            return None
 
-        self.timeline = Timeline(self.fan, self.id, 'statuses/home_timeline')  # 返回此用户看到的时间线
-        self.statues = Timeline(self.fan, self.id, 'statuses/user_timeline')  # 返回此用户已发送的消息
-        self.photos = Timeline(self.fan, self.id, 'photos/user_timeline')  # 浏览指定用户的图片
+    return event_class(fan, type, data)
 
-    @property
-    def followers(self, count=60):
+
+def _backoff(base, cap, failures):
+    """第 failures 次失败后重连前等待的秒数，指数增长并加入随机抖动"""
+    return min(cap, base * 2 ** failures) * random.uniform(0.5, 1.0)
+
+
+class _Listenable:
+    """监听器的注册接口，子类需要提供 `_table`"""
+
+    def install_listener(self, listener):
         """
-        返回此用户的关注者
-        此用户为当前用户的关注对象或未设置隐私
+        添加新的监听器
 
-        :param int count: 每次获取的数量
+        :param Listener listener: Listener 对象
+        :return: 监听器本身，可以传给 :meth:`uninstall_listener`
         """
-        for fo in pager(self.fan, 'statuses/followers', id=self.id, count=count):
-            yield User.from_json(self.fan, fo)
+        return self._table.install(listener)
 
-    @property
-    def followers_id(self, count=60):
+    def uninstall_listener(self, *listeners):
         """
-        返回此用户关注者的id列表
+        移除监听器
 
-        :param int count: 每次获取的数量
+        :param listeners: :class:`Listener` 对象或者用 :meth:`on` 装饰的函数
+        :return: 移除的监听器数量
         """
-        for fo in pager(self.fan, 'followers/ids', id=self.id, count=count):
-            yield fo
+        return self._table.uninstall(*listeners)
 
-    @property
-    def friends(self, count=60):
+    def on(self, event, ttl=None, users=None, keywords=None, topics=None, mentions=None):
         """
-        返回此用户的关注对象
-        此用户为当前用户的关注对象或未设置隐私
+        作为装饰器使用，添加新的监听器
+
+        :param event: 监听的事件, 多个事件请用 | 连接。如 `Event.MESSAGE | Event.FREIENDS`
+        :param int priority：监听器的优先级，数字越小优先级越高
+        :param int ttl: 此监听器执行的次数，`None` 表示不限次数
+
+        其余参数为过滤条件，参见 :class:`Filter`::
+
+            @stream.on(Event.MESSAGE_CREATE, topics=['饭否'], keywords=['python'])
+            def handle(event):
+                ...
         """
-        for fr in pager(self.fan, 'statuses/friends', id=self.id, count=count):
-            yield User.from_json(self.fan, fr)
+        if users or keywords or topics or mentions:
+            filter = Filter(users, keywords, topics, mentions)
+        else:
+            filter = None
 
-    @property
-    def friends_id(self, count=60):
-        """返回此用户关注对象的id列表"""
-        for fr in pager(self.fan, 'friends/ids', id=self.id, count=count):
-            yield fr
+        def decorator(func):
+            listener = Listener(event, func, ttl, filter)
+            self.install_listener(listener)
+            return func
 
-    @property
-    def favorites(self, count=60):
-        """浏览此用户收藏的消息"""
-        for fo in pager(self.fan, 'favorites/id', id=self.id, count=count):
-            yield Status.from_json(self.fan, fo)
+        return decorator
 
-    def relationship(self, other):
+
+class Stream(_Listenable, threading.Thread):
+    """
+    Streamming API, 实时监测用户动作
+
+    连接断开或超过 `heartbeat_timeout` 秒没有收到任何数据（包括心跳）时，按指数退避自动重连。
+    重连后通过 REST API 补齐断线期间的消息，以 `MESSAGE_CREATE` 事件发出，重复的消息会被丢弃。
+
+    :param bool reconnect: 是否自动重连
+    :param float backoff: 第一次重连前等待的秒数，之后每次翻倍
+    :param float max_backoff: 重连等待的最长秒数
+    :param float heartbeat_timeout: 多长时间收不到数据就认为连接已断开
+    :param since_id: 已经处理过的最新消息 id，用于重启后补齐消息，参见 :attr:`last_status_id`
+    :param backfill: 用于补齐消息的时间线，为空时不补齐。每条时间线最多取 :attr:`backfill_pages` 页
+        （每页 60 条），断线太久时更早的消息会被丢弃并记录警告
+    :param Dispatcher dispatcher: 调用监听器的方式，默认在读取连接的线程中直接调用，
+        慢的监听器可以使用 :class:`PoolDispatcher`
+    :param StreamRecorder recorder: 把收到的原始帧写入文件
+    :param ReplaySource source: 代替真实连接的数据来源，此时不会重连和补齐消息
+    """
+
+    def __init__(self, fan, reconnect=True, backoff=1.0, max_backoff=60.0, heartbeat_timeout=90.0,
+                 since_id=None, backfill=('statuses/home_timeline',), dispatcher=None,
+                 recorder=None, source=None):
+        super().__init__()
+        self.fan = fan
+        self.dispatcher = dispatcher or Dispatcher()  # type: Dispatcher
+        self.recorder = recorder  # type: StreamRecorder
+        self.source = source  # type: ReplaySource
+        self.reconnect = reconnect and source is None
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.heartbeat_timeout = heartbeat_timeout
+        self.backfill = backfill
+        self.reconnects = 0
+        """自动重连的次数"""
+        self.last_status_id = since_id
+        """收到的最新消息 id"""
+        self._last_rawid = -1
+        self._seen = collections.OrderedDict()  # 最近收到的消息 id，用于去重
+        self._failures = 0
+        self._conn = None
+        self._table = ListenerTable()
+        self._running = True
+        self._stopped = threading.Event()
+        self._init()
+
+    stream_url = 'http://stream.fanfou.com/1/user.json'
+    backfill_pages = 5
+    seen_size = 1024
+
+    def _init(self):
         """
-        返回此用户与 other 的关系： 是否屏蔽，是否关注，是否被关注
+        开始建立长连接
+        """
+        if self.source is not None:
+            self._conn = self.source.open()
+            return
+        self._conn = self.fan.session.post(self.stream_url, stream=True,
+                                           timeout=(10, self.heartbeat_timeout))
+        self._conn.raise_for_status()
 
-        :param str|User other: 其他用户
-        :rtype: (a_blocked_b, a_following_b, a_followed_b)
+    def stop(self):
         """
-        if isinstance(other, User):
-            other = other.id
-        rv = self.fan.get('friendships/show', source_id=self.id, target_id=other)
-        source = rv['relationship']['source']
-        rv = (source['blocking'] == 'true', source['following'] == 'true', source['followed_by'] == 'true')
-        return rv
+        停止监听事件
+        """
+        self._running = False
+        self._stopped.set()
+        if self.source is not None:
+            self.source.close()
 
-    def __str__(self):
-        return '<User ({}@{})>'.format(self.name, self.id)
+    def run(self):
+        """
+        开始监听事件
+        """
+        # 构造时传入了 since_id，第一次连接也要补齐重启期间的消息
+        backfill = self.last_status_id is not None
+        while self._running:
+            try:
+                if self._conn is None:
+                    self._init()
+                    self.reconnects += 1
+                    backfill = True
+                if backfill:
+                    backfill = False
+                    self._catch_up()
+                self._consume()
+            except (requests.RequestException, OSError) as e:
+                # 连接断开、心跳超时或者服务器返回错误
+                logger.error(e)
+            finally:
+                if self._conn is not None:
+                    self._conn.close()
+                    self._conn = None
+            if not self.reconnect:
+                break
+            self._stopped.wait(self._next_backoff())
+        if self.recorder is not None:
+            self.recorder.flush()
+
+    def _consume(self):
+        framer = StreamFramer()
+        for chunk in self._conn.iter_content(chunk_size=None):
+            self._failures = 0
+            for frame in framer.feed(chunk):
+                if self.recorder is not None:
+                    self.recorder.write(frame)
+                evt = self._parse_frame(frame)
+                if evt is not None:
+                    self._dispatch(evt)
+            if not self._running:
+                break
 
-    def __hash__(self):
-        return hash(self.id)
+    def _next_backoff(self):
+        delay = _backoff(self.backoff, self.max_backoff, self._failures)
+        self._failures += 1
+        return delay
+
+    def _dispatch(self, evt):
+        submit = self.dispatcher.submit
+        for action in self._table.actions(evt.type, evt):
+            submit(action, evt)
+
+    def _remember(self, status):
+        """记录收到的消息，返回 False 表示消息重复"""
+        id = status.get('id')
+        if id is None:
+            return True
+        if id in self._seen:
+            return False
+        self._seen[id] = None
+        if len(self._seen) > self.seen_size:
+            self._seen.popitem(last=False)
+        rawid = status.get('rawid', -1)
+        if rawid >= self._last_rawid:
+            self._last_rawid = rawid
+            self.last_status_id = id
+        return True
+
+    def _catch_up(self):
+        # 补齐失败时只丢失断线期间的消息，继续读取已经建立的连接
+        try:
+            self._backfill()
+        except FanfouError as e:
+            logger.error('Backfill failed: %r', e)
+
+    def _backfill(self):
+        """通过 REST API 获取断线期间的消息"""
+        since_id = self.last_status_id
+        if since_id is None or self.source is not None:
+            return
+        for endpoint in self.backfill:
+            missed = []
+            max_id = None
+            for _ in range(self.backfill_pages):
+                rv = self.fan.get(endpoint, since_id=since_id, max_id=max_id, count=60)
+                page = [s for s in rv if s['id'] != max_id]
+                if not page:
+                    break
+                missed.extend(page)
+                max_id = page[-1]['id']
+                if len(rv) < 60:
+                    break
+            else:
+                logger.warning('Backfill of %s stopped after %d pages, older missed statuses are dropped',
+                               endpoint, self.backfill_pages)
+            for status in sorted(missed, key=lambda s: s.get('rawid', 0)):
+                if not self._remember(status):
+                    continue
+                self._dispatch(Event(self.fan, Event.MESSAGE_CREATE, {
+                    'event': 'message.create',
+                    'source': status.get('user'),
+                    'object': status,
+                    'created_at': status.get('created_at'),
+                }))
 
-    __repr__ = __str__
+    @property
+    def _listeners(self):
+        return self._table.listeners
 
+    def _parse_frame(self, frame):
+        return _parse_frame(self.fan, frame, self._remember)
 
-class Photo:
-    """https://www.mtyun.com/doc/api/mss/mss/tu-pian-chu-li-fu-wu-api#图片处理服务状态码"""
 
-    def __init__(self, photo_url):
-        self.default_url = photo_url
-        self.origin_url = self.parse(photo_url)[0]
-        self._params = {}
-        self._format = ''
+class AsyncPager:
+    """
+    :func:`pager` 的异步版本，在 `async for` 中使用
+    """
 
-    @property
-    def url(self):
-        params = {}
-        for key, param in self._params.items():
-            if isinstance(param, (tuple, list)):
-                param = '-'.join(param)
-            params[key] = param
-        s = '_'.join('{}{}'.format(v, k) for k, v in params.items() if v is not None)
+    def __init__(self, fan, endpoint, convert=None, **params):
+        self.fan = fan
+        self.endpoint = endpoint
+        self.convert = convert
+        self.params = params
+        self._page = 1
+        self._buffer = []
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._buffer:
+            if self._done:
+                raise StopAsyncIteration
+            rv = await self.fan.get(self.endpoint, page=self._page, **self.params)
+            if not rv:
+                self._done = True
+                raise StopAsyncIteration
+            self._buffer = list(reversed(rv))
+            self._page += 1
+        item = self._buffer.pop()
+        if self.convert is not None:
+            item = self.convert(self.fan, item)
+        return item
 
-        format = self._format
-        if format and not format.startswith('.'):
-            format = '.' + format
-        return '{}@{}{}'.format(self.origin_url, s, format)
 
-    @staticmethod
-    def parse(url):
-        url, params = url.rsplit('@', 1)
-        return url, params
+async def async_fetch_ids(fan, endpoint, workers=8, compact=False, **params):
+    """
+    :func:`fetch_ids` 的异步版本，每次同时请求 `workers` 个页码，遇到空页时停止
 
-    @staticmethod
-    def check_length(v, name, length):
-        if isinstance(v, (list, tuple)):
-            if len(v) != length:
-                raise ValueError('{} should have length of {}'.format(name, length))
+    :param AsyncFan fan: 发出请求的账号
+    :param bool compact: 为 `True` 时返回去重后的 tuple，否则返回按顺序排列的 list
+    :rtype: list|tuple
+    """
+    ids = []
+    page = 1
+    while True:
+        pages = await asyncio.gather(*[fan.get(endpoint, page=page + i, **params) for i in range(workers)])
+        page += workers
+        for rv in pages:
+            if not rv:
+                return tuple(collections.OrderedDict.fromkeys(ids)) if compact else ids
+            ids.extend(rv)
 
-    def resize(self, width=None, height=None, edge=None,
-               larger=None, percentage=None, background_color=None):
-        """
-        图片缩放
-        :param width: 1-4096 指定目标缩略图的宽度
-        :param height: 1-4096 指定目标缩略图的高度
-        :param edge: 0/1/2/4，默认值为0 缩略优先边。0代表长边优先；1代表短边优先；2代表强制缩略；4代表短边优先缩略后填充
-        :param larger: 0/1，默认值为0 目标缩略图大于原图是否处理。0代表处理；1代表不处理
-        :param percentage: 1-1000 倍数百分比。100为原图；大于100为放大；小于100为缩小
-        :param background_color: red, green, blue[0-255] 填充部分的背景色。默认不指定（白色填充）。例如：100-100-100bgc
-        :return: 图片URL
-        """
-        self.check_length(background_color, 'background_color', 3)
 
-        params = {
-            'w': width,
-            'h': height,
-            'e': edge,
-            'l': larger,
-            'p': percentage,
-            'bgc': background_color
-        }
-        self._params.update(params)
+class AsyncTimeline(Timeline):
+    """
+    :class:`Timeline` 的异步版本，`read`, `seek`, `rewind`, `fetch` 均为协程，支持 `async for`
+    """
 
-    def crop(self, cut=None, advanced_cut=None, region_cut=None):
-        self.check_length(advanced_cut, 'advanced_cut', 4)
-        self.check_length(region_cut, 'region_cut', 3)
+    async def rewind(self):
+        if self._base:
+            self._reset()
+        await self._fetch_newer()
+        self._curr = 0
+        await self._refill()
+        return 0
 
-        """图片裁剪"""
-        params = {
-            'c': cut,
-            'a': advanced_cut,
-            'rc': '{0}x{1}-{2}'.format(*region_cut)
-        }
+    async def seek(self, offset=None, whence=0):
+        if not self._pool:
+            await self._fetch_older()
+        self._seek(offset, whence)
+        await self._refill()
+        return self._curr
 
-        self._params.update(params)
+    async def read(self, count=10):
+        rv = []
+        while len(rv) < count:
+            if self._curr >= len(self):
+                if await self._fetch_older() == 0:
+                    break
+            rv.extend(self._take(count - len(rv)))
+        return rv
 
-    def rotate(self, rotate):
-        params = {'r': rotate}
-        self._params.update(params)
+    async def fetch(self, since_id=None, max_id=None, count=60):
+        rv = await self.fan.get(self.endpoint, id=self.user_id,
+                                since_id=since_id, max_id=max_id, count=count)
+        return [AsyncStatus.from_json(self.fan, s) for s in rv]
+
+    async def _fetch_older(self):
+        rv = self._load_older()
+        if not rv:
+            rv = await self.fetch(max_id=self._since_id)
+            self._save(rv)
+        return self._extend(rv)
+
+    async def refresh(self):
+        rv = page = await self.fetch(since_id=self._max_id)
+        params = self._gap(rv, page)
+        while params:
+            page = await self.fetch(**params)
+            older = self._older_than(rv, page)
+            if not older:
+                break
+            rv = rv + older
+            params = self._gap(rv, page)
+        self._save(rv)
+        self._prepend(rv)
+        return rv
 
-    def orient(self, orient):
-        params = {'o': orient}
-        self._params.update(params)
+    async def _fetch_newer(self):
+        return len(await self.refresh())
 
-    def quality(self, quality, relative=True):
-        code = 'q'
-        if not relative:
-            code = 'Q'
-        params = {code: quality}
-        self._params.update(params)
+    def _from_store(self, rows):
+        return [AsyncStatus.from_json(self.fan, s) for s in rows]
 
-    def change_format(self, format):
-        self._format = format
+    def __iter__(self):
+        raise TypeError('use "async for" with AsyncTimeline')
 
-    @property
-    def exif(self):
-        return
+    def __aiter__(self):
+        return self
 
-    @property
-    def infoexif(self):
-        return
+    async def _refill(self):
+        if self._curr >= self._base:
+            return
+        page = self._load_at(self._curr)
+        if page is None:
+            page = await self.fetch(max_id=self._refill_max_id(), count=60)
+        self._restore(page)
+        self._trim()
+
+    async def __anext__(self):
+        if self._curr >= len(self):
+            if await self._fetch_older() == 0:
+                raise StopAsyncIteration
+        await self._refill()
+        status = self._pool[self._curr - self._base]
+        self._curr += 1
+        return status
+
+
+class AsyncBase:
+    """
+    异步对象的公共部分。
+    缺失的属性不会在访问时隐式发起请求，需要显式 `await obj.load()`。
+    """
 
-    def __str__(self):
-        return self.default_url
+    __slots__ = ()
 
+    def _lazy(self, item):
+        return self._raw(item)
 
-class Status(Base):
+    async def load(self):
+        """从服务器获取完整的对象属性"""
+        result = await self.fan.get(self.endpiont, id=self._raw('id'))
+        self._update(result)
+        self._loaded = True
+        return self
+
+    @classmethod
+    async def from_id(cls, fan, id=None):
+        result = await fan.get(cls.endpiont, id=id)
+        return cls.from_json(fan, result)
+
+
+class AsyncUser(AsyncBase, User):
     """
-    消息类
+    :class:`User` 的异步版本
     """
-    endpiont = 'statuses/show'
-    attrs = ('id', 'text', 'photo', 'created_at', 'in_reply_to_user_id', 'in_reply_to_status_id',
-             'in_reply_to_screen_name', 'repost_status_id', 'repost_status', 'repost_user_id',
-             'repost_screen_name', 'favorited', 'rawid', 'source', 'truncated', 'is_self', 'location')
+    __slots__ = ()
+    timeline_class = AsyncTimeline
+
+    @property
+    def followers(self, count=60):
+        return AsyncPager(self.fan, 'statuses/followers', AsyncUser.from_json, id=self.id, count=count)
+
+    @property
+    def followers_id(self, count=60):
+        return AsyncPager(self.fan, 'followers/ids', id=self.id, count=count)
+
+    @property
+    def friends(self, count=60):
+        return AsyncPager(self.fan, 'statuses/friends', AsyncUser.from_json, id=self.id, count=count)
 
-    def __init__(self, fan, **kwargs):
-        """
-        :param str text: 消息内容
-        :param str id: status id
-        :param bool fill: 是否立即发起请求，填充对象属性。默认为False，当省略该值，并且只提供了id时，fill为True
-        :param dict|File photo: 图片URL字典 imageurl=图片地址 thumburl=缩略图地址 largeurl=图片原图地址
-        :param Status|dict repost_status: 被转发消息的详细信息
-        :param User|dict user: 消息的主人
-        """
-        super().__init__(fan, **kwargs)
+    @property
+    def friends_id(self, count=60):
+        return AsyncPager(self.fan, 'friends/ids', id=self.id, count=count)
 
-        self.user = User.from_json(fan, self.dict['user'])  # type:User
-        self.created_at = arrow.get(self.dict['created_at'], 'ddd MMM DD HH:mm:ss Z YYYY')
-        if self.repost_status:
-            self.repost_status = Status.from_json(fan, self.dict['repost_status'])
-        if self.photo:
-            self.photo = Photo(self.dict['photo']['imageurl'])
+    async def fetch_followers_id(self, workers=8, count=60, compact=False):
+        return await async_fetch_ids(self.fan, 'followers/ids', workers, compact, id=self.id, count=count)
 
-    @staticmethod
-    def process_text(text):
-        at_re = re.compile(r'@<a.*?>(.*?)</a>', re.I)
-        topic_re = re.compile(r'#<a.*?>(.*?)</a>#', re.I)
-        link_re = re.compile(r'<a.*?rel="nofollow" target="_blank">(.*)</a>', re.I)
+    async def fetch_friends_id(self, workers=8, count=60, compact=False):
+        return await async_fetch_ids(self.fan, 'friends/ids', workers, compact, id=self.id, count=count)
 
-        text = at_re.sub(r'@\1', text)
-        text = topic_re.sub(r'#\1#', text)
-        text = link_re.sub(r'\1', text)
-        return text
+    @property
+    def favorites(self, count=60):
+        return AsyncPager(self.fan, 'favorites/id', AsyncStatus.from_json, id=self.id, count=count)
 
-    @staticmethod
-    def process_photo_link(photo):
-        large_url = photo['largeurl']
-        origin_url = re.sub(r'@.+\..+$', '', large_url)
-        type = re.match(r'^.+\.(.+)$', origin_url).group(1)
-        photo['originurl'] = origin_url
-        photo['type'] = type
-        return photo
+    async def relationship(self, other):
+        if isinstance(other, User):
+            other = other.id
+        rv = await self.fan.get('friendships/show', source_id=self.id, target_id=other)
+        source = rv['relationship']['source']
+        return source['blocking'] == 'true', source['following'] == 'true', source['followed_by'] == 'true'
 
-    def delete(self):
-        """删除此消息（当前用户发出的消息）"""
-        result = self.fan.post('statuses/destroy', id=self.id)
-        result = Status.from_json(self.fan, result)
-        return result
+
+class AsyncStatus(AsyncBase, Status):
+    """
+    :class:`Status` 的异步版本
+    """
+    __slots__ = ()
+    user_class = AsyncUser
+
+    async def delete(self):
+        result = await self.fan.post('statuses/destroy', id=self.id)
+        self.fan._status_changed(self.id)
+        if self.fan.store is not None:
+            self.fan.store.discard(self.id)
+        return AsyncStatus.from_json(self.fan, result)
 
     @property
-    def context(self):
-        """按照时间先后顺序显示消息上下文"""
-        result = self.fan.get('statuses/context_timeline', id=self.id)
-        context = [Status.from_json(self.fan, s) for s in result]
-        return context
+    async def context(self):
+        result = await self.fan.get('statuses/context_timeline', id=self.id)
+        return [AsyncStatus.from_json(self.fan, s) for s in result]
 
-    def reply(self, response, photo=None, location=None, format='@{poster} {response}', **kwargs):
-        """回复这条消息"""
+    async def reply(self, response, photo=None, location=None, format='@{poster} {response}', **kwargs):
         text = format.format(response=response,
                              poster=self.user.screen_name,
                              **kwargs)
-        data = dict(status=text,
-                    photo=photo,
-                    location=location,
-                    in_reply_to_user_id=self.user.id,
-                    in_reply_to_status_id=self.id)
-        result = self.fan.update_status(**data)
-        return result
-
-    def repost(self, repost, photo=None, location=None,
-               format='{repost}{repost_style_left}@{name} {origin}{repost_style_right}',
-               **kwargs):
-        """转发这条消息"""
+        return await self.fan.update_status(status=text,
+                                            photo=photo,
+                                            location=location,
+                                            in_reply_to_user_id=self.user.id,
+                                            in_reply_to_status_id=self.id)
+
+    async def repost(self, repost, photo=None, location=None,
+                     format='{repost}{repost_style_left}@{name} {origin}{repost_style_right}',
+                     **kwargs):
         kwargs.setdefault('repost_style_left', ' ')
         kwargs.setdefault('repost_style_right', '')
 
@@ -863,192 +4458,490 @@ class Status(Base):
                              name=self.user.screen_name,
                              origin=self.process_text(self.text),
                              **kwargs)
-        data = dict(status=text,
-                    photo=photo,
-                    location=location,
-                    repost_status_id=self.id)
-        result = self.fan.update_status(**data)
-        return result
+        return await self.fan.update_status(status=text,
+                                            photo=photo,
+                                            location=location,
+                                            repost_status_id=self.id)
 
-    def favorite(self):
-        """收藏此消息"""
-        # fuck, 为啥就这一个API不一样…
-        result = self.fan.post('favorites/create/' + self.id)
-        return Status.from_json(self.fan, result)
+    async def favorite(self):
+        result = await self.fan.post('favorites/create/' + self.id)
+        self.fan.invalidate('statuses/show', self.id)
+        return AsyncStatus.from_json(self.fan, result)
 
-    def unfavorite(self):
-        """取消收藏此消息"""
-        result = self.fan.post('favorites/destroy/' + self.id)
-        return Status.from_json(self.fan, result)
+    async def unfavorite(self):
+        result = await self.fan.post('favorites/destroy/' + self.id)
+        self.fan.invalidate('statuses/show', self.id)
+        return AsyncStatus.from_json(self.fan, result)
 
-    def __str__(self):
-        return '<Status ("{}" @{})>'.format(self.text, self.user.id)
 
-    __repr__ = __str__
+class AsyncEvent(Event):
+    """
+    :class:`Event` 的异步版本，载荷为 :class:`AsyncUser` 和 :class:`AsyncStatus`
+    """
+    __slots__ = ()
+    user_class = AsyncUser
+    status_class = AsyncStatus
 
 
-class Event:
+class AsyncFan(Fan):
     """
-    事件对象，模拟一个事件发生时相关的数据
+    基于 asyncio 的 API 操作入口，接口与 :class:`Fan` 一致，所有网络操作均为协程。
+    授权流程（:meth:`Fan.oauth`, :meth:`Fan.xauth`）沿用同步实现，只在启动时调用一次。
 
-    每个事件都有一个类型，当前可用的类型有：
+    需要安装 `aiohttp`::
 
-        * MESSAGE_CREATE： 当前用户发布一条状态。source为当前用户，如果消息中@其他人，则target为被提及用户，object为发布的状态
-        * MESSAGE_DELETE： 当前用户删除一条状态
-        * MESSAGE： 与 MESSAGE 相关的所有类型的事件，即 `MESSAGE_CREATE` 与 `MESSAGE_DELETE` 的合事件。
-        * FRIENDS_CREATE：当前用户关注其他用户。source为当前用户，target为被关注的对象
-        * FRIENDS_DELETE： 当前用户取消关注其他用户
-        * FRIENDS_REQUEST： 当前用户对其他用户发起关注请求
-        * FRIENDS：FRIENDS 相关的所有类型的事件
-        * FAV_CREATE：当前用户收藏一条状态。 source 为发起收藏操作的用户，target为状态被收藏的用户，object为被收藏的状态
-        * FAV_DELETE：当前用户取消收藏一条状态
-        * FAV：FAV 相关的所有事件
-        * DM_CREATE： 用户收到一条私信
-        * USER_UPDATE_PROFILE：当前用户更新个人资料
-        * ALL：所有事件
+        fan = AsyncFan(consumer_key, consumer_secret, oauth_token)
+        me = await fan.me
+        async for status in me.timeline:
+            print(status.text)
+        await fan.close()
     """
 
-    HEART_BEAT = 0b000001000
-    ERROR = 0b000010000
+    def __init__(self, consumer_key, consumer_secret, oauth_token=None, mobile=False, cache=None,
+                 identity_map=False, store=None, limit=100, connector=None, **unsupported):
+        """
+        :param int limit: 自己创建连接池时的最大连接数
+        :param aiohttp.BaseConnector connector: 与其他 AsyncFan 共享的连接池，由调用方负责关闭
 
-    MESSAGE_CREATE = 0b000100001
-    MESSAGE_DELETE = 0b000100010
-    MESSAGE = MESSAGE_CREATE | MESSAGE_DELETE
+        :class:`Fan` 的 `prefetch`, `transport`, `scheduler`, `retry`, `breaker` 和 `outbox` 基于线程，
+        不适用于异步客户端，传入时抛出 `TypeError`。注意第五个位置参数是 `cache` 而不是 `prefetch`。
+        """
+        if unsupported:
+            raise TypeError('AsyncFan does not support: {}'.format(', '.join(sorted(unsupported))))
+        if aiohttp is None:
+            raise ImportError('AsyncFan requires aiohttp')
+        super().__init__(consumer_key, consumer_secret, oauth_token, mobile,
+                         cache=cache, identity_map=identity_map, store=store)
+        self.limit = limit
+        self.connector = connector
+        self._http = None  # type: aiohttp.ClientSession
+
+        self.mentions = AsyncTimeline(self, None, 'statuses/mentions')
+        self.replies = AsyncTimeline(self, None, 'statuses/replies')
+        self.public_timeline = AsyncTimeline(self, None, 'statuses/public_timeline')
 
-    FRIENDS_CREATE = 0b001000001
-    FRIENDS_DELETE = 0b001000010
-    FRIENDS_REQUEST = 0b01000100
-    FRIENDS = FRIENDS_CREATE | FRIENDS_DELETE | FRIENDS_REQUEST
+    @property
+    def http(self):
+        """获取 aiohttp 会话"""
+        if self._http is None or self._http.closed:
+            if self.connector is not None:
+                self._http = aiohttp.ClientSession(connector=self.connector, connector_owner=False)
+            else:
+                self._http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.limit))
+        return self._http
 
-    FAV_CREATE = 0b010000001
-    FAV_DELETE = 0b010000010
-    FAV = FAV_CREATE | FAV_DELETE
+    async def close(self):
+        """关闭底层连接"""
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
 
-    USER_UPDATE_PROFILE = 0b100000001
-    USER = USER_UPDATE_PROFILE
+    async def __aenter__(self):
+        return self
 
-    ALL = MESSAGE | FRIENDS | FAV | USER | HEART_BEAT | ERROR
+    async def __aexit__(self, *exc_info):
+        await self.close()
 
-    def __init__(self, fan, type, data=None):
-        self.fan = fan
-        self.type = type
-        data = data if isinstance(data, dict) else dict(object=data)
-        source = data.get('source')
-        target = data.get('target')
-        object = data.get('object')
-        event = data.get('event')
-        created_at = data.get('created_at')
-
-        self.source = User.from_json(fan, source) if isinstance(source, dict) else source
-        self.target = User.from_json(fan, target) if isinstance(target, dict) else target
-        self.object = User.from_json(fan, object) if isinstance(object, dict) else object
-        self.event = event
-        self.created_at = arrow.get(created_at, 'ddd, DD MMM YYYY HH:mm:ss') if created_at else created_at
+    def _sign(self, method, url, body=None, headers=None):
+        # 与 OAuth1Session 共用同一个 oauthlib Client，签名方式完全一致
+        client = self._session._client.client
+        url, headers, body = client.sign(url, method, body=body, headers=headers)
+        decode = functools.partial(_to_str, encoding=client.decoding or 'utf8')
+        headers = {decode(k): decode(v) for k, v in headers.items()}
+        return decode(url), headers, decode(body)
 
-    def __str__(self):
-        return '<Event {0.type} {0.source} {0.target} {0.object} {0.event} {0.created_at}>'.format(self)
+    async def request(self, method, endpoint, params=None, data=None, files=None, **kwargs):
+        """发出请求"""
+        timeout = kwargs.pop('timeout', (5, 5))
+        if isinstance(timeout, tuple):
+            timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        else:
+            timeout = aiohttp.ClientTimeout(total=timeout)
+
+        url = self.api_url.format(endpoint)
+        params = [(k, v) for k, v in (params or {}).items() if v is not None]
+        data = [(k, v) for k, v in (data or {}).items() if v is not None]
+        if params:
+            url = '{}?{}'.format(url, urlencode(params))
+
+        if files:
+            # multipart 请求体不参与签名
+            url, headers, _ = self._sign(method, url)
+            body = aiohttp.FormData(data)
+            for name, f in files.items():
+                body.add_field(name, f, filename=getattr(f, 'name', name))
+        elif data:
+            body = urlencode(data)
+            url, headers, body = self._sign(method, url, body,
+                                            {'Content-Type': 'application/x-www-form-urlencoded'})
+        else:
+            url, headers, body = self._sign(method, url)
 
+        try:
+            async with self.http.request(method, yarl.URL(url, encoded=True), data=body,
+                                         headers=headers, timeout=timeout, **kwargs) as response:
+                status_code = response.status
+                text = await response.text()
+        except asyncio.TimeoutError:
+            raise Timeout
+        except aiohttp.ClientError:
+            raise NetworkError
 
-class Listener:
-    def __init__(self, on, action, ttl=None):
-        self.on = on
-        self.action = action
-        self.ttl = ttl
+        try:
+            json_data = json.loads(text)
+        except ValueError:
+            raise ApiRequestError('Invalid server response', status_code=status_code)
+        if status_code == 200:
+            return json_data
+        if json_data.get('error'):
+            raise ApiRequestError(json_data['error'], status_code=status_code)
+        raise ApiRequestError('Invalid error response', status_code=status_code)
+
+    @property
+    async def me(self):
+        """获取授权用户的信息"""
+        if self._me is None:
+            me = await AsyncUser.from_id(self)
+            me.mentions = self.mentions
+            me.replies = self.replies
+            self._me = me
+        return self._me
+
+    async def update_status(self, status, photo=None,
+                            in_reply_to_user_id=None,
+                            in_reply_to_status_id=None,
+                            repost_status_id=None,
+                            location=None,
+                            source=None):
+        """发表新状态"""
+        data = dict(status=status,
+                    in_reply_to_user_id=in_reply_to_user_id,
+                    in_reply_to_status_id=in_reply_to_status_id,
+                    repost_status_id=repost_status_id,
+                    locaion=location, source=source)
+        if photo is not None:
+            photo = await self._read_photo(photo)
+        try:
+            result = await self._post_status(data, photo)
+        except FanfouError:
+            data['photo'] = _draft_photo(photo)
+            self.draft_box.append(data)
+            raise
+
+        self._status_changed(in_reply_to_status_id, repost_status_id)
+        return AsyncStatus.from_json(self, result)
+
+    async def _read_photo(self, photo):
+        """路径和 URL 读取为 bytes，文件对象和 bytes 原样返回，无法读取时抛出 ValueError"""
+        if isinstance(photo, bytes) or hasattr(photo, 'read'):
+            return photo
+        if os.path.isfile(photo):
+            with open(photo, 'rb') as f:
+                return f.read()
+        url = photo.strip('\'').strip('"')
+        if urlparse(url).scheme != '':
+            try:
+                async with self.http.get(url) as response:
+                    if response.status == 200 and \
+                            response.headers.get('Content-Type', '').lower().startswith('image/'):
+                        return await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+        raise ValueError('Cannot read photo: {!r}'.format(photo))
+
+    async def _post_status(self, data, photo=None):
+        if photo is not None:
+            return await self.post('photos/upload', files=dict(photo=photo), **data)
+        return await self.post('statuses/update', **data)
+
+    async def resend_draft_box(self):
+        """依次重新发送 `draft_box` 中的消息，遇到失败时停止，返回成功发送的消息数"""
+        sent = 0
+        while self.draft_box:
+            data = dict(self.draft_box[0])
+            photo = data.pop('photo', None)
+            if photo is not None:
+                photo = await self._read_photo(photo)
+            try:
+                await self._post_status(data, photo)
+            except FanfouError as e:
+                logger.warning('Failed to resend draft: %r', e)
+                break
+            self.draft_box.pop(0)
+            self._status_changed(data.get('in_reply_to_status_id'), data.get('repost_status_id'))
+            sent += 1
+        return sent
+
+    async def get(self, endpoint, **params):
+        params.setdefault('mode', 'lite')
+        params.setdefault('format', 'html')
+        cache = self._cache_for(endpoint)
+        if cache is not None:
+            rv = cache.get(endpoint, params)
+            if rv is not _MISSING:
+                return rv
+        rv = await self.request('GET', endpoint, params=params)
+        if cache is not None:
+            cache.set(endpoint, params, rv)
+        return rv
+
+    async def hydrate(self, objects, attrs=None, limit=8):
+        """并发加载一组对象缺失的属性，参见 :meth:`Fan.hydrate`"""
+        objects = list(objects)
+        groups = collections.OrderedDict()
+        for obj in objects:
+            if not obj._filled(attrs):
+                groups.setdefault((obj.endpiont, obj._raw('id')), []).append(obj)
+        semaphore = asyncio.Semaphore(limit)
+
+        async def load(key):
+            endpoint, id = key
+            async with semaphore:
+                result = await self.get(endpoint, id=id)
+            for obj in groups[key]:
+                obj._update(result)
+                obj._loaded = True
+
+        await asyncio.gather(*[load(key) for key in groups])
+        return objects
+
+    async def _user_action(self, method, endpoint, user, changed=True):
+        if isinstance(user, User):
+            user = user.id
+        if method == 'GET':
+            rv = await self.get(endpoint, id=user)
+        else:
+            rv = await self.post(endpoint, id=user)
+        if changed:
+            self._user_changed(user)
+        return rv
+
+    def follow(self, user):
+        return self._user_action('POST', 'friendships/create', user)
+
+    def unfollow(self, user):
+        return self._user_action('POST', 'friendships/destroy', user)
+
+    @property
+    def follow_requests(self, count=60):
+        return AsyncPager(self, 'friendships/requests', AsyncUser.from_json, count=count)
+
+    def accept_follower(self, user):
+        return self._user_action('GET', 'friendships/accept', user)
+
+    def deny_follower(self, user):
+        return self._user_action('POST', 'friendships/deny', user)
+
+    def block(self, user):
+        return self._user_action('POST', 'blocks/create', user)
+
+    def unblock(self, user):
+        return self._user_action('POST', 'blocks/destroy', user)
+
+    def is_blocked(self, user):
+        return self._user_action('GET', 'blocks/exists', user, changed=False)
+
+    @property
+    def blocked_users(self):
+        return AsyncPager(self, 'blocks/blocking', AsyncUser.from_json)
+
+    @property
+    def blocked_users_id(self):
+        return AsyncPager(self, 'blocks/ids')
+
+    async def fetch_blocked_users_id(self, workers=8, compact=False):
+        return await async_fetch_ids(self, 'blocks/ids', workers, compact)
+
+    @property
+    def trends(self):
+        return self.get('trends/list')
 
 
-class Stream(threading.Thread):
+def _is_coroutine_function(action):
+    """`action` 是否协程函数，包括用 functools.partial 包装的协程函数和 `__call__` 为协程函数的对象"""
+    while isinstance(action, functools.partial):
+        action = action.func
+    return asyncio.iscoroutinefunction(action) or asyncio.iscoroutinefunction(getattr(action, '__call__', None))
+
+
+class _LoopAction:
     """
-    Streamming API, 实时监测用户动作
+    交给 dispatcher 执行的普通监听器，返回值可等待时交回事件循环执行。
+
+    按原来的监听器比较和计算哈希，:class:`PoolDispatcher` 仍然把同一个监听器的事件分到同一个线程。
     """
 
-    def __init__(self, fan):
-        super().__init__()
-        self.fan = fan
-        self._conn = None
-        self._listeners = []  # type:[Listener]
-        self._lock = threading.RLock()
-        # self._counter = itertools.count()  # counter 记录监听器加入顺序
-        self._running = True
-        self._init()
+    __slots__ = ('action', 'mux', 'loop')
 
-    def _init(self):
-        """
-        开始建立长连接
-        """
-        self._conn = self.fan.session.post('http://stream.fanfou.com/1/user.json', stream=True)
-        if self._conn.encoding is None:
-            self._conn.encoding = 'utf8'
+    def __init__(self, action, mux, loop):
+        self.action = action
+        self.mux = mux
+        self.loop = loop
 
-    def stop(self):
-        """
-        停止监听事件
-        """
-        self._running = False
+    def __call__(self, event):
+        rv = self.action(event)
+        if inspect.isawaitable(rv):
+            self.loop.call_soon_threadsafe(self.mux._spawn, rv)
 
-    def run(self):
-        """
-        开始监听事件
-        """
-        for chunk in self._conn.iter_content(chunk_size=None, decode_unicode=True):
-            evt = self._parse_chunk(chunk)
-            for action in self._pick_listeners(evt):
-                try:
-                    action(evt)
-                except Exception as e:
-                    logger.error(e)
-            if not self._running:
-                break
-        self._conn.close()
+    def __eq__(self, other):
+        return self.action == getattr(other, 'action', other)
 
-    def _pick_listeners(self, event):
-        with self._lock:
-            # 将堆导出为一个有序的列表
-            # listeners = self._listeners[:]
-            # queue = list(map(heapq.heappop, [listeners] * len(listeners)))
+    def __hash__(self):
+        return hash(self.action)
 
-            for lsn in self._listeners:
-                if lsn.on & event.type and (lsn.ttl is None or lsn.ttl > 0):
-                    yield lsn.action
 
-                    if lsn.ttl is not None:
-                        lsn.ttl -= 1
+class StreamMux(_Listenable):
+    """
+    在一个事件循环中同时维护多个账号的 Streaming API 长连接，所有事件交给同一组监听器处理。
 
-    def _parse_chunk(self, chunk):
-        if chunk == '\r\n':
-            return Event(self.fan, Event.HEART_BEAT, r'\r\n')
+    监听器的注册方式与 :class:`Stream` 相同，回调函数可以是普通函数或者协程函数。
+    协程函数（包括 functools.partial 包装的协程函数）在新的任务中执行；普通函数交给 `dispatcher`，
+    默认在 :class:`PoolDispatcher` 的线程中执行，慢的回调不会阻塞事件循环，返回值可等待时再交回事件循环执行。
+    :attr:`Event.fan` 是收到事件的账号::
 
-        try:
-            data = json.loads(chunk)
-        except json.JSONDecodeError as e:
-            logger.error(e)
-            return Event(Event.ERROR, e)
+        mux = StreamMux()
+        for token in tokens:
+            mux.add(AsyncFan(consumer_key, consumer_secret, token))
 
-        event_name = data['event'].upper().replace('.', '_')
-        type = getattr(Event, event_name, Event.ERROR)
+        @mux.on(Event.MESSAGE_CREATE)
+        async def handle(event):
+            ...
 
-        event = Event(self.fan, type, data)
-        return event
+        await mux.run()
 
-    def install_listener(self, listener):
-        """
-        添加新的监听器
-        :param Listener listener: Listener 对象
-        """
-        # seq = next(self._counter)
-        with self._lock:
-            self._listeners.append(listener)
+    :param Dispatcher dispatcher: 调用普通函数监听器的方式，默认为 :class:`PoolDispatcher`
+    :param int max_pending: 同时执行的协程回调的上限，达到上限时暂停读取连接
+    """
+
+    stream_url = Stream.stream_url
+
+    def __init__(self, reconnect=True, backoff=1.0, max_backoff=60.0, heartbeat_timeout=90.0,
+                 dispatcher=None, max_pending=1000):
+        if aiohttp is None:
+            raise ImportError('StreamMux requires aiohttp')
+        self.reconnect = reconnect
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.heartbeat_timeout = heartbeat_timeout
+        self.dispatcher = dispatcher or PoolDispatcher()  # type: Dispatcher
+        self.max_pending = max_pending
+        self.reconnects = 0
+        """所有连接自动重连的总次数"""
+        self._table = ListenerTable()
+        self._fans = []  # type: [AsyncFan]
+        self._tasks = {}
+        self._pending = set()
+        self._running = False
+        self._stopped = None  # type: asyncio.Event
+
+    @property
+    def fans(self):
+        """所有账号"""
+        return list(self._fans)
 
-    def on(self, event, ttl=None):
+    def add(self, fan):
         """
-        作为装饰器使用，添加新的监听器
+        添加一个账号，运行中添加的账号会立即建立连接
 
-        :param event: 监听的事件, 多个事件请用 | 连接。如 `Event.MESSAGE | Event.FREIENDS`
-        :param int priority：监听器的优先级，数字越小优先级越高
-        :param int ttl: 此监听器执行的次数，`None` 表示不限次数
+        :param AsyncFan fan: 已授权的账号
         """
+        self._fans.append(fan)
+        if self._running:
+            self._start(fan)
+
+    def remove(self, fan):
+        """断开并移除一个账号"""
+        self._fans.remove(fan)
+        task = self._tasks.pop(fan, None)
+        if task is not None:
+            task.cancel()
+
+    def _start(self, fan):
+        self._tasks[fan] = asyncio.ensure_future(self._connect(fan))
+
+    async def run(self):
+        """为所有账号建立连接并分发事件，直到调用 :meth:`stop`"""
+        self._running = True
+        self._stopped = asyncio.Event()
+        for fan in self._fans:
+            self._start(fan)
+        try:
+            await self._stopped.wait()
+        finally:
+            self._running = False
+            tasks = list(self._tasks.values())
+            self._tasks.clear()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self._pending:
+                await asyncio.wait(list(self._pending))
 
-        def decorator(func):
-            listener = Listener(event, func, ttl)
-            self.install_listener(listener)
+    def stop(self):
+        """停止所有连接，需要在事件循环所在的线程中调用"""
+        self._running = False
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def _connect(self, fan):
+        timeout = aiohttp.ClientTimeout(sock_connect=10, sock_read=self.heartbeat_timeout)
+        failures = 0
+        connected = False
+        while self._running:
+            try:
+                # 每次连接都需要新的签名
+                url, headers, _ = fan._sign('POST', self.stream_url)
+                async with fan.http.post(yarl.URL(url, encoded=True), headers=headers,
+                                         timeout=timeout) as response:
+                    response.raise_for_status()
+                    if connected:
+                        self.reconnects += 1
+                    connected = True
+                    framer = StreamFramer()
+                    async for chunk in response.content.iter_any():
+                        failures = 0
+                        for frame in framer.feed(chunk):
+                            await self._handle(fan, frame)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                # 连接断开、心跳超时或者服务器返回错误
+                logger.error(e)
+            if not self.reconnect:
+                break
+            await asyncio.sleep(_backoff(self.backoff, self.max_backoff, failures))
+            failures += 1
 
-        return decorator
+    async def _handle(self, fan, frame):
+        try:
+            evt = _parse_frame(fan, frame, event_class=AsyncEvent)
+            if evt is not None:
+                await self._dispatch(evt)
+        except Exception as e:
+            # 单个事件出错时跳过，不能结束这个账号的连接
+            logger.error('Failed to handle frame: %r', e)
+
+    async def _dispatch(self, evt):
+        loop = asyncio.get_event_loop()
+        for action in self._table.actions(evt.type, evt):
+            if not _is_coroutine_function(action):
+                self.dispatcher.submit(_LoopAction(action, self, loop), evt)
+                continue
+            if len(self._pending) >= self.max_pending:
+                await asyncio.wait(list(self._pending), return_when=asyncio.FIRST_COMPLETED)
+            try:
+                rv = action(evt)
+            except Exception as e:
+                logger.error(e)
+                continue
+            if inspect.isawaitable(rv):
+                self._spawn(rv)
+
+    def _spawn(self, awaitable):
+        task = asyncio.ensure_future(self._run_async(awaitable))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _run_async(self, awaitable):
+        try:
+            await awaitable
+        except Exception as e:
+            logger.error(e)